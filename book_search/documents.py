@@ -1,9 +1,13 @@
 """Elasticsearch document model for django-elasticsearch-dsl
 """
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from elasticsearch_dsl import analyzer
 from django_elasticsearch_dsl import Document, fields, Keyword
 from django_elasticsearch_dsl.registries import registry
-from .models import ChildPage
+from .models import ChildPage, ParentDocument
 
 
 booksearch_analyzer = analyzer(
@@ -13,12 +17,38 @@ booksearch_analyzer = analyzer(
     char_filter=['html_strip']
 )
 
+booksearch_suggest_analyzer = analyzer(
+    "booksearch_suggest_analyzer",
+    tokenizer="standard",
+    filter=['lowercase', 'asciifolding']
+)
+
+# how content is indexed for each highlighter (settings.SEARCH_HIGHLIGHTER).
+# plain re-analyses the text of every highlighted page, unified uses the
+# offsets stored in the postings and fvh the term vectors, at the cost of a
+# bigger index
+CONTENT_HIGHLIGHT_OPTIONS = {
+    'plain': {},
+    'unified': {'index_options': 'offsets'},
+    'fvh': {'term_vector': 'with_positions_offsets'},
+}
+
+
+def content_highlight_options(highlighter: str) -> dict:
+    """Mapping parameters of the content field needed by a highlighter type."""
+    try:
+        return CONTENT_HIGHLIGHT_OPTIONS[highlighter]
+    except KeyError:
+        raise ImproperlyConfigured(f'Unknown highlighter {highlighter!r}, '
+                                   f'expected one of {", ".join(CONTENT_HIGHLIGHT_OPTIONS)}') from None
+
 
 @registry.register_document
 class ChildPageDocument(Document):
 
-    content = fields.TextField(attr='html_content',
-                               analyzer=booksearch_analyzer)
+    content = fields.TextField(attr='html',
+                               analyzer=booksearch_analyzer,
+                               **content_highlight_options(settings.SEARCH_HIGHLIGHTER))
     title = fields.TextField(fields={'keyword': Keyword()})
     author = fields.KeywordField(attr='author')
 
@@ -45,3 +75,31 @@ class ChildPageDocument(Document):
         # Paginate the django queryset used to populate the index with the specified size
         # (by default it uses the database driver's default setting)
         # queryset_pagination = 5000
+
+
+@registry.register_document
+class BookSuggestDocument(Document):
+    """Title and author of each book, for search-as-you-type suggestions.
+
+    One doc per book in a small index of its own, so suggestion lookups never
+    touch the page index.  See elasticsearch.suggest.
+    """
+    title = fields.SearchAsYouTypeField(analyzer=booksearch_suggest_analyzer)
+    author = fields.SearchAsYouTypeField(analyzer=booksearch_suggest_analyzer)
+    # shown for books without a title in their metadata
+    parent_filename = fields.KeywordField(index=False)
+
+    class Index:
+        name = 'booksearch_suggest'
+        settings = {'number_of_shards': 1,
+                    'number_of_replicas': 1}
+
+    class Django:
+        model = ParentDocument
+        # a ParentDocument is saved several times per conversion, and on every
+        # re-scan of an unchanged file, so the doc is indexed once after a
+        # conversion commits instead, see indexing.index_suggest_document
+        ignore_signals = True
+
+    def prepare_parent_filename(self, instance):
+        return Path(instance.filepath).name
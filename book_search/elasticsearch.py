@@ -1,210 +1,852 @@
+import asyncio
+import base64
+import binascii
+from contextlib import contextmanager
+import hashlib
+import json
+import os
 import re
+import threading
+import time
+import weakref
 from pprint import pprint
 import logging
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import caches
 
-from elasticsearch import Elasticsearch
+from elasticsearch import ApiError, AsyncElasticsearch, ConnectionTimeout, Elasticsearch
 from elasticsearch_dsl import Search, Q
 
+from .metrics import SEARCH_CACHE_REQUESTS, SEARCH_PARTIAL, record_phase, timed_phase
+
 logger = logging.getLogger(__name__)
 
 HOST = "https://127.0.0.1"
 PORT = 9200
-TIMEOUT = 1000
 
 EDGE_STRIP_REGEX = re.compile(r'^>|<$|^[,.\-:;"”]+')
+# characters EDGE_STRIP_REGEX can strip from the start of a highlight
+EDGE_STRIP_CHARS = frozenset('>,.-:;"”')
+
+
+# process-wide client, see get_client()
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+# async clients by event loop, see get_async_client()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _reset_client_after_fork():
+    """Drop the parent's client in a forked child.
+
+    The pooled connections belong to the parent process, so the child must not
+    reuse (or close) them.  A fresh client is built lazily on first use.
+    """
+    global _client, _client_pid, _client_lock, _async_clients
+    _client, _client_pid = None, None
+    _client_lock = threading.Lock()
+    _async_clients = weakref.WeakKeyDictionary()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_after_fork)
+
+
+def get_client() -> Elasticsearch:
+    """Return the shared Elasticsearch client for this process.
+
+    The client is created on first use and keeps a pool of keep-alive
+    connections, so the TLS handshake and CA cert loading are paid once per
+    process rather than once per query.  Pool size, timeouts and retries come
+    from the ELASTIC_* settings.
+
+    If the process id has changed since the client was built (eg a gunicorn or
+    uwsgi worker forked after the app was preloaded) a new client is built.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = Elasticsearch(settings.ELASTIC_URL, **client_options())
+                _client_pid = pid
+    return _client
+
+
+def get_async_client() -> AsyncElasticsearch:
+    """Return the shared AsyncElasticsearch client for the running event loop.
+
+    aiohttp sessions are bound to the loop they are created in, so there is
+    one client per loop, normally one per ASGI worker process.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncElasticsearch(settings.ELASTIC_URL, **client_options())
+    return client
+
+
+def client_options() -> dict:
+    """Connection options shared by the sync and async clients."""
+    return {
+        'basic_auth': (settings.ELASTIC_USER, settings.ELASTIC_PASSWORD),
+        'ca_certs': settings.ELASTIC_CA_CERT,
+        'connections_per_node': settings.ELASTIC_CONNECTIONS_PER_NODE,
+        'request_timeout': settings.ELASTIC_TIMEOUT,
+        'max_retries': settings.ELASTIC_MAX_RETRIES,
+        'retry_on_timeout': settings.ELASTIC_RETRY_ON_TIMEOUT,
+    }
+
+
+def record_search_timing(response, seconds: float):
+    """Record the time ES spent on a search (took) and the rest of the round trip as search phases.
+
+    :param seconds - wall time of the client's search call
+    """
+    took = response['took'] / 1000
+    record_phase('es', took)
+    record_phase('network', max(0.0, seconds - took))
+
+
+def timed_search(client, **kwargs):
+    """client.search(**kwargs), recording its timing with record_search_timing."""
+    start = time.perf_counter()
+    response = client.search(**kwargs)
+    record_search_timing(response, time.perf_counter() - start)
+    return response
+
+
+async def async_timed_search(client, **kwargs):
+    """Async version of timed_search."""
+    start = time.perf_counter()
+    response = await client.search(**kwargs)
+    record_search_timing(response, time.perf_counter() - start)
+    return response
+
+
+def search_budget(query_type: str):
+    """Latency budget in seconds for searches of query_type, None if it has none, see settings.SEARCH_LATENCY_BUDGET."""
+    return settings.SEARCH_LATENCY_BUDGET.get(query_type)
+
+
+def apply_budget(query_type: str, body: dict) -> dict:
+    """Limit a search body to the latency budget of query_type.
+
+    ES stops collecting hits when the budget is spent and returns those it
+    has with timed_out set.  The budget covers the query phase on each shard,
+    not fetching and highlighting the hits, so the client waits
+    settings.SEARCH_DEADLINE_GRACE longer before giving up on it.
+
+    :return client options for the search's deadline, for client.options()
+    """
+    if settings.SEARCH_TERMINATE_AFTER:
+        body["terminate_after"] = settings.SEARCH_TERMINATE_AFTER
+    budget = search_budget(query_type)
+    if budget is None:
+        return {}
+    body["timeout"] = f"{round(budget * 1000)}ms"
+    # a retry would start the budget over
+    return {'request_timeout': budget + settings.SEARCH_DEADLINE_GRACE, 'retry_on_timeout': False}
+
+
+def deadline_response() -> dict:
+    """An empty, timed out response, for a search ES didn't answer by its deadline."""
+    return {'took': 0, 'timed_out': True, 'deadline': True,
+            '_shards': {'failed': 0}, 'hits': {'total': {'value': 0}, 'hits': []}}
+
+
+def budgeted_search(client, query_type: str, **kwargs):
+    """timed_search, within the latency budget of query_type, see apply_budget.
+
+    If ES hasn't answered by the deadline the request is dropped and
+    deadline_response returned, so a worker is never tied up for longer.
+    """
+    options = apply_budget(query_type, kwargs['body'])
+    start = time.perf_counter()
+    try:
+        return timed_search(client.options(**options), **kwargs)
+    except ConnectionTimeout:
+        record_phase('es', time.perf_counter() - start)
+        logger.warning('%s search missed its %ss deadline', query_type, options.get('request_timeout'))
+        return deadline_response()
+
+
+async def async_budgeted_search(client, query_type: str, **kwargs):
+    """Async version of budgeted_search."""
+    options = apply_budget(query_type, kwargs['body'])
+    start = time.perf_counter()
+    try:
+        return await async_timed_search(client.options(**options), **kwargs)
+    except ConnectionTimeout:
+        record_phase('es', time.perf_counter() - start)
+        logger.warning('%s search missed its %ss deadline', query_type, options.get('request_timeout'))
+        return deadline_response()
+
+
+def partial_reason(response) -> str:
+    """Why a search's results are incomplete, or '' if they are complete.
+
+    'deadline' - ES didn't answer by the client's deadline, there are no results
+    'timeout' - ES returned the hits it had collected when the budget was spent
+    'terminated' - a shard stopped at settings.SEARCH_TERMINATE_AFTER pages
+    'shard_failure' - some shards failed, their matches are missing
+    """
+    if response.get('deadline'):
+        return 'deadline'
+    if response.get('timed_out'):
+        return 'timeout'
+    if response.get('terminated_early'):
+        return 'terminated'
+    if response.get('_shards', {}).get('failed'):
+        return 'shard_failure'
+    return ''
+
+
+def is_partial(response) -> bool:
+    """True if a search's results are incomplete, counted in the partial search metric by reason."""
+    reason = partial_reason(response)
+    if reason:
+        SEARCH_PARTIAL.inc(reason=reason)
+    return bool(reason)
 
 
 def clean_highlight(highlight_html: str):
     """Clean possible unwanted leading and trailing characters"""
-    return re.sub(EDGE_STRIP_REGEX, '', highlight_html)
-
-
-def move_single_inner_hit_up(query_return):
-    """Moves a single nested inner hit to parent dict.
-
-    This has to be done because template logic can't call
-    {{ result['inner_hits'][0] }}.
-    """
-    for hit in query_return:
-        if hit['num_inner_hits'] == 1:
-            hit['single_inner_hit'] = hit['inner_hits'][0]
-    return query_return
-
-
-def add_highlight_count(query_return):
-    # must be called before move_single_inner_hit_up
-    for hit in query_return:
-        for inner_hit in hit['inner_hits']:
-            inner_hit['highlight_count'] = len(inner_hit['highlights'])
-    # print('add_highlight_count:')
-    # pprint(query_return)
-    return query_return
-
-
-def match_search(query: str) -> (int, list):
-    # client = Elasticsearch([{'scheme': 'http', 'host': HOST, 'port': PORT}], timeout=TIMEOUT)
-    client = Elasticsearch(settings.ELASTIC_URL,
-                           basic_auth=(settings.ELASTIC_USER, settings.ELASTIC_PASSWORD),
-                           ca_certs=settings.ELASTIC_CA_CERT,
-                           timeout=TIMEOUT)
-    response = client.search(
-        index = "booksearch",
-        body = {
-            "_source": [
-                "author", "title", "parent_doc_id",
-                "page_number", "parent_filename"
-            ],
-            "query": {
-                "match": {
-                    "content": {
-                        "query": query
-                    }
-                }
-            },
-            "collapse": {
-                "field": "parent_doc_id",
-                "inner_hits": {
-                    "name": "matched_pages",
-                    "size": 5,
-                    "_source": [
-                        "author", "title", "parent_doc_id",
-                        "page_number"
-                    ],
-                    "highlight": {
-                        "fields": {
-                            "content": { "type": "plain" }
-                        },
-                        "fragment_size": "100"
-                    }
-                }
+    # most fragments have nothing to strip, so only run the regex when they might
+    if highlight_html and (highlight_html[0] in EDGE_STRIP_CHARS or highlight_html[-1] in '<\n'):
+        return EDGE_STRIP_REGEX.sub('', highlight_html)
+    return highlight_html
+
+
+SOURCE_FIELDS = ["author", "title", "parent_doc_id", "page_number", "parent_filename"]
+INNER_HIT_SOURCE_FIELDS = ["author", "title", "parent_doc_id", "page_number"]
+# pages returned for each book in a collapsed search
+INNER_HITS_SIZE = 5
+
+
+def highlight_clause(highlighter: str = None) -> dict:
+    """Highlight clause for the page content, highlighter defaults to settings.SEARCH_HIGHLIGHTER."""
+    return {
+        "fields": {
+            "content": {"type": highlighter or settings.SEARCH_HIGHLIGHTER}
+        },
+        "fragment_size": "100"
+    }
+
+
+def content_query(query_type: str, query: str) -> dict:
+    """Query clause on the page content, query_type is 'match' or 'match_phrase'."""
+    return {
+        query_type: {
+            "content": {
+                "query": query
             }
         }
+    }
 
-    )
-    return_list = []
-    total_hits = int(response['hits']['total']['value'])
-    for hit in response['hits']['hits']:
-        # print(f"hit:")
-        # pprint(hit)
-        hit_return = {
-            'parent_doc_id': hit['_source']['parent_doc_id'],
-            'parent_filename': hit['_source']['parent_filename'],
-            'title': hit['_source']['title'],
-            'author': hit['_source']['author'],
-            'num_inner_hits': len(hit['inner_hits']['matched_pages']['hits']['hits']),
-            'inner_hits': []
+
+# facets: the keyword field each is aggregated on, and filtered on when a value is selected
+FACET_FIELDS = {"author": "author", "title": "title.keyword"}
+
+
+def search_query(query_type: str, query: str, filters: dict = None) -> dict:
+    """content_query, narrowed to the selected facet values.
+
+    The facets are filter clauses, which aren't scored and are cached by ES,
+    so narrowing a search doesn't rescore the rest of the corpus.
+
+    :param filters - facet name to selected value, see FACET_FIELDS
+    """
+    if not filters:
+        return content_query(query_type, query)
+    return {
+        "bool": {
+            "must": [content_query(query_type, query)],
+            "filter": [{"term": {FACET_FIELDS[name]: value}} for name, value in sorted(filters.items())],
         }
-        # print(f"inner_hits: {len(hit['inner_hits']['matched_pages']['hits']['hits'])}")
-        for inner_hit in hit['inner_hits']['matched_pages']['hits']['hits']:
-            # print('inner hit')
-            hit_return['inner_hits'].append(
-                {
-                    'parent_doc_id': inner_hit['_source']['parent_doc_id'],
-                    'title': inner_hit['_source']['title'],
-                    'author': inner_hit['_source']['author'],
-                    'page_number': inner_hit['_source']['page_number'],
-                    'highlights': [clean_highlight(highlight)
-                                   for highlight in inner_hit['highlight']['content']]
-
-
-                }
-            )
-        return_list.append(hit_return)
-    return_list = add_highlight_count(return_list)
-    return_list = move_single_inner_hit_up(return_list)
-    return total_hits, return_list
-
-
-def match_phrase_search(query: str) -> (int, list):
-    client = Elasticsearch(settings.ELASTIC_URL,
-                           basic_auth=(settings.ELASTIC_USER, settings.ELASTIC_PASSWORD),
-                           ca_certs=settings.ELASTIC_CA_CERT,
-                           timeout=TIMEOUT)
-    response = client.search(
-        index = "booksearch",
-        body = {
-            "_source": [
-                "author", "title", "parent_doc_id",
-                "page_number", "parent_filename"
-            ],
-            "query": {
-                "match_phrase": {
-                    "content": {
-                        "query": query
-                    }
-                }
-            },
-            "collapse": {
-                "field": "parent_doc_id",
-                "inner_hits": {
-                    "name": "matched_pages",
-                    "size": 5,
-                    "_source": [
-                        "author", "title", "parent_doc_id",
-                        "page_number"
-                    ],
-                    "highlight": {
-                        "fields": {
-                            "content": { "type": "plain" }
-                        },
-                        "fragment_size": "100"
-                    }
-                }
+    }
+
+
+def facet_aggs() -> dict:
+    """Aggregations counting the matching pages for the top values of each facet."""
+    return {
+        name: {"terms": {"field": field, "size": settings.SEARCH_FACET_SIZE, "exclude": [""]}}
+        for name, field in FACET_FIELDS.items()
+    }
+
+
+def shape_facets(response) -> dict:
+    """Return facet name to a list of (value, matching pages) from a search with facet_aggs."""
+    aggregations = response.get('aggregations', {})
+    return {name: [(bucket['key'], bucket['doc_count']) for bucket in aggregations[name]['buckets']]
+            for name in FACET_FIELDS if name in aggregations}
+
+
+def collapsed_search_body(query_type: str, query: str, filters: dict = None, facets: bool = False) -> dict:
+    """Search body returning one hit per book, with its best matching pages as inner hits.
+
+    :param filters - selected facet values, see search_query
+    :param facets - if True count the facet values of the matches in the same request
+    """
+    body = {
+        "_source": SOURCE_FIELDS,
+        "query": search_query(query_type, query, filters),
+        "collapse": {
+            "field": "parent_doc_id",
+            "inner_hits": {
+                "name": "matched_pages",
+                "size": INNER_HITS_SIZE,
+                "sort": [{"_score": "desc"}, {"page_number": "asc"}],
+                "_source": INNER_HIT_SOURCE_FIELDS,
+                "highlight": highlight_clause()
             }
         }
+    }
+    if facets:
+        body["aggs"] = facet_aggs()
+    return body
 
-    )
-    return_list = []
-    total_hits = int(response['hits']['total']['value'])
+
+class Hit:
+    """Base of the search results.
+
+    Results have fixed attributes (__slots__) so they are cheap to build and
+    cache.  Item access is supported as well: Django templates try it first,
+    so it saves an exception per variable lookup, and the json api selects
+    fields with it.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    # pickle (for the result cache) as a tuple of values rather than a dict of slot names to values
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class PageHit(Hit):
+    """A matching page, with its highlights cleaned."""
+    __slots__ = ('parent_doc_id', 'title', 'author', 'page_number', 'highlights', 'highlight_count')
+
+    def __init__(self, hit: dict):
+        source = hit['_source']
+        self.parent_doc_id = source['parent_doc_id']
+        self.title = source['title']
+        self.author = source['author']
+        self.page_number = source['page_number']
+        self.highlights = [clean_highlight(highlight) for highlight in hit['highlight']['content']]
+        self.highlight_count = len(self.highlights)
+
+
+class BookHit(Hit):
+    """A matching book from a collapsed search, with its best matching pages.
+
+    single_inner_hit is the only page if just one matched, as template logic
+    can't call {{ result['inner_hits'][0] }}.
+    """
+    __slots__ = ('parent_doc_id', 'parent_filename', 'title', 'author', 'num_inner_hits', 'inner_hits',
+                 'single_inner_hit')
+
+    def __init__(self, hit: dict):
+        source = hit['_source']
+        self.parent_doc_id = source['parent_doc_id']
+        self.parent_filename = source['parent_filename']
+        self.title = source['title']
+        self.author = source['author']
+        inner_hits = hit['inner_hits']['matched_pages']['hits']['hits']
+        self.inner_hits = [PageHit(inner_hit) for inner_hit in inner_hits]
+        self.num_inner_hits = len(self.inner_hits)
+        self.single_inner_hit = self.inner_hits[0] if self.num_inner_hits == 1 else None
+
+
+def shape_collapsed_hits(response) -> [BookHit]:
+    """Convert the hits of a collapsed search into the results used by the templates."""
+    with timed_phase('shape'):
+        return [BookHit(hit) for hit in response['hits']['hits']]
+
+
+def iter_collapsed_hits(response):
+    """Yield the same results as shape_collapsed_hits, one book at a time."""
     for hit in response['hits']['hits']:
-        # print(f"hit:")
-        # pprint(hit)
-        hit_return = {
-            'parent_doc_id': hit['_source']['parent_doc_id'],
-            'parent_filename': hit['_source']['parent_filename'],
-            'title': hit['_source']['title'],
-            'author': hit['_source']['author'],
-            'num_inner_hits': len(hit['inner_hits']['matched_pages']['hits']['hits']),
-            'inner_hits': []
-        }
-        # print(f"inner_hits: {len(hit['inner_hits']['matched_pages']['hits']['hits'])}")
-        for inner_hit in hit['inner_hits']['matched_pages']['hits']['hits']:
-            # print('inner hit')
-            hit_return['inner_hits'].append(
-                {
-                    'parent_doc_id': inner_hit['_source']['parent_doc_id'],
-                    'title': inner_hit['_source']['title'],
-                    'author': inner_hit['_source']['author'],
-                    'page_number': inner_hit['_source']['page_number'],
-                    'highlights': [clean_highlight(highlight)
-                                   for highlight in inner_hit['highlight']['content']]
-
-
-                }
-            )
-        return_list.append(hit_return)
-    return_list = add_highlight_count(return_list)
-    return_list = move_single_inner_hit_up(return_list)
-    return total_hits, return_list
+        yield BookHit(hit)
+
+
+def collapsed_search(query_type: str, query: str, filters: dict = None) -> (int, [BookHit], dict, bool):
+    """Search for books matching the query, with their best matching pages and the facet counts.
+
+    The search is limited to the latency budget of query_type, see budgeted_search.
+
+    :param query_type - 'match' or 'match_phrase'
+    :param filters - selected facet values, see search_query
+    :return (total_hits, results, facets, partial), facets as from shape_facets, partial
+        True if the results are incomplete, see partial_reason
+    """
+    body = collapsed_search_body(query_type, query, filters, facets=True)
+    response = budgeted_search(get_client(), query_type, index="booksearch", body=body)
+    total_hits = int(response['hits']['total']['value'])
+    return total_hits, shape_collapsed_hits(response), shape_facets(response), is_partial(response)
+
+
+def collapsed_search_iter(query_type: str, query: str, filters: dict = None):
+    """Like collapsed_search, but each book is shaped as the results are iterated.
+
+    :return (total_hits, iterator of results, facets, partial)
+    """
+    response = budgeted_search(get_client(), query_type, index="booksearch",
+                               body=collapsed_search_body(query_type, query, filters, facets=True))
+
+    def shape():
+        # shaping is interleaved with sending the results, so only the shaping time is recorded
+        shape_seconds = 0.0
+        start = time.perf_counter()
+        for book in iter_collapsed_hits(response):
+            shape_seconds += time.perf_counter() - start
+            yield book
+            start = time.perf_counter()
+        record_phase('shape', shape_seconds)
+
+    return int(response['hits']['total']['value']), shape(), shape_facets(response), is_partial(response)
+
+
+async def async_collapsed_search(query_type: str, query: str,
+                                 filters: dict = None) -> (int, [BookHit], dict, bool):
+    """Async version of collapsed_search."""
+    client = get_async_client()
+    response = await async_budgeted_search(client, query_type, index="booksearch",
+                                           body=collapsed_search_body(query_type, query, filters, facets=True))
+    total_hits = int(response['hits']['total']['value'])
+    return total_hits, shape_collapsed_hits(response), shape_facets(response), is_partial(response)
+
+
+def encode_cursor(cursor: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str, keys=()) -> dict:
+    """Decode a cursor from encode_cursor, raises ValueError if it's invalid.
+
+    :param keys - keys the cursor must have, eg a cursor made by another
+        search or backend doesn't have those expected
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, binascii.Error, UnicodeError, json.JSONDecodeError) as error:
+        raise ValueError(f'invalid cursor: {cursor!r}') from error
+    if not isinstance(position, dict) or not all(key in position for key in keys):
+        raise ValueError(f'invalid cursor: {cursor!r}')
+    return position
+
+
+class CursorExpired(ValueError):
+    """A cursor whose point in time ES has closed, after settings.SEARCH_PIT_KEEP_ALIVE without a request."""
+
+
+@contextmanager
+def cursor_errors(cursor: str, pit: bool = False):
+    """Raise ES rejecting the position in a cursor as ValueError, so it is a bad request rather than a server error.
+
+    :param pit - the cursor has a point in time, so a 404 means it expired, raised as CursorExpired
+    """
+    try:
+        yield
+    except ApiError as error:
+        if not cursor or error.status_code not in ((400, 404) if pit else (400,)):
+            raise
+        if error.status_code == 404:
+            raise CursorExpired(f'expired cursor: {cursor!r}') from error
+        # eg a made up pit id or search_after values
+        raise ValueError(f'invalid cursor: {cursor!r}') from error
+
+
+def search_page(query_type: str, query: str, cursor: str = '', size: int = None,
+                filters: dict = None) -> (int, list, str, bool):
+    """Page through all the books matching a query.
+
+    Uses a point in time so the pages are consistent while the index changes,
+    and search_after on parent_doc_id so each page costs the same however deep
+    it is.  ES only allows search_after with collapse when sorting on the
+    collapse field, so books come in parent_doc_id order rather than by score.
+
+    :param query_type - 'match' or 'match_phrase'
+    :param cursor - '' for the first page, otherwise the cursor returned for the previous page
+    :param size - books per page, default settings.SEARCH_PAGE_SIZE
+    :param filters - selected facet values, see search_query
+    :return (total_hits, results, cursor for the next page or '' if this is the last, partial),
+        partial as from collapsed_search.  A partial page can miss books, but
+        paging carries on after the last one it has.
+
+    Raises ValueError for an invalid cursor, CursorExpired if its point in time has closed.
+    """
+    client = get_client()
+    size = size or settings.SEARCH_PAGE_SIZE
+    if cursor:
+        position = decode_cursor(cursor, ('pit', 'after'))
+    else:
+        pit = client.open_point_in_time(index="booksearch", keep_alive=settings.SEARCH_PIT_KEEP_ALIVE)
+        position = {'pit': pit['id'], 'after': None}
+    body = collapsed_search_body(query_type, query, filters)
+    body.update({
+        "size": size,
+        "pit": {"id": position['pit'], "keep_alive": settings.SEARCH_PIT_KEEP_ALIVE},
+        "sort": [{"parent_doc_id": "asc"}],
+    })
+    if position['after']:
+        body['search_after'] = position['after']
+    with cursor_errors(cursor, pit=True):
+        response = budgeted_search(client, query_type, body=body)
+    partial = is_partial(response)
+    total_hits = int(response['hits']['total']['value'])
+    hits = response['hits']['hits']
+    # a response from deadline_response has no pit_id
+    pit_id = response.get('pit_id', position['pit'])
+    if len(hits) == size or (partial and hits):
+        next_cursor = encode_cursor({'pit': pit_id, 'after': hits[-1]['sort']})
+    else:
+        client.close_point_in_time(id=pit_id)
+        next_cursor = ''
+    return total_hits, shape_collapsed_hits(response), next_cursor, partial
+
+
+class SearchError(Exception):
+    """A search of a batch that failed, see multi_search.  The others in the batch are unaffected."""
+
+    def __init__(self, message: str, status: int = 500):
+        super().__init__(message)
+        self.status = status
+
+
+def multi_search(searches: [(str, str, dict)]) -> list:
+    """Run many collapsed searches in one _msearch request.
+
+    Each search is the same as collapsed_search, within the latency budget of
+    its query type.  ES runs them concurrently, so the client's deadline is
+    that of the longest budget.
+
+    :param searches - (query_type, query, filters) of each search
+    :return for each search in order, (total_hits, results, facets, partial) as
+        from collapsed_search, or a SearchError if ES failed it
+    """
+    if not searches:
+        return []
+    lines, budgets = [], []
+    for query_type, query, filters in searches:
+        body = collapsed_search_body(query_type, query, filters, facets=True)
+        budgets.append(apply_budget(query_type, body))
+        lines += [{}, body]
+    # a search with no budget has no deadline
+    options = max(budgets, key=lambda budget: budget['request_timeout']) if all(budgets) else {}
+
+    start = time.perf_counter()
+    try:
+        response = get_client().options(**options).msearch(index="booksearch", body=lines)
+    except ConnectionTimeout:
+        record_phase('es', time.perf_counter() - start)
+        logger.warning('batch of %d searches missed its %ss deadline', len(searches), options.get('request_timeout'))
+        responses = [deadline_response() for _ in searches]
+    else:
+        record_search_timing(response, time.perf_counter() - start)
+        responses = response['responses']
+
+    results = []
+    for response in responses:
+        if 'error' in response:
+            error = response['error']
+            message = f"{error['type']}: {error['reason']}" if isinstance(error, dict) else str(error)
+            results.append(SearchError(message, response.get('status', 500)))
+            continue
+        results.append((int(response['hits']['total']['value']), shape_collapsed_hits(response),
+                        shape_facets(response), is_partial(response)))
+    return results
+
+
+def more_book_pages(query_type: str, query: str, parent_doc_id: int,
+                    cursor: str = '', size: int = None) -> (list, str):
+    """Fetch further matching pages of one book, after those in the collapsed search.
+
+    Pages are in the same (score) order as the inner hits, with page_number
+    as a tie breaker for search_after, so each call costs the same however
+    far into the book it is.
+
+    :param cursor - '' for the pages following the inner hits, otherwise the
+        cursor returned by the previous call
+    :param size - pages to return, default settings.SEARCH_PAGE_SIZE
+    :return (page hits, cursor for the next call or '' if there are no more)
+
+    Raises ValueError for an invalid cursor.
+    """
+    size = size or settings.SEARCH_PAGE_SIZE
+    body = {
+        "_source": INNER_HIT_SOURCE_FIELDS,
+        "size": size,
+        "query": {
+            "bool": {
+                "must": [content_query(query_type, query)],
+                "filter": [{"term": {"parent_doc_id": parent_doc_id}}],
+            }
+        },
+        "sort": [{"_score": "desc"}, {"page_number": "asc"}],
+        "highlight": highlight_clause(),
+    }
+    if cursor:
+        body['search_after'] = decode_cursor(cursor, ('after',))['after']
+    else:
+        body['from'] = INNER_HITS_SIZE
+    with cursor_errors(cursor):
+        response = timed_search(get_client(), index="booksearch", body=body)
+    hits = response['hits']['hits']
+    with timed_phase('shape'):
+        pages = [PageHit(hit) for hit in hits]
+    next_cursor = encode_cursor({'after': hits[-1]['sort']}) if len(hits) == size else ''
+    return pages, next_cursor
 
 
 QUOTE_QUERY_REGEX = re.compile(r"""["'](.*)["']""")
 
 
-def handle_query(query: str) -> (int, list):
-    """Dispatch to actual query function."""
+def normalize_query(query: str) -> str:
+    """Normalise a query for use in a cache key.
+
+    The analyzer lowercases and tokenizes on whitespace, so case and runs of
+    whitespace don't change the results.
+    """
+    return ' '.join(query.split()).lower()
+
+
+def search_cache_key(mode: str, query: str, generation: int, filters: dict = None) -> str:
+    key = normalize_query(query)
+    if filters:
+        # facet values are matched exactly, so they aren't normalised
+        key += json.dumps(sorted(filters.items()))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return f'search:{generation}:{mode}:{digest}'
+
+
+def search_cache_stats() -> dict:
+    """Return the result cache hit and miss counts for this process."""
+    counts = {dict(labels)['result']: count for labels, count in SEARCH_CACHE_REQUESTS.values.items()}
+    return {'hits': counts.get('hit', 0), 'misses': counts.get('miss', 0)}
+
+
+def cached_search(mode: str, query: str, filters: dict = None) -> (int, list, dict, bool):
+    """Run the search for mode with the search backend, using the result cache in settings.SEARCH_CACHE_ALIAS.
+
+    Keys include the IndexGeneration, so results cached before an ingest or
+    delete are never returned.  Eviction (LRU/TTL) is up to the cache backend.
+    Partial results aren't cached, so the next search for the query can get
+    them all.
+
+    :param filters - selected facet values, see search_query
+    :return (total_hits, results, facets, partial), see collapsed_search
+    """
+    from .search_backends import get_backend
+
+    with timed_phase('cache'):
+        cache, key = current_search_cache_key(mode, query, filters)
+        result = cache.get(key)
+    if result is not None:
+        SEARCH_CACHE_REQUESTS.inc(result='hit')
+        return result
+    SEARCH_CACHE_REQUESTS.inc(result='miss')
+    result = get_backend().search(mode, query, filters)
+    if not result[3]:
+        cache.set(key, result)
+    return result
+
+
+def current_search_cache_key(mode: str, query: str, filters: dict = None):
+    """Return the search cache and the key for the query at the current IndexGeneration."""
+    from .models import IndexGeneration
+
+    return caches[settings.SEARCH_CACHE_ALIAS], search_cache_key(mode, query, IndexGeneration.current(), filters)
+
+
+def cached_search_iter(mode: str, query: str, filters: dict = None):
+    """Like cached_search, but on a cache miss each book is yielded as soon as it is shaped.
+
+    The results are cached once they have all been consumed.
+
+    :return (total_hits, iterator of results, facets, partial)
+    """
+    from .search_backends import get_backend
+
+    with timed_phase('cache'):
+        cache, key = current_search_cache_key(mode, query, filters)
+        result = cache.get(key)
+    if result is not None:
+        SEARCH_CACHE_REQUESTS.inc(result='hit')
+        total_hits, results, facets, partial = result
+        return total_hits, iter(results), facets, partial
+    SEARCH_CACHE_REQUESTS.inc(result='miss')
+    total_hits, books, facets, partial = get_backend().search_iter(mode, query, filters)
+    if partial:
+        return total_hits, books, facets, partial
+
+    def cache_when_consumed():
+        results = []
+        for book in books:
+            results.append(book)
+            yield book
+        cache.set(key, (total_hits, results, facets, partial))
+
+    return total_hits, cache_when_consumed(), facets, partial
+
+
+async def async_cached_search(mode: str, query: str, filters: dict = None) -> (int, list, dict, bool):
+    """Async version of cached_search, sharing its cache entries."""
+    from .models import IndexGeneration
+    from .search_backends import get_backend
+
+    with timed_phase('cache'):
+        cache = caches[settings.SEARCH_CACHE_ALIAS]
+        key = search_cache_key(mode, query, await sync_to_async(IndexGeneration.current)(), filters)
+        result = await cache.aget(key)
+    if result is not None:
+        SEARCH_CACHE_REQUESTS.inc(result='hit')
+        return result
+    SEARCH_CACHE_REQUESTS.inc(result='miss')
+    result = await get_backend().async_search(mode, query, filters)
+    if not result[3]:
+        await cache.aset(key, result)
+    return result
+
+
+def cached_multi_search(searches: [(str, str, dict)]) -> list:
+    """Run a batch of searches with the search backend, sharing cached_search's cache entries.
+
+    Only the searches not in the cache are run, in one multi_search.  Failed
+    and partial searches aren't cached.
+
+    :param searches - (query_type, query, filters) of each search
+    :return for each search, as from multi_search
+    """
+    from .models import IndexGeneration
+    from .search_backends import get_backend
+
+    with timed_phase('cache'):
+        cache = caches[settings.SEARCH_CACHE_ALIAS]
+        generation = IndexGeneration.current()
+        keys = [search_cache_key(query_type, query, generation, filters) for query_type, query, filters in searches]
+        cached = cache.get_many(keys)
+    misses = [i for i, key in enumerate(keys) if key not in cached]
+    SEARCH_CACHE_REQUESTS.inc(len(keys) - len(misses), result='hit')
+    SEARCH_CACHE_REQUESTS.inc(len(misses), result='miss')
+    results = [cached.get(key) for key in keys]
+    if misses:
+        for i, result in zip(misses, get_backend().multi_search([searches[i] for i in misses])):
+            results[i] = result
+        cache.set_many({keys[i]: results[i] for i in misses
+                        if not isinstance(results[i], SearchError) and not results[i][3]})
+    return results
+
+
+SUGGEST_INDEX = "booksearch_suggest"
+# search_as_you_type subfields of BookSuggestDocument, the shingles score whole word matches higher
+SUGGEST_FIELDS = ["title", "title._2gram", "title._3gram", "author", "author._2gram", "author._3gram"]
+
+
+def suggest_body(prefix: str, size: int) -> dict:
+    """Search body for books whose title or author matches a partial query, the last word as a prefix."""
+    return {
+        "_source": ["title", "author", "parent_filename"],
+        "size": size,
+        "query": {
+            "multi_match": {
+                "query": prefix,
+                "type": "bool_prefix",
+                "fields": SUGGEST_FIELDS
+            }
+        }
+    }
+
+
+def suggest(prefix: str, size: int = None) -> list:
+    """Return title and author suggestions for a partial query, from the book suggest index.
+
+    :param size - max suggestions, default settings.SUGGEST_SIZE
+    :return list of dicts of parent_doc_id, title, author and parent_filename
+    """
+    body = suggest_body(prefix, size or settings.SUGGEST_SIZE)
+    response = timed_search(get_client(), index=SUGGEST_INDEX, body=body)
+    return [{'parent_doc_id': int(hit['_id']), **hit['_source']} for hit in response['hits']['hits']]
+
+
+def cached_suggest(prefix: str) -> list:
+    """suggest, using the result cache in settings.SEARCH_CACHE_ALIAS, see cached_search."""
+    from .models import IndexGeneration
+
+    with timed_phase('cache'):
+        cache = caches[settings.SEARCH_CACHE_ALIAS]
+        key = search_cache_key('suggest', prefix, IndexGeneration.current())
+        result = cache.get(key)
+    if result is None:
+        result = suggest(prefix)
+        cache.set(key, result)
+    return result
+
+
+def parse_query(query: str) -> (str, str):
+    """Return the query type and the query to run for a query from the search form."""
     # match phrase on quotes - only whole expression quoted accepted at this point
     # ie query == "'three wisdoms'", not "word word 'quoted words'"
-    # query_content = query['query']
     m = QUOTE_QUERY_REGEX.match(query)
     if m:
-        match_query = m.groups()[0]
-        logger.info(f"""query: %r running match_phrase search: '%s' """, query, match_query)
-        return match_phrase_search(match_query)
-    logger.info("""query: %r running plain match search: '%s' """, query, query)
-    return match_search(query)
+        return 'match_phrase', m.groups()[0]
+    return 'match', query
+
+
+def handle_query_page(query: str, cursor: str = '', filters: dict = None) -> (int, list, str, bool):
+    """Dispatch to the search backend's search_page, see handle_query."""
+    from .search_backends import get_backend
+
+    query_type, search_query = parse_query(query)
+    logger.info("query: %r running paged %s search: '%s' %s", query, query_type, search_query, filters or '')
+    return get_backend().search_page(query_type, search_query, cursor, filters=filters)
+
+
+def handle_query(query: str, filters: dict = None) -> (int, list, dict, bool):
+    """Dispatch to actual query function.  Results are cached, see cached_search.
+
+    :param filters - selected facet values, see search_query
+    """
+    query_type, search_query = parse_query(query)
+    logger.info("query: %r running %s search: '%s' %s", query, query_type, search_query, filters or '')
+    return cached_search(query_type, search_query, filters)
+
+
+def handle_query_iter(query: str, filters: dict = None):
+    """Dispatch to cached_search_iter, see handle_query."""
+    query_type, search_query = parse_query(query)
+    logger.info("query: %r running streamed %s search: '%s' %s", query, query_type, search_query, filters or '')
+    return cached_search_iter(query_type, search_query, filters)
+
+
+async def async_handle_query(query: str, filters: dict = None) -> (int, list, dict, bool):
+    """Async version of handle_query."""
+    query_type, search_query = parse_query(query)
+    logger.info("query: %r running async %s search: '%s' %s", query, query_type, search_query, filters or '')
+    return await async_cached_search(query_type, search_query, filters)
+
+
+def handle_queries(queries: [(str, dict)]) -> list:
+    """Batch version of handle_query, running the searches in one request, see cached_multi_search.
+
+    :param queries - (query, filters) of each search, query as from the search form
+    :return for each query, (total_hits, results, facets, partial) or a SearchError
+    """
+    searches = [(*parse_query(query), filters) for query, filters in queries]
+    logger.info("running batch of %d searches: %r", len(searches), [query for query, filters in queries])
+    return cached_multi_search(searches)
 
 
 
@@ -3,3 +3,6 @@ from django import forms
 
 class SearchForm(forms.Form):
     query = forms.CharField(label=False)
+    # selected facet values, see elasticsearch.FACET_FIELDS
+    author = forms.CharField(required=False, widget=forms.HiddenInput)
+    title = forms.CharField(required=False, widget=forms.HiddenInput)
@@ -0,0 +1,264 @@
+"""Bulk loading of ChildPages into Elasticsearch.
+
+The django-elasticsearch-dsl signal processor indexes each ChildPage as it is
+saved, one request (and refresh) per page.  For ingest, pages are instead
+written with bulk_create, which sends no signals, and indexed here with the
+bulk helpers.
+"""
+from contextlib import contextmanager
+from itertools import islice
+import logging
+import re
+
+from django.conf import settings
+from elasticsearch.helpers import parallel_bulk, streaming_bulk
+
+from .documents import CONTENT_HIGHLIGHT_OPTIONS, BookSuggestDocument, ChildPageDocument, content_highlight_options
+from .elasticsearch import get_client
+from .metrics import INGEST_INDEX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def autosync_enabled() -> bool:
+    """False if indexing is turned off with django-elasticsearch-dsl's ELASTICSEARCH_DSL_AUTOSYNC.
+
+    The bulk functions here follow the same setting as the signal processor.
+    """
+    return getattr(settings, 'ELASTICSEARCH_DSL_AUTOSYNC', True)
+
+
+def index_child_pages(child_pages, chunk_size=None, in_flight=None, index=None) -> int:
+    """Index child pages in ES with bulk requests, without refreshing the index.
+
+    :param child_pages - saved ChildPage objects
+    :param chunk_size - pages per bulk request, default settings.INGEST_BULK_BATCH_SIZE
+    :param in_flight - max concurrent bulk requests, default settings.INGEST_BULK_IN_FLIGHT
+    :param index - index to write to, default ChildPageDocument's index (alias)
+    :return number of pages indexed
+    """
+    if not autosync_enabled():
+        return 0
+    chunk_size = chunk_size or settings.INGEST_BULK_BATCH_SIZE
+    in_flight = in_flight or settings.INGEST_BULK_IN_FLIGHT
+    actions = ChildPageDocument()._get_actions(child_pages, 'index')
+    if index:
+        actions = ({**action, '_index': index} for action in actions)
+    if in_flight > 1:
+        results = parallel_bulk(get_client(), actions, thread_count=in_flight,
+                                chunk_size=chunk_size, refresh=False)
+    else:
+        results = streaming_bulk(get_client(), actions, chunk_size=chunk_size, refresh=False)
+    indexed = 0
+    with INGEST_INDEX_SECONDS.time():
+        for ok, item in results:
+            # errors raise BulkIndexError by default
+            indexed += 1
+    return indexed
+
+
+def delete_child_pages_from_index(page_ids, chunk_size=None) -> int:
+    """Delete child pages from ES by id with bulk requests.
+
+    Pages already missing from the index are ignored.
+
+    :return number of pages deleted
+    """
+    if not autosync_enabled():
+        return 0
+    index = ChildPageDocument._index._name
+    actions = ({'_op_type': 'delete', '_index': index, '_id': page_id} for page_id in page_ids)
+    deleted = 0
+    for ok, item in streaming_bulk(get_client(), actions, raise_on_error=False,
+                                   chunk_size=chunk_size or settings.INGEST_BULK_BATCH_SIZE):
+        if ok:
+            deleted += 1
+        elif item['delete'].get('status') != 404:
+            logger.error('failed to delete page from index: %s', item)
+    return deleted
+
+
+def index_suggest_document(parent):
+    """Index a ParentDocument's title and author suggestions, without refreshing the index.
+
+    BookSuggestDocument ignores the save signals, so this is called once a
+    conversion has committed.
+    """
+    if autosync_enabled():
+        BookSuggestDocument().update(parent, refresh=False)
+
+
+def delete_suggest_document(parent_id: int):
+    """Delete a ParentDocument's suggestions, if they were indexed."""
+    if autosync_enabled():
+        get_client().options(ignore_status=404).delete(index=BookSuggestDocument._index._name, id=parent_id)
+
+
+def fetch_html_from_index(page_ids) -> dict:
+    """Read the html content of child pages from ES.
+
+    :return {page id: html} for the pages found
+    """
+    if not page_ids:
+        return {}
+    response = get_client().mget(index=ChildPageDocument._index._name, ids=[str(page_id) for page_id in page_ids],
+                                 source_includes=['content'])
+    return {int(doc['_id']): doc['_source']['content'] for doc in response['docs'] if doc.get('found')}
+
+
+@contextmanager
+def refresh_disabled(index=None):
+    """Turn off periodic refresh of the index for the duration of a bulk load.
+
+    The previous refresh_interval is restored and the index refreshed on exit.
+    """
+    if not autosync_enabled():
+        yield
+        return
+    index = index or ChildPageDocument._index._name
+    client = get_client()
+    index_settings = client.indices.get_settings(index=index, name='index.refresh_interval',
+                                                 include_defaults=True)
+    index_settings = next(iter(index_settings.values()))
+    refresh_interval = (index_settings.get('settings', {}).get('index', {}).get('refresh_interval')
+                        or index_settings['defaults']['index']['refresh_interval'])
+    logger.info('disabling refresh on index %s, was: %s', index, refresh_interval)
+    client.indices.put_settings(index=index, settings={'index': {'refresh_interval': '-1'}})
+    try:
+        yield
+    finally:
+        client.indices.put_settings(index=index, settings={'index': {'refresh_interval': refresh_interval}})
+        client.indices.refresh(index=index)
+        logger.info('restored refresh_interval %s on index %s', refresh_interval, index)
+
+
+def versioned_indices(alias: str = None) -> [str]:
+    """Return the names of the alias_vN indices, oldest version first."""
+    alias = alias or ChildPageDocument._index._name
+    pattern = re.compile(rf'{re.escape(alias)}_v(\d+)$')
+    names = get_client().indices.get(index=f'{alias}_v*', expand_wildcards='all').keys()
+    return sorted((name for name in names if pattern.match(name)),
+                  key=lambda name: int(pattern.match(name).group(1)))
+
+
+def create_versioned_index(alias: str = None) -> str:
+    """Create the next alias_vN index, with ChildPageDocument's mapping and settings for bulk loading.
+
+    It has no replicas and refresh turned off, see finish_versioned_index.
+
+    :return the new index's name
+    """
+    alias = alias or ChildPageDocument._index._name
+    existing = versioned_indices(alias)
+    version = int(existing[-1].rsplit('_v', 1)[1]) + 1 if existing else 1
+    name = f'{alias}_v{version}'
+    create_index(name)
+    return name
+
+
+def create_index(name: str, highlighter: str = None):
+    """Create an index with ChildPageDocument's mapping, with no replicas and refresh turned off for bulk loading.
+
+    :param highlighter - index the content for this highlighter type rather
+        than settings.SEARCH_HIGHLIGHTER
+    """
+    index = ChildPageDocument._index.clone(name)
+    index.settings(number_of_replicas=0, refresh_interval='-1')
+    body = index.to_dict()
+    if highlighter:
+        content = body['mappings']['properties']['content']
+        for options in CONTENT_HIGHLIGHT_OPTIONS.values():
+            for option in options:
+                content.pop(option, None)
+        content.update(content_highlight_options(highlighter))
+    # through django-elasticsearch-dsl's connection, as Index.create and search_index --create do,
+    # as its serializer is needed for the analyzer definitions
+    index._get_connection().indices.create(index=name, body=body)
+    logger.info('created index %s', name)
+
+
+def fill_index(index: str, chunk_size=None) -> int:
+    """Index every ChildPage into index, reading the pages in batches.
+
+    :return number of pages indexed
+    """
+    from .models import ChildPage
+
+    chunk_size = chunk_size or settings.INGEST_BULK_BATCH_SIZE
+    pages = ChildPage.objects.order_by('pk').iterator(chunk_size=chunk_size)
+    return index_child_pages(prefetch_html(pages, chunk_size), chunk_size=chunk_size, index=index)
+
+
+def prefetch_html(pages, chunk_size: int):
+    """Yield pages, reading the html of those stored only in ES with one request per chunk of pages.
+
+    Otherwise ChildPage.html would fetch it a page at a time.
+    """
+    pages = iter(pages)
+    while chunk := list(islice(pages, chunk_size)):
+        html = fetch_html_from_index([page.pk for page in chunk
+                                      if not page.html_content and page.compressed_content is None])
+        for page in chunk:
+            if page.pk in html:
+                page._html = html[page.pk]
+            yield page
+
+
+def finish_versioned_index(index: str, wait_timeout: str = '5m'):
+    """Restore ChildPageDocument's replica and refresh settings on a bulk loaded index and force merge it.
+
+    Waits up to wait_timeout for the replicas to be allocated, so the index
+    serves at full capacity once it is swapped in.
+    """
+    client = get_client()
+    replicas = ChildPageDocument._index._settings.get('number_of_replicas', 1)
+    client.indices.put_settings(index=index, settings={'index': {'number_of_replicas': replicas,
+                                                                 'refresh_interval': None}})
+    client.indices.refresh(index=index)
+    client.indices.forcemerge(index=index, max_num_segments=1)
+    health = client.cluster.health(index=index, wait_for_status='green', timeout=wait_timeout)
+    if health['status'] != 'green':
+        logger.warning('index %s is %s after waiting %s for its replicas', index, health['status'], wait_timeout)
+
+
+def swap_alias(index: str, alias: str = None) -> [str]:
+    """Point alias at index, atomically, so searches move from the old index to the new one at once.
+
+    If alias is the name of an index, as created before versioned indices,
+    that index is deleted in the same request.
+
+    :return the indices the alias was moved off
+    """
+    client = get_client()
+    alias = alias or ChildPageDocument._index._name
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    if client.indices.exists_alias(name=alias):
+        previous = [name for name in client.indices.get_alias(name=alias) if name != index]
+        actions = [{'remove': {'index': name, 'alias': alias}} for name in previous] + actions
+    elif client.indices.exists(index=alias):
+        previous = []
+        actions = [{'remove_index': {'index': alias}}] + actions
+    else:
+        previous = []
+    client.indices.update_aliases(actions=actions)
+    logger.info('alias %s now points at %s, was: %s', alias, index, previous)
+    return previous
+
+
+def sync_documents_since(index: str, since) -> int:
+    """Reindex the pages of documents converted since a time into index.
+
+    Pages written while index was being filled went to the index the alias
+    pointed at then, this brings index up to date with them.
+
+    :param since - datetime the fill started
+    :return number of pages indexed
+    """
+    from .models import ChildPage, ParentDocument
+
+    parent_ids = list(ParentDocument.objects.filter(converted_at__gte=since).values_list('id', flat=True))
+    if not parent_ids:
+        return 0
+    get_client().delete_by_query(index=index, query={'terms': {'parent_doc_id': parent_ids}}, refresh=True)
+    pages = ChildPage.objects.filter(parent_id__in=parent_ids).order_by('pk')
+    return index_child_pages(prefetch_html(pages, settings.INGEST_BULK_BATCH_SIZE), index=index)
@@ -0,0 +1,91 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from book_search.elasticsearch import get_client, parse_query
+from book_search.search_backends import BACKENDS
+
+MB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = """Compare the search backends on the same corpus, for query latency and footprint.
+
+    Each query is run through each backend's search, without the result
+    cache.  Footprint is the size of what each keeps for searching: the ES
+    index (primaries) and node heap in use, and the search_vector column and
+    its GIN index with PostgreSQL's shared_buffers.  The pages must be in ES
+    and stored in the db (PAGE_STORAGE = 'db')."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-q', '--queries-file',
+                            help='File with one query per line.  Quoted queries are run as phrase queries.')
+        parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS),
+                            help='Backends to compare.  Default all.')
+        parser.add_argument('-n', '--repeat', type=int, default=5, help='Times each query is run.')
+        parser.add_argument('--json', action='store_true', help='Output results as json.')
+
+    def handle(self, *args, **options):
+        if options['queries_file']:
+            with open(options['queries_file']) as infile:
+                queries = [line.strip() for line in infile if line.strip()]
+        else:
+            queries = ['wisdom']
+        if not queries:
+            raise CommandError('No queries to run')
+
+        results = {}
+        for name in options['backends']:
+            results[name] = self.run(BACKENDS[name](), [parse_query(query) for query in queries], options['repeat'])
+            results[name].update(getattr(self, f'{name}_footprint')())
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'backend':<14}{'hits':>10}{'p50 ms':>10}{'p95 ms':>10}{'index MB':>10}  memory")
+        for name, result in results.items():
+            self.stdout.write(f"{name:<14}{result['total_hits']:>10}{result['p50_ms']:>10.1f}"
+                              f"{result['p95_ms']:>10.1f}{result['index_mb']:>10.1f}  {result['memory']}")
+
+    def run(self, backend, queries: [(str, str)], repeat: int) -> dict:
+        # the first run of each query warms the caches
+        total_hits = sum(backend.search(query_type, query)[0] for query_type, query in queries)
+        latencies = []
+        for _ in range(repeat):
+            for query_type, query in queries:
+                start = time.perf_counter()
+                backend.search(query_type, query)
+                latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        return {
+            # summed over the queries, to check the backends find similar pages
+            'total_hits': total_hits,
+            'p50_ms': statistics.median(latencies),
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0],
+        }
+
+    @staticmethod
+    def elasticsearch_footprint() -> dict:
+        client = get_client()
+        stats = client.indices.stats(index='booksearch', metric='store')
+        heap = sum(node['jvm']['mem']['heap_used_in_bytes']
+                   for node in client.nodes.stats(metric='jvm')['nodes'].values())
+        return {
+            'index_mb': round(stats['_all']['primaries']['store']['size_in_bytes'] / MB, 2),
+            'memory': f'{heap / MB:.0f}MB heap used',
+        }
+
+    @staticmethod
+    def postgres_footprint() -> dict:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_relation_size('book_search_childpage_search_vector_gin'), "
+                           "coalesce(sum(pg_column_size(search_vector)), 0) FROM book_search_childpage")
+            index_size, column_size = cursor.fetchone()
+            cursor.execute('SHOW shared_buffers')
+            shared_buffers = cursor.fetchone()[0]
+        return {
+            'index_mb': round((index_size + column_size) / MB, 2),
+            'memory': f'{shared_buffers} shared_buffers',
+        }
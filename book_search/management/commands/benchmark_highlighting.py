@@ -0,0 +1,94 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from book_search.documents import CONTENT_HIGHLIGHT_OPTIONS, ChildPageDocument
+from book_search.elasticsearch import collapsed_search_body, get_client, highlight_clause, parse_query
+from book_search.indexing import create_index, fill_index
+
+
+class Command(BaseCommand):
+    help = """Compare the highlighters on the ChildPages in the database, for query latency and index size.
+
+    For each highlighter the pages are indexed into a temporary index with the
+    content mapping it needs (offsets for unified, term vectors for fvh), the
+    queries are run against it with inner hit highlighting, and the index is
+    deleted.  Set the one to use with settings.SEARCH_HIGHLIGHTER."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-q', '--queries-file',
+                            help='File with one query per line.  Quoted queries are run as phrase queries.')
+        parser.add_argument('--highlighters', nargs='+', default=list(CONTENT_HIGHLIGHT_OPTIONS),
+                            choices=list(CONTENT_HIGHLIGHT_OPTIONS), help='Highlighters to compare.  Default all.')
+        parser.add_argument('-n', '--repeat', type=int, default=5, help='Times each query is run.')
+        parser.add_argument('--batch-size', type=int,
+                            help='Pages per db read and bulk request.  Default is settings.INGEST_BULK_BATCH_SIZE.')
+        parser.add_argument('--json', action='store_true', help='Output results as json.')
+
+    def handle(self, *args, **options):
+        if options['queries_file']:
+            with open(options['queries_file']) as infile:
+                queries = [line.strip() for line in infile if line.strip()]
+        else:
+            queries = ['wisdom']
+        if not queries:
+            raise CommandError('No queries to run')
+
+        results = {highlighter: self.run(highlighter, queries, options) for highlighter in options['highlighters']}
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'highlighter':<12}{'index MB':>10}{'took p50':>10}{'took p95':>10}"
+                          f"{'p50 ms':>10}{'p95 ms':>10}")
+        for highlighter, result in results.items():
+            self.stdout.write(f"{highlighter:<12}{result['index_mb']:>10.1f}{result['took_p50_ms']:>10.1f}"
+                              f"{result['took_p95_ms']:>10.1f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}")
+
+    def run(self, highlighter: str, queries: [str], options: dict) -> dict:
+        client = get_client()
+        index = f'{ChildPageDocument._index._name}_highlight_{highlighter}'
+        client.indices.delete(index=index, ignore_unavailable=True)
+        create_index(index, highlighter)
+        try:
+            pages = fill_index(index, options['batch_size'])
+            client.indices.put_settings(index=index, settings={'index': {'refresh_interval': None}})
+            client.indices.refresh(index=index)
+            # one segment each, so the sizes compare the mappings rather than merge timing
+            client.indices.forcemerge(index=index, max_num_segments=1)
+            stats = client.indices.stats(index=index, metric='store')
+            size = stats['indices'][index]['primaries']['store']['size_in_bytes']
+
+            bodies = [self.search_body(query, highlighter) for query in queries]
+            for body in bodies:
+                client.search(index=index, body=body, request_cache=False)
+            took, latencies = [], []
+            for _ in range(options['repeat']):
+                for body in bodies:
+                    start = time.perf_counter()
+                    response = client.search(index=index, body=body, request_cache=False)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    took.append(response['took'])
+        finally:
+            client.indices.delete(index=index, ignore_unavailable=True)
+        self.stderr.write(f'{highlighter}: {pages} pages, {len(latencies)} searches')
+        return {
+            'pages': pages,
+            'index_mb': round(size / 1024 / 1024, 2),
+            'took_p50_ms': statistics.median(took),
+            'took_p95_ms': percentile(took, 0.95),
+            'p50_ms': statistics.median(latencies),
+            'p95_ms': percentile(latencies, 0.95),
+        }
+
+    @staticmethod
+    def search_body(query: str, highlighter: str) -> dict:
+        body = collapsed_search_body(*parse_query(query))
+        body['collapse']['inner_hits']['highlight'] = highlight_clause(highlighter)
+        return body
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[int(len(values) * fraction) - 1] if len(values) > 1 else values[0]
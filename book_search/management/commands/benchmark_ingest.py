@@ -0,0 +1,164 @@
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import json
+import platform
+import resource
+import sys
+import time
+
+import tika.tika
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from book_search import metrics
+from book_search.models import ChildPage, ParentDocument
+from book_search.stub_tika import StubTikaServer, generate_corpus
+
+
+def reset_peak_rss():
+    """Reset this process's peak rss, where the platform allows it (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> (float, float):
+    """Return the peak rss of this process and of its largest child, in MB."""
+    # /proc/self/status has the peak since reset_peak_rss, ru_maxrss the lifetime peak
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    self_peak = int(line.split()[1]) / 1024
+                    break
+            else:
+                raise OSError
+    except OSError:
+        self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on Linux, bytes on macOS
+        self_peak = self_peak / (1024 * 1024) if sys.platform == 'darwin' else self_peak / 1024
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    children_peak = children_peak / (1024 * 1024) if sys.platform == 'darwin' else children_peak / 1024
+    return round(self_peak, 1), round(children_peak, 1)
+
+
+class Stage:
+    """Times a benchmark stage and records its throughput and peak memory."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.documents = self.pages = 0
+
+    def __enter__(self):
+        reset_peak_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+
+    def result(self) -> dict:
+        peak_rss, peak_children_rss = peak_rss_mb()
+        return {
+            'stage': self.name,
+            'seconds': round(self.seconds, 3),
+            'documents': self.documents,
+            'pages': self.pages,
+            'documents_per_s': round(self.documents / self.seconds, 2) if self.seconds else None,
+            'pages_per_s': round(self.pages / self.seconds, 2) if self.seconds else None,
+            'peak_rss_mb': peak_rss,
+            'peak_children_rss_mb': peak_children_rss,
+        }
+
+
+class Command(BaseCommand):
+    help = """Benchmark convert_to_html_and_index end to end on a synthetic corpus.
+
+    Documents are served by a local stub Tika server and written to a
+    throwaway test database.  Pages are not indexed unless --index is passed,
+    which needs a running Elasticsearch.  Reports documents/s, pages/s and peak
+    rss for each stage: generating the corpus, ingesting it and re-scanning it
+    unchanged."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--documents', type=int, default=20, help='Number of documents.')
+        parser.add_argument('-p', '--pages', type=int, default=100, help='Pages per document.')
+        parser.add_argument('--words', type=int, default=300, help='Words per page.')
+        parser.add_argument('-w', '--workers', type=int, default=1,
+                            help='Passed to convert_to_html_and_index.')
+        parser.add_argument('--bulk', action='store_true', help='Passed to convert_to_html_and_index.')
+        parser.add_argument('--stream', action='store_true', help='Passed to convert_to_html_and_index.')
+        parser.add_argument('--index', action='store_true',
+                            help='Index the pages in Elasticsearch as well.')
+        parser.add_argument('--json', action='store_true', help='Output results as json.')
+        parser.add_argument('-o', '--output', help='Also write the json results to this file.')
+
+    def handle(self, *args, **options):
+        results = {
+            'config': {key: options[key] for key in ('documents', 'pages', 'words', 'workers',
+                                                     'bulk', 'stream', 'index')},
+            'python': platform.python_version(),
+            'stages': [],
+        }
+        test_db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # use the stub rather than starting a Tika server
+        tika_client_only = tika.tika.TikaClientOnly
+        tika.tika.TikaClientOnly = True
+        try:
+            with TemporaryDirectory() as corpus_dir, StubTikaServer() as stub:
+                with override_settings(TIKA_SERVER_ENDPOINT=stub.endpoint, TIKA_SERVER_ENDPOINTS=[],
+                                       TIKA_CONFIG_FILE=None, ELASTICSEARCH_DSL_AUTOSYNC=options['index'],
+                                       INGEST_METRICS_FILE=None):
+                    results['stages'] = self.run_stages(corpus_dir, options)
+        finally:
+            tika.tika.TikaClientOnly = tika_client_only
+            connection.creation.destroy_test_db(test_db_name, verbosity=0)
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'stage':<10}{'seconds':>10}{'docs/s':>10}{'pages/s':>12}"
+                          f"{'rss MB':>10}{'child MB':>10}")
+        for stage in results['stages']:
+            self.stdout.write(f"{stage['stage']:<10}{stage['seconds']:>10.2f}{stage['documents_per_s'] or 0:>10.1f}"
+                              f"{stage['pages_per_s'] or 0:>12.1f}{stage['peak_rss_mb']:>10.1f}"
+                              f"{stage['peak_children_rss_mb']:>10.1f}")
+        for stage in results['stages']:
+            if stage.get('metrics'):
+                self.stdout.write(f"\n{stage['stage']} stages:")
+                self.stdout.write(f"{'stage':<32}{'count':>10}{'total':>12}{'mean':>12}")
+                for row in stage['metrics']:
+                    self.stdout.write(f"{row['metric']:<32}{row['count']:>10}{row['total']:>12.3f}"
+                                      f"{row['mean']:>12.4f}")
+
+    def run_stages(self, corpus_dir: str, options: dict) -> [dict]:
+        ingest_options = {'input_dir': corpus_dir, 'workers': options['workers'],
+                          'bulk': options['bulk'], 'stream': options['stream'], 'stdout': StringIO()}
+        stages = []
+
+        with Stage('generate') as stage:
+            generate_corpus(corpus_dir, options['documents'], options['pages'], options['words'])
+            stage.documents = options['documents']
+        stages.append(stage.result())
+
+        with Stage('ingest') as stage:
+            call_command('convert_to_html_and_index', **ingest_options)
+            stage.documents = ParentDocument.objects.count()
+            stage.pages = ChildPage.objects.count()
+        stages.append(stage.result())
+        stages[-1]['metrics'] = [
+            {'metric': name.replace('booksearch_ingest_', ''), 'count': count, 'total': total, 'mean': mean}
+            for name, count, total, mean in metrics.REGISTRY.summary(metrics.INGEST_METRICS) if total is not None]
+
+        with Stage('rescan') as stage:
+            call_command('convert_to_html_and_index', **ingest_options)
+            stage.documents = options['documents']
+        stages.append(stage.result())
+        return stages
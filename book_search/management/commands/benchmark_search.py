@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle
+import json
+import statistics
+import threading
+import time
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = """Compare concurrent request throughput of the sync and async search views.
+
+    Run against a server started under ASGI, eg:
+        uvicorn config.asgi:application --workers 1
+    Results are cached, so pass many distinct queries (or point the 'search'
+    cache at a dummy backend) to measure the ES round trip rather than cache hits."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-u', '--url', default='http://127.0.0.1:8000',
+                            help='Base url of the running server.')
+        parser.add_argument('-q', '--queries-file',
+                            help='File with one query per line.  Queries are used in turn.')
+        parser.add_argument('-c', '--concurrency', type=int, default=50,
+                            help='Number of concurrent clients.')
+        parser.add_argument('-n', '--requests', type=int, default=500,
+                            help='Number of requests sent to each view.')
+        parser.add_argument('--json', action='store_true', help='Output results as json.')
+
+    def handle(self, *args, **options):
+        if options['queries_file']:
+            with open(options['queries_file']) as infile:
+                queries = [line.strip() for line in infile if line.strip()]
+        else:
+            queries = ['wisdom']
+        if not queries:
+            raise CommandError('No queries to run')
+
+        results = {
+            'sync': self.run(SyncSearchClient(options['url']), queries,
+                             options['concurrency'], options['requests']),
+            'async': self.run(AsyncSearchClient(options['url']), queries,
+                              options['concurrency'], options['requests']),
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'view':<8}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for view, result in results.items():
+            self.stdout.write(f"{view:<8}{result['requests']:>10}{result['errors']:>8}"
+                              f"{result['requests_per_second']:>10.1f}{result['p50_ms']:>10.1f}"
+                              f"{result['p95_ms']:>10.1f}")
+
+    def run(self, search_client, queries: [str], concurrency: int, num_requests: int) -> dict:
+        query_iter = cycle(queries)
+        lock = threading.Lock()
+
+        def next_query():
+            with lock:
+                return next(query_iter)
+
+        def timed_request(_):
+            query = next_query()
+            start = time.perf_counter()
+            ok = search_client.search(query)
+            return ok, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            timings = list(executor.map(timed_request, range(num_requests)))
+        elapsed = time.perf_counter() - start
+        latencies = sorted(latency * 1000 for ok, latency in timings)
+        return {
+            'requests': num_requests,
+            'errors': sum(1 for ok, latency in timings if not ok),
+            'elapsed_s': elapsed,
+            'requests_per_second': num_requests / elapsed,
+            'p50_ms': statistics.median(latencies),
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0],
+        }
+
+
+class SyncSearchClient:
+    """Posts to the search form, with a csrf token per client thread."""
+
+    def __init__(self, base_url: str):
+        self.url = f'{base_url}/search/'
+        self.local = threading.local()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            session.get(self.url)
+            self.local.session = session
+        return self.local.session
+
+    def search(self, query: str) -> bool:
+        session = self.session()
+        response = session.post(self.url, data={'query': query},
+                                headers={'X-CSRFToken': session.cookies.get('csrftoken', ''),
+                                         'Referer': self.url})
+        return response.ok
+
+
+class AsyncSearchClient:
+
+    def __init__(self, base_url: str):
+        self.url = f'{base_url}/search/async/'
+        self.local = threading.local()
+
+    def search(self, query: str) -> bool:
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session.get(self.url, params={'query': query}).ok
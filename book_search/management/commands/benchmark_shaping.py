@@ -0,0 +1,121 @@
+import json
+import pickle
+import random
+import re
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from book_search.elasticsearch import EDGE_STRIP_REGEX, shape_collapsed_hits
+from book_search.stub_tika import WORDS
+
+
+def canned_response(books: int, pages: int, highlights: int, seed: int = 0) -> dict:
+    """A collapsed search response in the shape ES returns, with generated highlights."""
+    rng = random.Random(seed)
+
+    def fragment():
+        words = rng.choices(WORDS, k=16)
+        words[rng.randrange(len(words))] = f'<em>{rng.choice(WORDS)}</em>'
+        # some fragments start or end mid tag or on punctuation, as ES's do
+        return rng.choice(('', '', '', '>', ', ', '. ')) + ' '.join(words) + rng.choice(('', '', '<'))
+
+    def page_hit(book, page_number):
+        return {
+            '_index': 'booksearch', '_id': str(book * 1000 + page_number), '_score': rng.random() * 10,
+            '_source': {'parent_doc_id': book, 'title': f'Title {book}', 'author': f'Author {book}',
+                        'page_number': page_number, 'parent_filename': f'book_{book}.pdf'},
+            'highlight': {'content': [fragment() for _ in range(highlights)]},
+        }
+
+    hits = []
+    for book in range(1, books + 1):
+        hit = page_hit(book, 1)
+        inner = [page_hit(book, page_number) for page_number in range(1, pages + 1)]
+        hit['inner_hits'] = {'matched_pages': {'hits': {'total': {'value': pages, 'relation': 'eq'},
+                                                        'hits': inner}}}
+        hits.append(hit)
+    return {'took': 5, 'timed_out': False, 'hits': {'total': {'value': books * pages, 'relation': 'eq'},
+                                                    'hits': hits}}
+
+
+def legacy_shape_collapsed_hits(response) -> list:
+    """The dict based shaping that shape_collapsed_hits replaced, as the baseline.
+
+    It builds dicts, then walks them again to add the highlight counts and
+    again to move single inner hits up, with a regex substitution per highlight.
+    """
+    def shape_page_hit(inner_hit):
+        return {
+            'parent_doc_id': inner_hit['_source']['parent_doc_id'],
+            'title': inner_hit['_source']['title'],
+            'author': inner_hit['_source']['author'],
+            'page_number': inner_hit['_source']['page_number'],
+            'highlights': [re.sub(EDGE_STRIP_REGEX, '', highlight)
+                           for highlight in inner_hit['highlight']['content']]
+        }
+
+    results = []
+    for hit in response['hits']['hits']:
+        results.append({
+            'parent_doc_id': hit['_source']['parent_doc_id'],
+            'parent_filename': hit['_source']['parent_filename'],
+            'title': hit['_source']['title'],
+            'author': hit['_source']['author'],
+            'num_inner_hits': len(hit['inner_hits']['matched_pages']['hits']['hits']),
+            'inner_hits': [shape_page_hit(inner_hit)
+                           for inner_hit in hit['inner_hits']['matched_pages']['hits']['hits']],
+        })
+    for hit in results:
+        for inner_hit in hit['inner_hits']:
+            inner_hit['highlight_count'] = len(inner_hit['highlights'])
+    for hit in results:
+        if hit['num_inner_hits'] == 1:
+            hit['single_inner_hit'] = hit['inner_hits'][0]
+    return results
+
+
+class Command(BaseCommand):
+    help = """Microbenchmark of search result shaping on canned collapsed search responses.
+
+    Compares shape_collapsed_hits with the dict based shaping it replaced, for
+    cpu time per response, memory allocated and the pickled (cached) size."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--books', type=int, default=1000, help='Books (hits) per response.')
+        parser.add_argument('-p', '--pages', type=int, default=5, help='Inner hits per book.')
+        parser.add_argument('--highlights', type=int, default=5, help='Highlight fragments per page.')
+        parser.add_argument('-n', '--repeat', type=int, default=20, help='Times each shaper is run.')
+        parser.add_argument('--json', action='store_true', help='Output results as json.')
+
+    def handle(self, *args, **options):
+        response = canned_response(options['books'], options['pages'], options['highlights'])
+        shapers = {'legacy': legacy_shape_collapsed_hits, 'slots': shape_collapsed_hits}
+        results = {name: self.measure(shaper, response, options['repeat']) for name, shaper in shapers.items()}
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'shaper':<8}{'ms/response':>14}{'allocated KB':>14}{'pickled KB':>12}")
+        for name, result in results.items():
+            self.stdout.write(f"{name:<8}{result['ms_per_response']:>14.2f}{result['allocated_kb']:>14.1f}"
+                              f"{result['pickled_kb']:>12.1f}")
+
+    def measure(self, shaper, response: dict, repeat: int) -> dict:
+        shaper(response)
+        start = time.process_time()
+        for _ in range(repeat):
+            shaper(response)
+        cpu_seconds = (time.process_time() - start) / repeat
+
+        tracemalloc.start()
+        try:
+            results = shaper(response)
+            allocated, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {
+            'ms_per_response': round(cpu_seconds * 1000, 3),
+            'allocated_kb': round(allocated / 1024, 1),
+            'pickled_kb': round(len(pickle.dumps(results, pickle.HIGHEST_PROTOCOL)) / 1024, 1),
+        }
@@ -0,0 +1,57 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from book_search.indexing import fetch_html_from_index
+from book_search.models import ChildPage, PAGE_STORAGE_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Move the html of existing ChildPages to another storage type, see ChildPage.
+    Set settings.PAGE_STORAGE to the same type so new pages are stored the same way."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('storage', choices=PAGE_STORAGE_TYPES, help='Storage type to convert to.')
+        parser.add_argument('-b', '--batch-size', type=int, default=settings.INGEST_BULK_BATCH_SIZE,
+                            help='Pages converted per transaction.  Default is settings.INGEST_BULK_BATCH_SIZE.')
+
+    def handle(self, *args, **options):
+        storage, batch_size = options['storage'], options['batch_size']
+        converted, skipped, last_id = 0, 0, 0
+        while True:
+            pages = list(ChildPage.objects.filter(id__gt=last_id).order_by('id')[:batch_size])
+            if not pages:
+                break
+            last_id = pages[-1].id
+            # read pages stored only in ES in one request
+            in_index = fetch_html_from_index([page.id for page in pages
+                                              if not page.html_content and page.compressed_content is None])
+            to_update = []
+            for page in pages:
+                if page.id in in_index:
+                    page._html = in_index[page.id]
+                elif not page.html_content and page.compressed_content is None:
+                    logger.error('Page %s is not stored in the db or ES, skipping', page.id)
+                    skipped += 1
+                    continue
+                page.set_html(page.html, storage)
+                to_update.append(page)
+            if storage == 'elasticsearch':
+                # don't drop anything from the db that can't be read back from ES
+                in_index.update(fetch_html_from_index([page.id for page in to_update if page.id not in in_index]))
+                missing = [page for page in to_update if page.id not in in_index]
+                for page in missing:
+                    logger.error('Page %s is not in the index, leaving it in the db', page.id)
+                skipped += len(missing)
+                to_update = [page for page in to_update if page.id in in_index]
+            # bulk_update sends no save signals, so the pages aren't re-indexed
+            with transaction.atomic():
+                ChildPage.objects.bulk_update(to_update, ['html_content', 'compressed_content'])
+            converted += len(to_update)
+            self.stdout.write(f'Converted {converted} pages')
+        self.stdout.write(f'Converted {converted} pages to {storage} storage, skipped {skipped}.')
@@ -1,20 +1,165 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 from pathlib import Path
+import multiprocessing
 import os
 import logging
+import time
 
 import yaml
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connections
 from django.db.utils import IntegrityError
 
-from book_search.models import ParentDocument, TikaParseError
+from book_search import metrics, tika_servers
+from book_search.indexing import refresh_disabled
+from book_search.models import OCR_PENDING, ChildPage, ParentDocument, TikaParseError, hash_file
 
 
 logger = logging.getLogger(__name__)
 
+DOCUMENT_SUFFIXES = ('*.pdf', '*.epub')
+
+CONVERTED, UNCHANGED, FAILED = 'converted', 'unchanged', 'failed'
+
+# set in each worker process by _init_worker
+_tika_lock = None
+_convert_options = {}
+
+
+def find_documents(input_dir: str) -> [Path]:
+    """Recursively find the .pdf and .epub files under input_dir."""
+    logger.info('reading from input dir: %s', input_dir)
+    documents = []
+    for root, dirs, files in os.walk(input_dir):
+        for suffix in DOCUMENT_SUFFIXES:
+            documents.extend(Path(root).glob(suffix))
+    return documents
+
+
+def find_changed_documents(doc_files: [Path]) -> ([Path], int):
+    """Filter out documents whose size and mtime match their ParentDocument.
+
+    This only stats the files, so a re-scan of an unchanged library is fast.
+
+    :return (documents that are new or may have changed, number unchanged)
+    """
+    known = {filepath: (size, mtime) for filepath, size, mtime in
+             ParentDocument.objects.values_list('filepath', 'file_size', 'file_mtime')}
+    changed, unchanged = [], 0
+    for doc_file in doc_files:
+        doc_path = doc_file.resolve()
+        try:
+            stat = doc_path.stat()
+        except OSError:
+            # missing or unreadable, convert_to_child_pages reports it
+            changed.append(doc_file)
+            continue
+        if known.get(str(doc_path)) == (stat.st_size, stat.st_mtime):
+            unchanged += 1
+        else:
+            changed.append(doc_file)
+    return changed, unchanged
+
+
+def convert_to_child_pages(doc_file: Path, tika_lock=None, bulk=False, stream=False) -> (str, int, str):
+    """Create or update parent, convert file to create children, save to db.
+
+    This kicks off indexing into ES.
+
+    If the document was converted before and its content hash is unchanged
+    only the recorded size and mtime are updated.  Otherwise its pages are
+    replaced.  Documents converted before content hashes were recorded are
+    assumed unchanged if they have pages.
+
+    :param doc_file - input document
+    :param tika_lock - optional semaphore bounding concurrent Tika requests
+    :param bulk - save and index pages in bulk, see ParentDocument.bulk_save_child_pages
+    :param stream - parse and save pages in batches as Tika streams them, see
+        ParentDocument.convert_to_html_child_pages_streaming
+    :return (status, number of pages created, error message or '' on success)
+    """
+    doc_path = doc_file.resolve()
+    if not doc_path.is_file():
+        logger.error('Cannot convert document, file does not exist: %s', doc_path)
+        return FAILED, 0, 'file does not exist'
+    content_hash = hash_file(doc_path)
+    parent_doc = ParentDocument.objects.filter(filepath=doc_path).first()
+    is_new = parent_doc is None
+    if not is_new:
+        if parent_doc.content_hash == content_hash or (
+                not parent_doc.content_hash and ChildPage.objects.filter(parent=parent_doc).exists()):
+            parent_doc.set_file_stats(content_hash)
+            parent_doc.save(update_fields=['file_size', 'file_mtime', 'content_hash'])
+            logger.info("Unchanged file: %s", doc_path)
+            return UNCHANGED, 0, ''
+    try:
+        if is_new:
+            parent_doc = ParentDocument.objects.create(filepath=doc_path)
+        start = time.perf_counter()
+        if stream:
+            num_pages = parent_doc.convert_to_html_child_pages_streaming(tika_lock=tika_lock)
+        else:
+            num_pages = parent_doc.convert_to_html_child_pages(tika_lock=tika_lock, bulk=bulk)
+        # only recorded after a successful conversion, so a failed one is retried
+        parent_doc.set_file_stats(content_hash)
+        parent_doc.save(update_fields=['file_size', 'file_mtime', 'content_hash'])
+        metrics.INGEST_DOCUMENT_SECONDS.observe(time.perf_counter() - start)
+        logger.info("Converted file: %s", doc_path)
+        return CONVERTED, num_pages, ''
+
+    except IntegrityError as error:
+        logger.error("%s, not inserting: %s", error, doc_path)
+        return FAILED, 0, str(error)
+
+    except TikaParseError as error:
+        logger.error('%s: failed to parse document: %s', error, doc_path)
+        if is_new:
+            parent_doc.delete()
+        return FAILED, 0, str(error)
+
+
+def write_metrics_file(path):
+    """Write this run's ingest metrics in Prometheus text format, for the metrics view.
+
+    The file is replaced atomically so it is never read half written.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}')
+    tmp_path.write_text(metrics.REGISTRY.render(metrics.INGEST_METRICS))
+    os.replace(tmp_path, path)
+
+
+def _init_worker(tika_lock, tika_pool_state, convert_options):
+    """Process pool initializer.
+
+    Connections inherited from the parent are discarded so each worker opens
+    its own db connection on first use.  Workers share the Tika server pool's
+    dispatch state.
+    """
+    global _tika_lock, _convert_options
+    _tika_lock, _convert_options = tika_lock, convert_options
+    tika_servers.use_shared_state(tika_pool_state)
+    for conn in connections.all():
+        conn.connection = None
+
+
+def _convert_in_worker(doc_file: Path) -> (Path, str, int, str, dict):
+    """Convert a document, returning its result and the metrics recorded while converting it."""
+    metrics.REGISTRY.reset(metrics.INGEST_METRICS)
+    try:
+        status, num_pages, error = convert_to_child_pages(doc_file, _tika_lock, **_convert_options)
+    except Exception as error:
+        logger.exception('Unexpected error converting: %s', doc_file)
+        status, num_pages, error = FAILED, 0, repr(error)
+    return doc_file, status, num_pages, error, metrics.REGISTRY.snapshot()
+
 
 class Command(BaseCommand):
-    help = """Convert each document file into a parent object containing the metadata and 
-    and children such that each child object contains the html for each page."""
+    help = """Convert each document file into a parent object containing the metadata and
+    and children such that each child object contains the html for each page.
+    Files that were converted before are skipped if unchanged and replaced if changed."""
 
     def add_arguments(self, parser):
         parser.add_argument('-d', '--input-dir',
@@ -23,39 +168,98 @@ class Command(BaseCommand):
         parser.add_argument('-f', '--file', help='Specify a single file to be processed.  Only one optional ' +
                             'parameter can be used.  If an input_dir and a file parameter are passed, only ' +
                             'the directory will be processed.')
+        parser.add_argument('-w', '--workers', type=int, default=1,
+                            help='Number of worker processes converting documents in parallel.  Default is 1, ' +
+                            'which converts documents one at a time in this process.')
+        parser.add_argument('--tika-concurrency', type=int, default=settings.TIKA_MAX_CONCURRENCY,
+                            help='Max concurrent requests to the Tika servers across all workers.  ' +
+                            'Default is settings.TIKA_MAX_CONCURRENCY.')
+        parser.add_argument('--bulk', action='store_true',
+                            help='Save each document\'s pages with batched inserts in one transaction and ' +
+                            'index them with ES bulk requests, with index refresh turned off during the run.  ' +
+                            'Batch size and concurrent bulk requests are set by settings.INGEST_BULK_BATCH_SIZE ' +
+                            'and settings.INGEST_BULK_IN_FLIGHT.')
+        parser.add_argument('--stream', action='store_true',
+                            help='Parse Tika\'s output incrementally as it streams from the server at ' +
+                            'settings.TIKA_SERVER_ENDPOINT, saving and indexing pages in bulk batches as they ' +
+                            'are parsed, so memory use doesn\'t grow with the length of a document.')
 
     def handle(self, *args, **options):
+        metrics.REGISTRY.reset(metrics.INGEST_METRICS)
         if options['input_dir']:
-            for root, dirs, files in os.walk(options['input_dir']):
-                logger.info('reading from input dir: %s', options['input_dir'])
-                for infile in list(Path(root).glob('*.pdf')) + list(Path(root).glob('*.epub')):
-                    self.convert_to_child_pages(infile)
+            doc_files = find_documents(options['input_dir'])
         elif options['file']:
-            self.convert_to_child_pages(Path(options['file']))
+            doc_files = [Path(options['file'])]
+        else:
+            doc_files = []
+        doc_files, unchanged = find_changed_documents(doc_files)
+        metrics.INGEST_DOCUMENTS.inc(unchanged, status=UNCHANGED)
+        if doc_files:
+            for endpoint in tika_servers.get_pool().check_health():
+                logger.error('Tika server is not responding: %s', endpoint)
 
-    def convert_to_child_pages(self, doc_file: Path):
-        """Create parent, convert file to create children, save to db.
+        convert_options = {'bulk': options['bulk'], 'stream': options['stream']}
+        if options['workers'] > 1 and len(doc_files) > 1:
+            results = self.convert_parallel(doc_files, options['workers'], options['tika_concurrency'],
+                                            convert_options)
+        else:
+            results = ((doc_file, *convert_to_child_pages(doc_file, **convert_options)) for doc_file in doc_files)
 
-        This kicks off indexing into ES.
-        .
-        :param doc_file - input document
-        """
-        doc_path = doc_file.resolve()
-        if not doc_path.is_file():
-            logger.error('Cannot convert document, file does not exist: %s', doc_path)
-            return
-        parent_doc = ParentDocument(filepath=doc_path)
-        parent_doc.save()
-        try:
-            parent_doc.convert_to_html_child_pages(doc_path)
-            logger.info("Converted file: %s", doc_path)
+        converted, pages, failures = 0, 0, []
+        bulk_indexing = options['bulk'] or options['stream']
+        with refresh_disabled() if bulk_indexing and doc_files else nullcontext():
+            for doc_file, status, num_pages, error in results:
+                metrics.INGEST_DOCUMENTS.inc(status=status)
+                metrics.INGEST_PAGES.inc(num_pages)
+                if status == FAILED:
+                    failures.append((doc_file, error))
+                elif status == UNCHANGED:
+                    unchanged += 1
+                else:
+                    converted += 1
+                    pages += num_pages
+        self.write_summary(converted, unchanged, pages, failures)
+        queued = ChildPage.objects.filter(ocr_status=OCR_PENDING).count()
+        if queued:
+            self.stdout.write(f'Pages without text queued for OCR: {queued}, run the ocr_pages command')
+        self.write_metrics()
+        if settings.INGEST_METRICS_FILE:
+            write_metrics_file(settings.INGEST_METRICS_FILE)
 
-        except IntegrityError as error:
-            logger.error("%s, not inserting: %s", error, doc_path)
-
-        except TikaParseError as error:
-            logger.error('%s: failed to parse document: %s', error, doc_path)
-            parent_doc.delete()
+    def convert_parallel(self, doc_files: [Path], workers: int, tika_concurrency: int, convert_options: dict):
+        """Convert documents in a pool of worker processes.
 
+        Yields (doc_file, status, number of pages, error) as each document finishes.
+        """
+        # fork so workers inherit the configured django app registry
+        context = multiprocessing.get_context('fork')
+        tika_lock = context.BoundedSemaphore(max(1, tika_concurrency))
+        tika_pool_state = tika_servers.TikaServerPool.create_shared_state(
+            len(tika_servers.configured_endpoints()), context)
+        # don't let workers inherit open db connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(tika_lock, tika_pool_state, convert_options)) as executor:
+            futures = [executor.submit(_convert_in_worker, doc_file) for doc_file in doc_files]
+            for future in as_completed(futures):
+                doc_file, status, num_pages, error, worker_metrics = future.result()
+                metrics.REGISTRY.merge(worker_metrics)
+                yield doc_file, status, num_pages, error
 
+    def write_summary(self, converted: int, unchanged: int, pages: int, failures: list):
+        self.stdout.write(f'Documents converted: {converted}')
+        self.stdout.write(f'Documents unchanged: {unchanged}')
+        self.stdout.write(f'Pages created: {pages}')
+        self.stdout.write(f'Failures: {len(failures)}')
+        for doc_file, error in failures:
+            self.stdout.write(f'  {doc_file}: {error}')
 
+    def write_metrics(self):
+        """Write a table of the time spent in each ingest stage."""
+        rows = [row for row in metrics.REGISTRY.summary(metrics.INGEST_METRICS) if row[2] is not None]
+        if not rows:
+            return
+        self.stdout.write(f"{'stage':<32}{'count':>10}{'total':>12}{'mean':>12}")
+        for name, count, total, mean in rows:
+            name = name.replace('booksearch_ingest_', '')
+            self.stdout.write(f'{name:<32}{count:>10}{total:>12.3f}{mean:>12.4f}')
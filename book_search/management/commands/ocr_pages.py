@@ -0,0 +1,47 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from book_search import ocr
+
+
+class Command(BaseCommand):
+    help = """OCR the pages that had no text when converted, eg of scanned books.
+
+    Ingest parses with OCR turned off, and queues the pages that come out
+    without text.  Their documents are parsed again by the Tika servers with
+    OCR enabled in settings.OCR_TIKA_ENDPOINTS, and only the queued pages are
+    updated in the db and ES.  Run it after ingest, or periodically."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', type=int, default=settings.OCR_WORKERS,
+                            help='Documents OCR\'d at once.  Default is settings.OCR_WORKERS.')
+        parser.add_argument('--limit', type=int, help='Max documents to OCR.  Default all with queued pages.')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Queue the pages whose OCR failed on a previous run again.')
+        parser.add_argument('--queue-existing', action='store_true',
+                            help='First queue the pages without text converted before pages were queued ' +
+                            'for OCR.  Reads every page, so it is only needed once.')
+
+    def handle(self, *args, **options):
+        if options['queue_existing']:
+            self.stdout.write(f'Queued {ocr.queue_textless_pages()} existing pages without text')
+        if options['retry_failed']:
+            self.stdout.write(f'Queued {ocr.requeue_failed()} pages that failed before')
+        for endpoint in ocr.get_ocr_pool().check_health():
+            self.stderr.write(f'OCR Tika server is not responding: {endpoint}')
+
+        start = time.perf_counter()
+        documents, queued, with_text, failures = 0, 0, 0, []
+        for parent, num_queued, num_with_text, error in ocr.ocr_pending_pages(options['workers'], options['limit']):
+            documents += 1
+            queued += num_queued
+            with_text += num_with_text
+            if error:
+                failures.append((parent.filepath, error))
+        self.stdout.write(f'Documents OCR\'d: {documents} in {time.perf_counter() - start:.1f}s')
+        self.stdout.write(f'Pages with text found: {with_text} of {queued}')
+        self.stdout.write(f'Failures: {len(failures)}')
+        for filepath, error in failures:
+            self.stdout.write(f'  {filepath}: {error}')
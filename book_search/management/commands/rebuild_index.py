@@ -0,0 +1,60 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from book_search.documents import ChildPageDocument
+from book_search.elasticsearch import get_client
+from book_search.indexing import (autosync_enabled, create_versioned_index, fill_index, finish_versioned_index,
+                                  swap_alias, sync_documents_since, versioned_indices)
+
+
+class Command(BaseCommand):
+    help = """Rebuild the search index from the ChildPage rows without downtime.
+
+    The pages are bulk loaded into a new booksearch_vN index, with no replicas
+    and refresh off, which then gets the production settings back, is force
+    merged and swapped in by pointing the booksearch alias at it in one
+    request.  Searches use the old index until the swap.
+
+    Pages of documents converted while the new index is filled are reindexed
+    before the swap, but it is best run while no ingest is running.  The first
+    run replaces a plain booksearch index (as created by search_index
+    --create) with the alias."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            help='Pages per db read and bulk request.  Default is settings.INGEST_BULK_BATCH_SIZE.')
+        parser.add_argument('--keep', type=int, default=1,
+                            help='Number of previous versioned indices to keep, for rolling back by pointing ' +
+                            'the alias at one again.  Default is 1.')
+        parser.add_argument('--wait-timeout', default='5m',
+                            help='How long to wait for the new index\'s replicas before swapping.  Default 5m.')
+
+    def handle(self, *args, **options):
+        if not autosync_enabled():
+            raise CommandError('Indexing is turned off by ELASTICSEARCH_DSL_AUTOSYNC')
+        alias = ChildPageDocument._index._name
+        started = timezone.now()
+        index = create_versioned_index(alias)
+        try:
+            start = time.perf_counter()
+            pages = fill_index(index, options['batch_size'])
+            self.stdout.write(f'Indexed {pages} pages into {index} in {time.perf_counter() - start:.1f}s')
+
+            finish_versioned_index(index, options['wait_timeout'])
+            caught_up = sync_documents_since(index, started)
+            if caught_up:
+                self.stdout.write(f'Reindexed {caught_up} pages converted during the rebuild')
+            previous = swap_alias(index, alias)
+        except Exception:
+            # searches are still on the old index, drop the partial new one
+            get_client().indices.delete(index=index, ignore_unavailable=True)
+            raise
+        self.stdout.write(f'Alias {alias} now points at {index}'
+                          + (f', was {", ".join(previous)}' if previous else ''))
+
+        old_indices = [name for name in versioned_indices(alias) if name != index]
+        for name in old_indices[:max(0, len(old_indices) - options['keep'])]:
+            get_client().indices.delete(index=name)
+            self.stdout.write(f'Deleted old index {name}')
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from book_search import search_backends
+
+
+class Command(BaseCommand):
+    help = """Set up PostgreSQL full text search of the pages for the postgres search backend.
+
+    Adds a trigger keeping ChildPage.search_vector up to date as pages are
+    saved, fills it in for the existing pages in batches, and adds its GIN
+    index.  Not needed with the elasticsearch backend, where it would only slow
+    down ingest.  Safe to run again, eg if it was interrupted."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.INGEST_BULK_BATCH_SIZE,
+                            help='Pages updated at once.  Default is settings.INGEST_BULK_BATCH_SIZE.')
+        parser.add_argument('--remove', action='store_true',
+                            help='Remove the trigger and index and clear the vectors, eg after switching ' +
+                            'back to the elasticsearch backend.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Full text search of the pages needs a PostgreSQL database')
+        if options['remove']:
+            cleared = search_backends.remove_search_vector(options['batch_size'])
+            self.stdout.write(f'Removed the search vector trigger and index, cleared {cleared} pages')
+            return
+        filled = search_backends.install_search_vector(options['batch_size'])
+        self.stdout.write(f'Added the search vector trigger and index, filled in {filled} pages')
@@ -0,0 +1,259 @@
+"""Minimal in-process counters and histograms, rendered in Prometheus text format.
+
+Metrics live in REGISTRY for the process.  Snapshots can be merged into
+another registry, which is how ingest worker processes report back to the
+command that started them.
+"""
+from contextlib import contextmanager
+import bisect
+import contextvars
+import math
+import threading
+import time
+
+# seconds, from 1ms to 5 minutes
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(label_key: tuple, extra: tuple = ()) -> str:
+    pairs = label_key + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help = name, help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) -> dict:
+        return {'values': [[list(key), value] for key, value in self.values.items()]}
+
+    def merge(self, snapshot: dict):
+        for key, value in snapshot['values']:
+            key = tuple(tuple(pair) for pair in key)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self) -> [str]:
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}' for key, value in self.values.items()]
+
+    def summary(self) -> [tuple]:
+        return [(self.name + _format_labels(key), value, None, None) for key, value in self.values.items()]
+
+
+class Histogram:
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets=TIME_BUCKETS):
+        self.name, self.help = name, help_text
+        self.buckets = tuple(buckets)
+        # label key -> [bucket counts, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            current = self.values[key]
+            if index < len(self.buckets):
+                current[0][index] += 1
+            current[1] += value
+            current[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        return {'values': [[list(key), value] for key, value in self.values.items()]}
+
+    def merge(self, snapshot: dict):
+        for key, (bucket_counts, total, count) in snapshot['values']:
+            key = tuple(tuple(pair) for pair in key)
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            current = self.values[key]
+            current[0] = [a + b for a, b in zip(current[0], bucket_counts)]
+            current[1] += total
+            current[2] += count
+
+    def render(self) -> [str]:
+        lines = []
+        for key, (bucket_counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(key, (("le", _format_value(bound)),))} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(key, (("le", "+Inf"),))} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+    def summary(self) -> [tuple]:
+        return [(self.name + _format_labels(key), count, total, total / count if count else None)
+                for key, (bucket_counts, total, count) in self.values.items()]
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets=TIME_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def reset(self, names=None):
+        with self.lock:
+            for name, metric in self.metrics.items():
+                if names is None or name in names:
+                    metric.values.clear()
+
+    def snapshot(self) -> dict:
+        """Metric values in a picklable/json serialisable form, see merge."""
+        with self.lock:
+            return {name: metric.snapshot() for name, metric in self.metrics.items() if metric.values}
+
+    def merge(self, snapshot: dict):
+        with self.lock:
+            for name, values in snapshot.items():
+                self.metrics[name].merge(values)
+
+    def render(self, names=None) -> str:
+        """Render metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                if (names is not None and name not in names) or not metric.values:
+                    continue
+                lines.append(f'# HELP {name} {metric.help}')
+                lines.append(f'# TYPE {name} {metric.type}')
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def summary(self, names=None) -> [tuple]:
+        """Rows of (metric, count, sum, mean) for a summary table.  Counters have no sum or mean."""
+        rows = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                if names is None or name in names:
+                    rows.extend(metric.summary())
+        return rows
+
+
+REGISTRY = MetricsRegistry()
+
+# ingest
+INGEST_DOCUMENTS = REGISTRY.counter('booksearch_ingest_documents_total',
+                                    'Documents processed by convert_to_html_and_index, by status.')
+INGEST_PAGES = REGISTRY.counter('booksearch_ingest_pages_total', 'Pages created.')
+INGEST_DOCUMENT_SECONDS = REGISTRY.histogram('booksearch_ingest_document_seconds',
+                                             'Time to convert, save and index a document.')
+INGEST_TIKA_SECONDS = REGISTRY.histogram('booksearch_ingest_tika_parse_seconds',
+                                         'Time for Tika to parse a document.  With --stream, the time '
+                                         'reading Tika\'s xhtml stream, which includes splitting pages.')
+INGEST_PAGES_PER_DOCUMENT = REGISTRY.histogram('booksearch_ingest_pages_per_document',
+                                               'Pages per converted document.', COUNT_BUCKETS)
+INGEST_PAGE_CLEAN_SECONDS = REGISTRY.histogram('booksearch_ingest_page_clean_seconds',
+                                               'Time to split out and clean a page.')
+INGEST_DB_WRITE_SECONDS = REGISTRY.histogram('booksearch_ingest_db_write_seconds',
+                                             'Time writing a batch of pages to the db.  Without --bulk or '
+                                             '--stream a document is one batch and this includes the '
+                                             'per-page signal indexing.')
+INGEST_INDEX_SECONDS = REGISTRY.histogram('booksearch_ingest_index_seconds',
+                                          'Time for a bulk index request of pages.')
+TIKA_REQUESTS = REGISTRY.counter('booksearch_ingest_tika_requests_total',
+                                 'Parse requests to Tika servers, by endpoint and outcome (ok, error or '
+                                 'unavailable).')
+INGEST_METRICS = (INGEST_DOCUMENTS.name, INGEST_PAGES.name, INGEST_DOCUMENT_SECONDS.name,
+                  INGEST_TIKA_SECONDS.name, INGEST_PAGES_PER_DOCUMENT.name, INGEST_PAGE_CLEAN_SECONDS.name,
+                  INGEST_DB_WRITE_SECONDS.name, INGEST_INDEX_SECONDS.name, TIKA_REQUESTS.name)
+
+# search
+SEARCH_CACHE_REQUESTS = REGISTRY.counter('booksearch_search_cache_requests_total',
+                                         'Search result cache lookups, by result (hit or miss).')
+SEARCH_PARTIAL = REGISTRY.counter('booksearch_search_partial_total',
+                                  'Searches returning incomplete results, by reason: deadline (no answer by '
+                                  'the client deadline), timeout (ES latency budget spent), terminated '
+                                  '(terminate_after reached), shard_failure, or statement_timeout (postgres).')
+SEARCH_REQUEST_SECONDS = REGISTRY.histogram('booksearch_search_request_seconds',
+                                            'Time for a search view to build its response, by view.')
+SEARCH_PHASE_SECONDS = REGISTRY.histogram('booksearch_search_phase_seconds',
+                                          'Time in each phase of a search: cache (result cache lookup), '
+                                          'es (ES took), network (the rest of the ES round trip), '
+                                          'shape (building results from hits), render (templates).')
+
+# {phase: seconds} for the search request being handled, see collect_phases
+_search_phases = contextvars.ContextVar('search_phases', default=None)
+
+
+@contextmanager
+def collect_phases():
+    """Collect the phases recorded with record_phase while in the block.
+
+    Yields a dict of {phase: total seconds}.  It is a context variable, so
+    phases of concurrent requests, including async ones, are kept apart.
+    """
+    phases = {}
+    token = _search_phases.set(phases)
+    try:
+        yield phases
+    finally:
+        _search_phases.reset(token)
+
+
+def record_phase(phase: str, seconds: float):
+    """Record time spent in a phase of a search, in the histogram and the current request's phases."""
+    SEARCH_PHASE_SECONDS.observe(seconds, phase=phase)
+    phases = _search_phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed_phase(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
+
+
+def server_timing(phases: dict, total: float) -> str:
+    """Format phase timings, in seconds, as a Server-Timing header value."""
+    metrics = [f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in phases.items()]
+    metrics.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(metrics)
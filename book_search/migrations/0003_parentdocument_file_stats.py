@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('book_search', '0002_childpage_parent_filename'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parentdocument',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='parentdocument',
+            name='file_mtime',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='parentdocument',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
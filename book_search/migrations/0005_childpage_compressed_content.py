@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('book_search', '0004_indexgeneration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='childpage',
+            name='compressed_content',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='childpage',
+            name='html_content',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('book_search', '0005_childpage_compressed_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parentdocument',
+            name='converted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='childpage',
+            constraint=models.UniqueConstraint(fields=('parent', 'page_number'), name='unique_parent_page_number'),
+        ),
+    ]
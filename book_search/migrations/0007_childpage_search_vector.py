@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:26
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    # only the column, the GIN index and the trigger filling it are added by the
+    # setup_postgres_search command, so ES deployments don't pay for them on ingest
+
+    dependencies = [
+        ('book_search', '0006_childpage_unique_parent_page_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='childpage',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('book_search', '0007_childpage_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='childpage',
+            name='ocr_status',
+            field=models.CharField(blank=True, default='', max_length=8),
+        ),
+        migrations.AddIndex(
+            model_name='childpage',
+            index=models.Index(condition=models.Q(('ocr_status', 'pending')), fields=['parent'], name='childpage_ocr_pending'),
+        ),
+    ]
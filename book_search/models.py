@@ -1,18 +1,26 @@
-from io import StringIO
+from contextlib import contextmanager
+import hashlib
 import re
+import time
+import zlib
 from pathlib import Path
 import logging
 
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connection, models, transaction
 from django.conf import settings
-from bs4 import BeautifulSoup
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+import requests
+from bs4 import BeautifulSoup, Comment
+from lxml import etree
 from tika import parser
 
-logger = logging.getLogger(__name__)
-
+from . import metrics
+from .tika_servers import TikaParseError, call_with_retries
 
-class TikaParseError(RuntimeError):
-    """Raised when the conversion of a document into html by Tika fails."""
+logger = logging.getLogger(__name__)
 
 
 def extract_author_and_title(metadata: dict) -> (str, str):
@@ -30,6 +38,167 @@ def extract_author_and_title(metadata: dict) -> (str, str):
     return author, title
 
 
+# Elements and attributes that survive Tika's html parser (its DefaultHtmlMapper).
+# Any other element is unwrapped, keeping its content, and other attributes are dropped.
+TIKA_SAFE_ELEMENTS = frozenset([
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'pre', 'blockquote', 'q',
+    'ul', 'ol', 'li', 'dl', 'dt', 'dd', 'table', 'thead', 'tbody', 'tr', 'th', 'td',
+    'address', 'a', 'map', 'area', 'img', 'frameset', 'frame', 'iframe',
+    'object', 'param', 'ins', 'del',
+])
+TIKA_SAFE_ATTRIBUTES = {
+    'a': {'href', 'name'},
+    'area': {'shape', 'coords', 'href', 'alt'},
+    'img': {'src', 'height', 'width', 'alt'},
+    'frame': {'src'},
+    'iframe': {'src'},
+    'object': {'data', 'type'},
+    'param': {'name', 'value'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan'},
+}
+
+
+def page_to_html(page_div, clean=True) -> str:
+    """Convert a page div from Tika's xhtml for a whole document into a standalone html page.
+
+    This produces the same html as sending the div back through Tika's html
+    parser did, without the extra round trip per page.  The html head is not
+    included so it doesn't cause any garbage in ES highlights.
+
+    Note that the children of page_div are moved into the new page.
+
+    :param page_div - bs4 Tag for a <div class="page"> element
+    :param clean - if True clean non-ascii whitespace
+    """
+    page_soup = BeautifulSoup('<html xmlns="http://www.w3.org/1999/xhtml"><body></body></html>',
+                              features='lxml')
+    body = page_soup.body
+    for child in list(page_div.children):
+        body.append(child)
+    for comment in body.find_all(string=lambda string: isinstance(string, Comment)):
+        comment.extract()
+    for tag in body.find_all(True):
+        if tag.name in TIKA_SAFE_ELEMENTS:
+            safe_attributes = TIKA_SAFE_ATTRIBUTES.get(tag.name, ())
+            tag.attrs = {key: value for key, value in tag.attrs.items() if key in safe_attributes}
+        else:
+            tag.unwrap()
+    if clean:
+        for string in body.find_all(string=True):
+            cleaned = re.sub(r' +\n', '\n', string.replace('\xa0', ' '))
+            if cleaned != string:
+                string.replace_with(cleaned)
+    return page_soup.prettify()
+
+
+def iter_xhtml_pages(source, metadata: dict, clean=True):
+    """Yield the html of each page of Tika's xhtml for a document, parsing it incrementally.
+
+    Produces the same pages as page_to_html on each page div of the parsed
+    document, but only one page is held in memory at a time.
+
+    :param source - file like object with the xhtml
+    :param metadata - filled with the name/content of the head's meta elements
+        as they are parsed, so it is complete before the first page is yielded
+    :param clean - if True clean non-ascii whitespace
+    """
+    for event, elem in etree.iterparse(source, events=('end',), huge_tree=True, remove_comments=True):
+        if not isinstance(elem.tag, str):
+            continue
+        tag = etree.QName(elem).localname
+        if tag == 'meta' and elem.get('name'):
+            metadata.setdefault(elem.get('name'), elem.get('content', ''))
+        elif tag == 'div' and elem.get('class') == 'page':
+            for child in elem.iter():
+                if isinstance(child.tag, str):
+                    child.tag = etree.QName(child).localname
+            etree.cleanup_namespaces(elem)
+            with metrics.INGEST_PAGE_CLEAN_SECONDS.time():
+                page_html = etree.tostring(elem, method='html', encoding='unicode', with_tail=False)
+                page_soup = BeautifulSoup(page_html, features='lxml')
+                page_html = page_to_html(page_soup.div, clean=clean)
+            yield page_html
+            # free the pages already processed
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+@contextmanager
+def tika_xhtml_stream(filepath, endpoint: str = '', headers: dict = None, timeout: float = None):
+    """Send the file to the Tika server and yield its xhtml response as a stream.
+
+    This talks to the running server directly, as the tika package reads the
+    whole response into memory.
+
+    :param endpoint - Tika server url, default settings.TIKA_SERVER_ENDPOINT
+    :param headers - extra request headers, eg Tika parser options
+    :param timeout - seconds to wait for Tika, default settings.TIKA_REQUEST_TIMEOUT
+    """
+    with open(filepath, 'rb') as infile:
+        response = requests.put(f'{endpoint or settings.TIKA_SERVER_ENDPOINT}/tika', data=infile,
+                                headers={'Accept': 'text/html', **(headers or {})}, stream=True,
+                                timeout=timeout or settings.TIKA_REQUEST_TIMEOUT)
+    try:
+        if response.status_code != 200:
+            raise TikaParseError(f'Tika returned status {response.status_code}', response.status_code)
+        response.raw.decode_content = True
+        yield response.raw
+    finally:
+        response.close()
+
+
+TAG_REGEX = re.compile(r'<[^>]*>')
+
+
+def has_text(html: str) -> bool:
+    """True if the page html has at least settings.OCR_MIN_PAGE_CHARS characters of text, whitespace aside."""
+    return len(''.join(TAG_REGEX.sub(' ', html).split())) >= settings.OCR_MIN_PAGE_CHARS
+
+
+def with_last_flag(iterable):
+    """Yield (item, is_last) for each item."""
+    iterator = iter(iterable)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+    for item in iterator:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
+def hash_file(filepath, chunk_size=1024 * 1024) -> str:
+    """Return the hex sha256 digest of the file's content."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class IndexGeneration(models.Model):
+    """Single row counter bumped whenever pages are added to or deleted from the index.
+
+    Cached search results are keyed on the generation, so bumping it means
+    stale results are never served.  It lives in the db rather than the cache
+    so an ingest run in another process invalidates every web worker.
+    """
+    generation = models.BigIntegerField(default=0)
+
+    @classmethod
+    def current(cls) -> int:
+        generation = cls.objects.filter(pk=1).values_list('generation', flat=True).first()
+        return generation or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=1).update(generation=models.F('generation') + 1):
+            cls.objects.get_or_create(pk=1, defaults={'generation': 1})
+
+
 class ParentDocument(models.Model):
     """Each book/file is represented here.
     """
@@ -41,10 +210,29 @@ class ParentDocument(models.Model):
     author = models.CharField(max_length=512, blank=True, default='')
     title = models.CharField(max_length=512, blank=True, default='')
 
+    # source file state when it was last converted, used to skip unchanged files
+    # when re-ingesting
+    file_size = models.BigIntegerField(null=True, blank=True)
+    file_mtime = models.FloatField(null=True, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    # when the pages were last (re)created
+    converted_at = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
         return f"id: {self.id}  {Path(self.filepath).name}"
 
-    def convert_to_html_child_pages(self, clean=True):
+    def file_stat_changed(self) -> bool:
+        """True if the file's size or mtime differ from those recorded."""
+        stat = Path(self.filepath).stat()
+        return (stat.st_size, stat.st_mtime) != (self.file_size, self.file_mtime)
+
+    def set_file_stats(self, content_hash: str = ''):
+        """Record the file's current size, mtime and content hash."""
+        stat = Path(self.filepath).stat()
+        self.file_size, self.file_mtime = stat.st_size, stat.st_mtime
+        self.content_hash = content_hash or hash_file(self.filepath)
+
+    def convert_to_html_child_pages(self, clean=True, tika_lock=None, bulk=False) -> int:
         """Convert book/file at filepath to html pages.
 
         This constructs a ChildPage object for each page of the document.
@@ -52,68 +240,216 @@ class ParentDocument(models.Model):
 
         Populates author and title if available in the metadata.
 
+        The document is parsed by one of the pool of Tika servers, retrying on
+        another if it fails, see tika_servers.call_with_retries.  Raises
+        TikaParseError if it can't be parsed.
+
+        Any existing pages are replaced: the old pages are deleted and the new
+        ones inserted in one transaction, and the old pages are removed from ES
+        once it commits.
+
         :param clean - if True clean non-ascii whitespace
+        :param tika_lock - optional lock or semaphore held while calling the Tika
+            server, used to bound concurrent requests from parallel ingest workers
+        :param bulk - if True save the pages with batched bulk_create in one transaction
+            and index them with ES bulk requests instead of one save/index per page
+        :return number of pages created
         """
-        try_count, successful_parse = 0, False
-        while try_count < settings.TIKA_PARSE_MAX_RETRY:
-            if settings.TIKA_CONFIG_FILE:
-                data = parser.from_file(str(self.filepath), xmlContent=True, config_path=settings.TIKA_CONFIG_FILE)
-            else:
-                data = parser.from_file(str(self.filepath), xmlContent=True)
-            if data['status'] == 200:
-                successful_parse = True
-                break
-        if not successful_parse:
-            logger.error('Failed to parse file: %s', self.filepath)
+        from .indexing import index_suggest_document
+
+        def parse(endpoint):
+            options = {'config_path': settings.TIKA_CONFIG_FILE} if settings.TIKA_CONFIG_FILE else {}
+            data = parser.from_file(str(self.filepath), serverEndpoint=endpoint, xmlContent=True,
+                                    requestOptions={'timeout': settings.TIKA_REQUEST_TIMEOUT}, **options)
+            if data['status'] != 200:
+                raise TikaParseError(f'Tika returned status {data["status"]}', data['status'])
+            return data
+
+        parse_start = time.perf_counter()
+        data = call_with_retries(parse, tika_lock, self.filepath)
+        metrics.INGEST_TIKA_SECONDS.observe(time.perf_counter() - parse_start)
         author, title = extract_author_and_title(data['metadata'])
         self.author, self.title = author, title
-        self.save()
         soup = BeautifulSoup(data['content'], features='lxml')
         # convert all pages successfully before creating children
         pages = []
 
-        for i, content in enumerate(soup.find_all('div', attrs={'class': 'page'})):
-            _buffer = StringIO()
-            _buffer.write(str(content))
-            parsed_content = parser.from_buffer(_buffer.getvalue(), xmlContent=True)
-
-            text = parsed_content['content'].strip()
-            if clean:
-                text = re.sub(r' +\n', '\n', parsed_content['content'].strip().replace('\xa0', ' '))
-
-            # remove the html head from the doc so it doesn't cause any garbage in ES highlights
-            page_soup = BeautifulSoup(text, features='lxml')
-            page_soup.head.extract()
-            pages.append(page_soup.prettify())
+        for content in soup.find_all('div', attrs={'class': 'page'}):
+            with metrics.INGEST_PAGE_CLEAN_SECONDS.time():
+                pages.append(page_to_html(content, clean=clean))
 
+        children = []
         for i, html in enumerate(pages):
             parent_filename = Path(self.filepath).name
-            child = ChildPage(parent=self, page_number=i+1, html_content=html,
+            child = ChildPage(parent=self, page_number=i+1,
                               author=self.author, title=self.title,
                               parent_doc_id=self.id, parent_filename=parent_filename)
+            child.set_html(html)
+            child.queue_ocr_if_textless()
             if i == len(pages) - 1:
                 child.is_last_page = True
-            child.save()
+            children.append(child)
+
+        self.converted_at = timezone.now()
+        with transaction.atomic():
+            self.save()
+            self.delete_child_pages()
+            if bulk:
+                self.bulk_save_child_pages(children)
+            else:
+                with metrics.INGEST_DB_WRITE_SECONDS.time():
+                    for child in children:
+                        child.save()
+            transaction.on_commit(lambda: index_suggest_document(self))
+            transaction.on_commit(IndexGeneration.bump)
+        metrics.INGEST_PAGES_PER_DOCUMENT.observe(len(pages))
+        return len(pages)
+
+    def delete_child_pages(self):
+        """Delete this document's pages from the db and, after commit, from ES.
+
+        The rows are deleted with a single DELETE statement rather than through
+        the collector, so no delete signals are sent and django-elasticsearch-dsl
+        doesn't send a delete request per page.  ChildPage has no dependent rows
+        to cascade to.
+        """
+        from .indexing import delete_child_pages_from_index
+
+        page_ids = list(ChildPage.objects.filter(parent=self).values_list('id', flat=True))
+        if not page_ids:
+            return
+        table = connection.ops.quote_name(ChildPage._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {table} WHERE parent_id = %s', [self.pk])
+        transaction.on_commit(lambda: delete_child_pages_from_index(page_ids))
+        transaction.on_commit(IndexGeneration.bump)
+
+    def convert_to_html_child_pages_streaming(self, clean=True, tika_lock=None) -> int:
+        """Convert book/file at filepath to html pages with memory use bounded.
+
+        Does the same as convert_to_html_child_pages with bulk=True, but Tika's
+        xhtml is parsed as it streams from the server and the pages are saved
+        and indexed in batches of settings.INGEST_BULK_BATCH_SIZE as they are
+        parsed, so memory use doesn't depend on the length of the document.
+        Existing pages are replaced in one transaction.  If it fails, pages
+        already indexed are removed from ES again, and if the Tika server
+        failed the whole conversion is retried on another.
+
+        :param clean - if True clean non-ascii whitespace
+        :param tika_lock - optional lock or semaphore held while Tika is parsing
+        :return number of pages created
+        """
+        from .indexing import delete_child_pages_from_index, index_child_pages, index_suggest_document
+
+        parent_filename = Path(self.filepath).name
+
+        def convert(endpoint) -> int:
+            metadata, indexed_ids, num_pages = {}, [], 0
+            # time spent saving and indexing, to separate it from the time reading Tika's stream
+            save_seconds = 0.0
+
+            def save_batch(batch):
+                nonlocal save_seconds
+                start = time.perf_counter()
+                with metrics.INGEST_DB_WRITE_SECONDS.time():
+                    ChildPage.objects.bulk_create(batch)
+                index_child_pages(batch)
+                indexed_ids.extend(child.id for child in batch)
+                save_seconds += time.perf_counter() - start
+
+            try:
+                with tika_xhtml_stream(self.filepath, endpoint) as source:
+                    parse_start = time.perf_counter()
+                    with transaction.atomic():
+                        self.converted_at = timezone.now()
+                        self.save()
+                        self.delete_child_pages()
+                        batch = []
+                        for html, is_last in with_last_flag(iter_xhtml_pages(source, metadata, clean)):
+                            if num_pages == 0:
+                                # the metadata is in the head, before the first page
+                                self.author, self.title = extract_author_and_title(metadata)
+                            num_pages += 1
+                            child = ChildPage(parent=self, page_number=num_pages, is_last_page=is_last,
+                                              author=self.author, title=self.title,
+                                              parent_doc_id=self.id, parent_filename=parent_filename)
+                            child.set_html(html)
+                            child.queue_ocr_if_textless()
+                            batch.append(child)
+                            if len(batch) >= settings.INGEST_BULK_BATCH_SIZE:
+                                save_batch(batch)
+                                batch = []
+                        if batch:
+                            save_batch(batch)
+                        metrics.INGEST_TIKA_SECONDS.observe(time.perf_counter() - parse_start - save_seconds)
+                        self.author, self.title = extract_author_and_title(metadata)
+                        self.save(update_fields=['author', 'title'])
+                        transaction.on_commit(lambda: index_suggest_document(self))
+                        transaction.on_commit(IndexGeneration.bump)
+            except Exception:
+                if indexed_ids:
+                    delete_child_pages_from_index(indexed_ids)
+                raise
+            return num_pages
+
+        num_pages = call_with_retries(convert, tika_lock, self.filepath)
+        metrics.INGEST_PAGES_PER_DOCUMENT.observe(num_pages)
+        return num_pages
+
+    def bulk_save_child_pages(self, children):
+        """Insert children in batches and bulk index them in ES, in one transaction.
+
+        bulk_create doesn't send the save signals django-elasticsearch-dsl uses
+        so the pages are indexed explicitly.  If indexing fails the inserts are
+        rolled back, and the pages already indexed are removed from ES again.
+        """
+        from .indexing import delete_child_pages_from_index, index_child_pages
+
+        with transaction.atomic():
+            with metrics.INGEST_DB_WRITE_SECONDS.time():
+                ChildPage.objects.bulk_create(children, batch_size=settings.INGEST_BULK_BATCH_SIZE)
+            try:
+                index_child_pages(children)
+            except Exception:
+                # which chunks were indexed isn't known, pages never indexed are ignored
+                delete_child_pages_from_index([child.id for child in children])
+                raise
+
+
+PAGE_STORAGE_TYPES = ('db', 'compressed', 'elasticsearch')
+# ChildPage.ocr_status of pages queued for, done by and failed in the background OCR pass
+OCR_PENDING, OCR_DONE, OCR_FAILED = 'pending', 'done', 'failed'
 
 
 class ChildPage(models.Model):
     """Each page of a book/file is represented by a ChildPage.
 
-    With the initial implementation, this model will also have the html_content
-    field filled with the full text of the page.  This is very inefficient
-    space-wise as you are storing the full text in the database as well as in
-    Elasticsearch.  But it allows reading the text online and being able to
-    navigate directly from the search to the location in the text.
+    The full html of the page is indexed in Elasticsearch, and is also needed
+    for reading the text online and navigating directly from the search to the
+    location in the text.  Where it is kept is set by settings.PAGE_STORAGE:
+
+    'db' - plain text in html_content.  This duplicates the full text in the
+        database and Elasticsearch.
+    'compressed' - zlib compressed in compressed_content.
+    'elasticsearch' - nothing in the db, the html is read from the ES _source.
+        Note the index can't then be rebuilt from the db.
 
-    The reason that it is mandatory now is due to using django-elasticsearch-dsl.
-    In the future, we can get rid of django-es-dsl and then allow an option to
-    not store the full text to save space.
+    Use the html property to read the page whichever way it is stored, and
+    set_html to store it.  The convert_page_storage command moves existing
+    pages between storage types.
     """
 
     parent = models.ForeignKey(ParentDocument, on_delete=models.CASCADE)
     page_number = models.IntegerField()
-    html_content = models.TextField()
+    html_content = models.TextField(blank=True)
+    compressed_content = models.BinaryField(null=True, blank=True)
+    # html_content's lexemes for the postgres search backend, with a GIN index.  Set
+    # by a trigger on PostgreSQL, see migration 0007, so it is never written here
+    search_vector = SearchVectorField(null=True, editable=False)
     is_last_page = models.BooleanField(default=False)
+    # '' if the page had text when converted, otherwise one of OCR_PENDING, OCR_DONE
+    # or OCR_FAILED, see ocr.py
+    ocr_status = models.CharField(max_length=8, blank=True, default='')
 
     # need to duplicate keys from parent so django-elasticsearch-dsl can access them
     author = models.CharField(max_length=512)
@@ -122,8 +458,68 @@ class ChildPage(models.Model):
     parent_doc_id = models.IntegerField()
     parent_filename = models.CharField(max_length=512)
 
+    class Meta:
+        constraints = [
+            # also the index used to look up a page of a book
+            models.UniqueConstraint(fields=['parent', 'page_number'], name='unique_parent_page_number'),
+        ]
+        indexes = [
+            # the OCR queue, a small part of the pages
+            models.Index(fields=['parent'], name='childpage_ocr_pending', condition=models.Q(ocr_status=OCR_PENDING)),
+        ]
+
+    # page html once read or set, see html
+    _html = None
+
+    @property
+    def html(self) -> str:
+        """The page's html, from wherever it is stored."""
+        if self._html is None:
+            if self.html_content:
+                self._html = self.html_content
+            elif self.compressed_content is not None:
+                self._html = zlib.decompress(self.compressed_content).decode('utf-8')
+            else:
+                from .indexing import fetch_html_from_index
+
+                self._html = fetch_html_from_index([self.pk]).get(self.pk, '')
+        return self._html
+
+    def set_html(self, html: str, storage: str = ''):
+        """Store the page html.
+
+        :param storage - one of PAGE_STORAGE_TYPES, default settings.PAGE_STORAGE
+        """
+        storage = storage or settings.PAGE_STORAGE
+        if storage == 'db':
+            self.html_content, self.compressed_content = html, None
+        elif storage == 'compressed':
+            self.html_content = ''
+            self.compressed_content = zlib.compress(html.encode('utf-8'), settings.PAGE_COMPRESSION_LEVEL)
+        elif storage == 'elasticsearch':
+            self.html_content, self.compressed_content = '', None
+        else:
+            raise ValueError(f'Unknown page storage: {storage}')
+        # kept so the page can be indexed without reading it back
+        self._html = html
+
+    def queue_ocr_if_textless(self):
+        """Queue the page for the background OCR pass if its html has no text, see ocr.py."""
+        if not has_text(self.html):
+            self.ocr_status = OCR_PENDING
+
     def url(self):
         return f"/{self.parent_doc_id}/{self.page_number}/"
 
     def __str__(self):
         return (f"{self.author} - {self.title} - page {self.page_number}")
+
+
+@receiver(post_delete, sender=ParentDocument)
+def bump_index_generation_on_delete(sender, instance, **kwargs):
+    from .indexing import delete_suggest_document
+
+    parent_id = instance.pk
+    # BookSuggestDocument ignores the signals, so its doc is deleted here
+    transaction.on_commit(lambda: delete_suggest_document(parent_id))
+    transaction.on_commit(IndexGeneration.bump)
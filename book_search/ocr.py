@@ -0,0 +1,176 @@
+"""Background OCR of pages that had no text when converted.
+
+Ingest parses documents with OCR turned off (settings.TIKA_CONFIG_FILE), as
+Tesseract makes parsing an order of magnitude slower, so the pages of scanned
+books come out empty.  Those pages are queued (ChildPage.ocr_status is
+OCR_PENDING) and their documents parsed again here, by the Tika servers with
+OCR enabled in settings.OCR_TIKA_ENDPOINTS.  With the auto pdf OCR strategy
+(settings.OCR_TIKA_HEADERS) Tika only OCRs the pages without text.
+
+Only the queued pages' rows and ES docs are updated, the rest of the
+document is left as it is.  Run by the ocr_pages command.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from lxml import etree
+
+from .indexing import fetch_html_from_index, index_child_pages
+from .models import (OCR_DONE, OCR_FAILED, OCR_PENDING, ChildPage, IndexGeneration, ParentDocument, has_text,
+                     iter_xhtml_pages, tika_xhtml_stream)
+from .tika_servers import TikaParseError, TikaServerPool, call_with_retries
+
+logger = logging.getLogger(__name__)
+
+
+def get_ocr_pool() -> TikaServerPool:
+    """A pool of the OCR Tika servers, separate from the ingest servers of tika_servers.get_pool."""
+    return TikaServerPool(settings.OCR_TIKA_ENDPOINTS)
+
+
+def pending_documents() -> [int]:
+    """Ids of the documents with pages queued for OCR."""
+    return list(ChildPage.objects.filter(ocr_status=OCR_PENDING).order_by('parent_id')
+                .values_list('parent_id', flat=True).distinct())
+
+
+def queue_textless_pages(batch_size: int = None) -> int:
+    """Queue the pages converted before OCR queueing that have no text, returning how many.
+
+    Reads every page not already queued or OCR'd, in batches, so it is only
+    needed once for pages converted before the ocr_status field existed.
+
+    :param batch_size - pages read at once, default settings.INGEST_BULK_BATCH_SIZE
+    """
+    batch_size = batch_size or settings.INGEST_BULK_BATCH_SIZE
+    queued, last_id = 0, 0
+    while True:
+        pages = list(ChildPage.objects.filter(id__gt=last_id, ocr_status='').order_by('id')[:batch_size])
+        if not pages:
+            return queued
+        last_id = pages[-1].id
+        # read pages stored only in ES in one request
+        in_index = fetch_html_from_index([page.id for page in pages
+                                          if not page.html_content and page.compressed_content is None])
+        textless = []
+        for page in pages:
+            if page.id in in_index:
+                page._html = in_index[page.id]
+            elif not page.html_content and page.compressed_content is None:
+                # in neither the db nor the index, there's nothing to OCR it into
+                continue
+            if not has_text(page.html):
+                textless.append(page.id)
+        queued += ChildPage.objects.filter(id__in=textless).update(ocr_status=OCR_PENDING)
+
+
+def requeue_failed() -> int:
+    """Queue the pages whose OCR failed again, returning how many."""
+    return ChildPage.objects.filter(ocr_status=OCR_FAILED).update(ocr_status=OCR_PENDING)
+
+
+def _fail_pending(parent: ParentDocument):
+    ChildPage.objects.filter(parent=parent, ocr_status=OCR_PENDING).update(ocr_status=OCR_FAILED)
+
+
+def ocr_document(parent: ParentDocument, pool: TikaServerPool = None) -> (int, int, str):
+    """OCR a document's queued pages, updating those pages' html in the db and ES.
+
+    The document is parsed by an OCR server, retrying on another if it fails,
+    see tika_servers.call_with_retries, and the xhtml streamed so only the
+    queued pages are kept.  If it can't be parsed, or Tika finds a different
+    number of pages than when it was converted, or saving or indexing the
+    pages fails, its queued pages are marked OCR_FAILED.  Pages OCR still finds
+    no text in are marked OCR_DONE as they are.
+
+    :param pool - OCR servers, default get_ocr_pool()
+    :return (pages queued, pages now with text, error message or '' on success)
+    """
+    page_numbers = set(ChildPage.objects.filter(parent=parent, ocr_status=OCR_PENDING)
+                       .values_list('page_number', flat=True))
+    if not page_numbers:
+        return 0, 0, ''
+
+    def parse(endpoint) -> (dict, int):
+        pages, num_pages = {}, 0
+        with tika_xhtml_stream(parent.filepath, endpoint, headers=settings.OCR_TIKA_HEADERS,
+                               timeout=settings.OCR_REQUEST_TIMEOUT) as source:
+            for num_pages, html in enumerate(iter_xhtml_pages(source, {}), 1):
+                if num_pages in page_numbers:
+                    pages[num_pages] = html
+        return pages, num_pages
+
+    try:
+        pages, num_pages = call_with_retries(parse, description=parent.filepath, pool=pool or get_ocr_pool())
+        expected = ChildPage.objects.filter(parent=parent).count()
+        if num_pages != expected:
+            raise TikaParseError(f'OCR found {num_pages} pages, expected {expected}')
+    except (TikaParseError, OSError, etree.XMLSyntaxError) as error:
+        logger.error('%s: failed to OCR document: %s', error, parent.filepath)
+        _fail_pending(parent)
+        return len(page_numbers), 0, str(error)
+    except Exception as error:
+        logger.exception('Unexpected error OCRing: %s', parent.filepath)
+        _fail_pending(parent)
+        return len(page_numbers), 0, repr(error)
+
+    try:
+        with transaction.atomic():
+            # pages replaced by a new conversion since they were queued are left alone
+            queued = list(ChildPage.objects.select_for_update()
+                          .filter(parent=parent, ocr_status=OCR_PENDING, page_number__in=pages))
+            with_text = []
+            for page in queued:
+                if has_text(pages[page.page_number]):
+                    page.set_html(pages[page.page_number])
+                    with_text.append(page)
+                page.ocr_status = OCR_DONE
+            ChildPage.objects.bulk_update(queued, ['html_content', 'compressed_content', 'ocr_status'])
+            # bulk_update sends no save signals.  If indexing fails the updates are rolled back
+            index_child_pages(with_text)
+            if with_text:
+                transaction.on_commit(IndexGeneration.bump)
+    except Exception as error:
+        logger.exception('Unexpected error saving OCR of: %s', parent.filepath)
+        _fail_pending(parent)
+        return len(page_numbers), 0, repr(error)
+    logger.info('OCR found text on %s of %s pages: %s', len(with_text), len(queued), parent.filepath)
+    return len(page_numbers), len(with_text), ''
+
+
+def _ocr_in_thread(parent_id: int, pool: TikaServerPool):
+    try:
+        parent = ParentDocument.objects.filter(pk=parent_id).first()
+        return (parent, *ocr_document(parent, pool)) if parent else (None, 0, 0, '')
+    finally:
+        # each thread has its own connection
+        connection.close()
+
+
+def ocr_pending_pages(workers: int = None, limit: int = None):
+    """OCR the queued pages, one document per worker thread.
+
+    The workers only wait on the OCR servers, so they are threads, and their
+    number bounds the concurrent OCR requests.
+
+    :param workers - documents OCR'd at once, default settings.OCR_WORKERS
+    :param limit - max documents to OCR, default all those queued
+    :return yields (parent document, pages queued, pages now with text, error) as each document finishes
+    """
+    workers = workers or settings.OCR_WORKERS
+    parent_ids = pending_documents()[:limit]
+    pool = get_ocr_pool()
+    if workers == 1:
+        for parent_id in parent_ids:
+            parent = ParentDocument.objects.filter(pk=parent_id).first()
+            if parent:
+                yield parent, *ocr_document(parent, pool)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_ocr_in_thread, parent_id, pool) for parent_id in parent_ids]
+        for future in as_completed(futures):
+            result = future.result()
+            if result[0]:
+                yield result
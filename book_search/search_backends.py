@@ -0,0 +1,371 @@
+"""Search backends: the searches behind handle_query and the search views.
+
+settings.SEARCH_BACKEND selects one:
+
+'elasticsearch' - the ES searches in elasticsearch.py.
+'postgres' - PostgreSQL full text search on ChildPage.search_vector, for small
+    deployments and test machines without an ES node.  Pages must be stored
+    in the db (settings.PAGE_STORAGE = 'db') as the highlights are made from
+    html_content.  Turn off ES indexing with ELASTICSEARCH_DSL_AUTOSYNC = False.
+    Run the setup_postgres_search command first to fill in search_vector.
+
+Both return BookHit and PageHit results, so the result cache, templates and
+json api work the same whichever is used.
+"""
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import reduce
+import logging
+import operator
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, OperationalError, connection, transaction
+from django.db.models import Count, F, Max, Window
+from django.db.models.functions import RowNumber
+
+from . import elasticsearch as es
+from .elasticsearch import FACET_FIELDS, INNER_HITS_SIZE, BookHit, PageHit
+from .metrics import SEARCH_PARTIAL, timed_phase
+from .models import ChildPage
+
+logger = logging.getLogger(__name__)
+
+# text search config of the search_vector trigger, see install_search_vector
+POSTGRES_SEARCH_CONFIG = 'english'
+SEARCH_VECTOR_TRIGGER = 'book_search_childpage_search_vector_update'
+SEARCH_VECTOR_INDEX = 'book_search_childpage_search_vector_gin'
+# books returned by a search, as ES returns by default
+POSTGRES_SEARCH_SIZE = 10
+# between the fragments ts_headline returns, a control character so it can't be in the page text
+FRAGMENT_DELIMITER = '\x1f'
+# SQLSTATE of a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+_backend = None
+
+
+class SearchBackend(ABC):
+    """The searches a backend provides.
+
+    Filters are facet name to selected value, see elasticsearch.FACET_FIELDS.
+    """
+    name = ''
+
+    @abstractmethod
+    def search(self, query_type: str, query: str, filters: dict = None) -> (int, [BookHit], dict, bool):
+        """Books matching the query, with their best pages, see elasticsearch.collapsed_search.
+
+        Searches are limited to the latency budget of query_type, see
+        settings.SEARCH_LATENCY_BUDGET, and flagged partial if they ran out of it.
+
+        :return (total_hits, results, facets, partial)
+        """
+
+    def search_iter(self, query_type: str, query: str, filters: dict = None):
+        """Like search, with the results as an iterator.
+
+        :return (total_hits, iterator of results, facets, partial)
+        """
+        total_hits, results, facets, partial = self.search(query_type, query, filters)
+        return total_hits, iter(results), facets, partial
+
+    async def async_search(self, query_type: str, query: str,
+                           filters: dict = None) -> (int, [BookHit], dict, bool):
+        return await sync_to_async(self.search)(query_type, query, filters)
+
+    @abstractmethod
+    def search_page(self, query_type: str, query: str, cursor: str = '', size: int = None,
+                    filters: dict = None) -> (int, [BookHit], str, bool):
+        """Page through all the books matching a query, see elasticsearch.search_page.
+
+        Raises ValueError for an invalid cursor, elasticsearch.CursorExpired if it is no longer valid.
+        """
+
+    def multi_search(self, searches: [(str, str, dict)]) -> list:
+        """Run a batch of searches, see elasticsearch.multi_search.  By default one after the other.
+
+        :param searches - (query_type, query, filters) of each search
+        :return for each search, (total_hits, results, facets, partial) or an elasticsearch.SearchError
+        """
+        return [self.search(query_type, query, filters) for query_type, query, filters in searches]
+
+    @abstractmethod
+    def more_book_pages(self, query_type: str, query: str, parent_doc_id: int,
+                        cursor: str = '', size: int = None) -> ([PageHit], str):
+        """Matching pages of one book after those in the search results, see elasticsearch.more_book_pages.
+
+        Raises ValueError for an invalid cursor.
+        """
+
+
+class ElasticsearchBackend(SearchBackend):
+    name = 'elasticsearch'
+
+    def search(self, query_type, query, filters=None):
+        return es.collapsed_search(query_type, query, filters)
+
+    def search_iter(self, query_type, query, filters=None):
+        return es.collapsed_search_iter(query_type, query, filters)
+
+    async def async_search(self, query_type, query, filters=None):
+        return await es.async_collapsed_search(query_type, query, filters)
+
+    def search_page(self, query_type, query, cursor='', size=None, filters=None):
+        return es.search_page(query_type, query, cursor, size, filters)
+
+    def multi_search(self, searches):
+        return es.multi_search(searches)
+
+    def more_book_pages(self, query_type, query, parent_doc_id, cursor='', size=None):
+        return es.more_book_pages(query_type, query, parent_doc_id, cursor, size)
+
+
+class PostgresBackend(SearchBackend):
+    """Full text search on ChildPage.search_vector, with ts_headline highlights.
+
+    Pages are ranked with ts_rank and grouped per book like the ES collapse:
+    books in order of their best page, each with its best INNER_HITS_SIZE
+    pages.  Headlines are only made for the pages returned.
+
+    The latency budget is a statement_timeout on each of a search's queries.
+    PostgreSQL can't return the rows found so far, so a search that runs out
+    of it returns no results, flagged partial.
+    """
+    name = 'postgres'
+
+    def __init__(self):
+        if connection.vendor != 'postgresql':
+            raise ImproperlyConfigured('The postgres search backend needs a PostgreSQL database')
+        if settings.PAGE_STORAGE != 'db':
+            raise ImproperlyConfigured("The postgres search backend needs PAGE_STORAGE = 'db'")
+        if not search_vector_installed():
+            raise ImproperlyConfigured('The postgres search backend needs ChildPage.search_vector filled, '
+                                       'run the setup_postgres_search command')
+
+    @staticmethod
+    def text_query(query_type: str, query: str) -> SearchQuery:
+        """The query as ES runs it: match is any of the words, match_phrase all of them in order."""
+        if query_type == 'match_phrase':
+            return SearchQuery(query, search_type='phrase', config=POSTGRES_SEARCH_CONFIG)
+        words = re.findall(r'\w+', query) or ['']
+        return reduce(operator.or_, (SearchQuery(word, config=POSTGRES_SEARCH_CONFIG) for word in words))
+
+    def matching_pages(self, query_type: str, query: str, filters: dict = None):
+        """Return the pages matching the query and the SearchQuery."""
+        text_query = self.text_query(query_type, query)
+        pages = ChildPage.objects.filter(search_vector=text_query)
+        if filters:
+            # the facets are ChildPage fields of the same name
+            pages = pages.filter(**{name: value for name, value in filters.items() if name in FACET_FIELDS})
+        return pages, text_query
+
+    @staticmethod
+    def rank(text_query: SearchQuery) -> SearchRank:
+        return SearchRank(F('search_vector'), text_query)
+
+    def search(self, query_type, query, filters=None):
+        try:
+            with timed_phase('db'), statement_timeout(es.search_budget(query_type)):
+                pages, text_query = self.matching_pages(query_type, query, filters)
+                total_hits = pages.count()
+                books = (pages.values('parent_doc_id').annotate(score=Max(self.rank(text_query)))
+                         .order_by('-score', 'parent_doc_id'))
+                parent_doc_ids = [book['parent_doc_id'] for book in books[:POSTGRES_SEARCH_SIZE]]
+                results = self.book_hits(pages, parent_doc_ids, text_query)
+                facets = self.facets(pages)
+        except OperationalError as error:
+            if not timed_out(error):
+                raise
+            logger.warning('%s search for %r ran out of its latency budget', query_type, query)
+            return 0, [], {}, True
+        return total_hits, results, facets, False
+
+    def search_page(self, query_type, query, cursor='', size=None, filters=None):
+        size = size or settings.SEARCH_PAGE_SIZE
+        after = cursor_position(cursor, 'after', 0)
+        try:
+            with timed_phase('db'), statement_timeout(es.search_budget(query_type)):
+                pages, text_query = self.matching_pages(query_type, query, filters)
+                total_hits = pages.count()
+                parent_doc_ids = list(pages.filter(parent_doc_id__gt=after).order_by('parent_doc_id')
+                                      .values_list('parent_doc_id', flat=True).distinct()[:size])
+                results = self.book_hits(pages, parent_doc_ids, text_query)
+        except OperationalError as error:
+            if not timed_out(error):
+                raise
+            logger.warning('paged %s search for %r ran out of its latency budget', query_type, query)
+            return 0, [], '', True
+        next_cursor = es.encode_cursor({'after': parent_doc_ids[-1]}) if len(parent_doc_ids) == size else ''
+        return total_hits, results, next_cursor, False
+
+    def multi_search(self, searches):
+        results = []
+        for query_type, query, filters in searches:
+            try:
+                results.append(self.search(query_type, query, filters))
+            except DatabaseError as error:
+                logger.warning('%s search for %r failed: %s', query_type, query, error)
+                results.append(es.SearchError(str(error)))
+        return results
+
+    def more_book_pages(self, query_type, query, parent_doc_id, cursor='', size=None):
+        size = size or settings.SEARCH_PAGE_SIZE
+        offset = cursor_position(cursor, 'offset', INNER_HITS_SIZE)
+        with timed_phase('db'):
+            pages, text_query = self.matching_pages(query_type, query)
+            page_ids = list(pages.filter(parent_doc_id=parent_doc_id).annotate(rank=self.rank(text_query))
+                            .order_by('-rank', 'page_number')
+                            .values_list('pk', flat=True)[offset:offset + size])
+            hits = [PageHit(hit) for hit in self.page_hits(page_ids, text_query)]
+        next_cursor = es.encode_cursor({'offset': offset + size}) if len(page_ids) == size else ''
+        return hits, next_cursor
+
+    def book_hits(self, pages, parent_doc_ids: [int], text_query: SearchQuery) -> [BookHit]:
+        """Results for the books, with their best INNER_HITS_SIZE pages as inner hits."""
+        best_pages = (pages.filter(parent_doc_id__in=parent_doc_ids)
+                      .annotate(rank=self.rank(text_query))
+                      .annotate(row=Window(RowNumber(), partition_by=[F('parent_doc_id')],
+                                           order_by=[F('rank').desc(), F('page_number').asc()]))
+                      .filter(row__lte=INNER_HITS_SIZE)
+                      .order_by('parent_doc_id', 'row')
+                      .values_list('pk', flat=True))
+        inner_hits = defaultdict(list)
+        for hit in self.page_hits(list(best_pages), text_query):
+            inner_hits[hit['_source']['parent_doc_id']].append(hit)
+        return [BookHit({'_source': inner_hits[parent_doc_id][0]['_source'],
+                         'inner_hits': {'matched_pages': {'hits': {'hits': inner_hits[parent_doc_id]}}}})
+                for parent_doc_id in parent_doc_ids if inner_hits[parent_doc_id]]
+
+    @staticmethod
+    def page_hits(page_ids: [int], text_query: SearchQuery) -> [dict]:
+        """The pages, in the order given, as ES hits with their highlights."""
+        headline = SearchHeadline('html_content', text_query, config=POSTGRES_SEARCH_CONFIG,
+                                  start_sel='<em>', stop_sel='</em>', max_words=20, min_words=10,
+                                  max_fragments=5, fragment_delimiter=FRAGMENT_DELIMITER)
+        rows = (ChildPage.objects.filter(pk__in=page_ids).annotate(headline=headline)
+                .values('pk', 'parent_doc_id', 'parent_filename', 'title', 'author', 'page_number', 'headline'))
+        rows = {row.pop('pk'): row for row in rows}
+        return [{'_source': rows[page_id],
+                 'highlight': {'content': rows[page_id].pop('headline').split(FRAGMENT_DELIMITER)}}
+                for page_id in page_ids if page_id in rows]
+
+    @staticmethod
+    def facets(pages) -> dict:
+        """The top values of each facet with their numbers of matching pages, see elasticsearch.shape_facets."""
+        facets = {}
+        for name in FACET_FIELDS:
+            counts = (pages.exclude(**{name: ''}).values(name).annotate(count=Count('pk'))
+                      .order_by('-count', name)[:settings.SEARCH_FACET_SIZE])
+            facets[name] = [(row[name], row['count']) for row in counts]
+        return facets
+
+
+@contextmanager
+def statement_timeout(seconds):
+    """Cancel any query in the block that runs longer than seconds, None for no limit.
+
+    The queries are run in a transaction, so the timeout is reset at its end.
+    """
+    if seconds is None:
+        yield
+        return
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL statement_timeout = %s', [round(seconds * 1000)])
+        yield
+
+
+def timed_out(error: OperationalError) -> bool:
+    """True if a query was cancelled by statement_timeout, counted in the partial search metric."""
+    if getattr(error.__cause__, 'pgcode', None) != QUERY_CANCELED:
+        return False
+    SEARCH_PARTIAL.inc(reason='statement_timeout')
+    return True
+
+
+def cursor_position(cursor: str, key: str, default: int) -> int:
+    """Read a position from a cursor made by the postgres backend, raises ValueError if it's invalid."""
+    if not cursor:
+        return default
+    try:
+        return int(es.decode_cursor(cursor, (key,))[key])
+    except TypeError:
+        raise ValueError(f'invalid cursor: {cursor!r}') from None
+
+
+def search_vector_installed() -> bool:
+    """True if the trigger keeping ChildPage.search_vector up to date exists, see install_search_vector."""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_trigger WHERE tgname = %s', [SEARCH_VECTOR_TRIGGER])
+        return cursor.fetchone() is not None
+
+
+def install_search_vector(batch_size: int = None) -> int:
+    """Set up ChildPage.search_vector for the postgres backend, returning the pages filled in.
+
+    Only the postgres backend uses the column, so it isn't kept up to date
+    unless this is run: it adds a trigger setting the vector from html_content
+    on insert and update, fills it in for the existing pages, then adds the GIN
+    index.  The pages are updated a batch per statement, so a large library
+    isn't locked in one long UPDATE.  Safe to run again.
+
+    :param batch_size - pages updated at once, default settings.INGEST_BULK_BATCH_SIZE
+    """
+    table = ChildPage._meta.db_table
+    with connection.cursor() as cursor:
+        # before filling in the vectors, so pages saved meanwhile get one too
+        cursor.execute(f'DROP TRIGGER IF EXISTS {SEARCH_VECTOR_TRIGGER} ON {table}')
+        cursor.execute(f"""CREATE TRIGGER {SEARCH_VECTOR_TRIGGER}
+                           BEFORE INSERT OR UPDATE OF html_content ON {table} FOR EACH ROW
+                           EXECUTE PROCEDURE tsvector_update_trigger(
+                               search_vector, 'pg_catalog.{POSTGRES_SEARCH_CONFIG}', html_content)""")
+    filled = update_search_vectors(f"to_tsvector('pg_catalog.{POSTGRES_SEARCH_CONFIG}', html_content)",
+                                   ChildPage.objects.filter(search_vector__isnull=True), batch_size)
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_VECTOR_INDEX} ON {table} USING gin (search_vector)')
+    return filled
+
+
+def remove_search_vector(batch_size: int = None) -> int:
+    """Undo install_search_vector, returning the pages whose vector was cleared."""
+    table = ChildPage._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {SEARCH_VECTOR_TRIGGER} ON {table}')
+        cursor.execute(f'DROP INDEX IF EXISTS {SEARCH_VECTOR_INDEX}')
+    return update_search_vectors('NULL', ChildPage.objects.filter(search_vector__isnull=False), batch_size)
+
+
+def update_search_vectors(value: str, pages, batch_size: int = None) -> int:
+    """Set search_vector to the SQL expression value on pages, a batch of ids at a time, returning how many."""
+    batch_size = batch_size or settings.INGEST_BULK_BATCH_SIZE
+    table = ChildPage._meta.db_table
+    updated, last_id = 0, 0
+    while True:
+        page_ids = list(pages.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not page_ids:
+            return updated
+        last_id = page_ids[-1]
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {table} SET search_vector = {value} WHERE id = ANY(%s)', [page_ids])
+        updated += len(page_ids)
+
+
+BACKENDS = {backend.name: backend for backend in (ElasticsearchBackend, PostgresBackend)}
+
+
+def get_backend() -> SearchBackend:
+    """Return the backend named by settings.SEARCH_BACKEND."""
+    global _backend
+    if _backend is None or _backend.name != settings.SEARCH_BACKEND:
+        try:
+            backend_class = BACKENDS[settings.SEARCH_BACKEND]
+        except KeyError:
+            raise ImproperlyConfigured(f'Unknown search backend {settings.SEARCH_BACKEND!r}, '
+                                       f'expected one of {", ".join(BACKENDS)}') from None
+        _backend = backend_class()
+    return _backend
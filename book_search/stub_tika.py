@@ -0,0 +1,108 @@
+"""Stub Tika server and synthetic corpus for benchmarking ingest without Tika.
+
+Each synthetic document is a small file describing the document, and the
+stub server answers Tika's /rmeta/xml and /tika endpoints with generated
+xhtml in the same shape Tika produces for a pdf, one div per page.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from xml.sax.saxutils import escape
+import json
+import random
+import threading
+
+WORDS = ('wisdom', 'emptiness', 'awareness', 'mind', 'nature', 'path', 'view', 'practice',
+         'meditation', 'compassion', 'reality', 'appearance', 'clarity', 'insight', 'teacher',
+         'student', 'text', 'commentary', 'verse', 'chapter', 'the', 'of', 'and', 'in', 'is')
+
+
+def generate_corpus(directory, documents: int, pages: int, words: int) -> [Path]:
+    """Write the files for a synthetic corpus into directory."""
+    paths = []
+    for i in range(documents):
+        path = Path(directory) / f'document_{i:05d}.pdf'
+        path.write_text(json.dumps({'seed': i, 'pages': pages, 'words': words}))
+        paths.append(path)
+    return paths
+
+
+def document_xhtml(spec: dict) -> str:
+    """Generate Tika style xhtml for a synthetic document file's spec."""
+    rng = random.Random(spec['seed'])
+    parts = [
+        '<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n',
+        f'<meta name="dc:creator" content="Author {spec["seed"]}"/>\n',
+        f'<meta name="dc:title" content="Document {spec["seed"]}"/>\n',
+        f'<title>Document {spec["seed"]}</title>\n</head>\n<body>',
+    ]
+    for page in range(spec['pages']):
+        parts.append('<div class="page">')
+        remaining = spec['words']
+        while remaining > 0:
+            paragraph = min(remaining, rng.randint(20, 80))
+            parts.append(f'<p>{escape(" ".join(rng.choices(WORDS, k=paragraph)))}</p>\n')
+            remaining -= paragraph
+        parts.append('</div>\n')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+class StubTikaHandler(BaseHTTPRequestHandler):
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            spec = json.loads(body)
+        except ValueError:
+            self.send_error(422, 'Not a synthetic document')
+            return
+        xhtml = document_xhtml(spec)
+        if self.path == '/rmeta/xml':
+            content_type = 'application/json'
+            payload = json.dumps([{'Content-Type': 'application/pdf',
+                                   'dc:creator': f'Author {spec["seed"]}',
+                                   'dc:title': f'Document {spec["seed"]}',
+                                   'X-TIKA:content': xhtml}])
+        elif self.path == '/tika':
+            content_type, payload = 'text/html; charset=UTF-8', xhtml
+        else:
+            self.send_error(404)
+            return
+        data = payload.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        # health check, /tika answers with a greeting on a real server
+        data = b'This is Tika Server (stub).'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubTikaServer:
+    """Run the stub server on a local port in a background thread.
+
+    Use as a context manager, the endpoint url is in the endpoint attribute.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), StubTikaHandler)
+        self.server.daemon_threads = True
+        self.endpoint = f'http://{host}:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,3 +1,1120 @@
-from django.test import TestCase
+from contextlib import contextmanager, nullcontext
+from io import BytesIO, StringIO
+from pathlib import Path
+import json
+import os
+import pickle
+import re
+from tempfile import TemporaryDirectory
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+import requests
+from bs4 import BeautifulSoup
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from elasticsearch import BadRequestError, ConnectionTimeout, NotFoundError
+from elastic_transport import ApiResponseMeta
+
+from . import elasticsearch as es
+from . import indexing, metrics, ocr, search_backends, tika_servers, views
+from .documents import BookSuggestDocument, content_highlight_options
+from .models import (OCR_DONE, OCR_FAILED, OCR_PENDING, ChildPage, IndexGeneration, ParentDocument, hash_file,
+                     iter_xhtml_pages, page_to_html)
+from .management.commands import convert_to_html_and_index as ingest
+from .management.commands.benchmark_shaping import canned_response, legacy_shape_collapsed_hits
+from .stub_tika import StubTikaServer, document_xhtml, generate_corpus
+from .management.commands.convert_to_html_and_index import find_documents, find_changed_documents
+
+
+@override_settings(ELASTIC_URL='http://localhost:9200', ELASTIC_CA_CERT=None)
+class TestGetClient(SimpleTestCase):
+
+    def setUp(self):
+        es._reset_client_after_fork()
+
+    def tearDown(self):
+        es._reset_client_after_fork()
+
+    def test_client_is_shared(self):
+        self.assertIs(es.get_client(), es.get_client())
+
+    def test_client_rebuilt_in_new_process(self):
+        client = es.get_client()
+        with mock.patch.object(es.os, 'getpid', return_value=es._client_pid + 1):
+            self.assertIsNot(es.get_client(), client)
+
+
+class TestFindDocuments(SimpleTestCase):
+
+    def test_find_documents_recursive(self):
+        with TemporaryDirectory() as tmpdir:
+            root = Path(tmpdir)
+            (root / 'sub').mkdir()
+            for name in ('a.pdf', 'b.epub', 'c.txt', 'sub/d.pdf'):
+                (root / name).touch()
+            found = sorted(path.relative_to(root).as_posix() for path in find_documents(tmpdir))
+            self.assertEqual(found, ['a.pdf', 'b.epub', 'sub/d.pdf'])
+
+
+class TestPageToHtml(SimpleTestCase):
+    # page div as found in Tika's xhtml for the whole document
+    document_xhtml = (
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Book</title></head><body>'
+        '<div class="page"><p>Some  text\xa0 here \nmore</p>\n'
+        '<div class="annotation"><a href="http://example.com" class="x">link</a></div>\n'
+        '<!-- comment --><p>Last line </p>\n</div>'
+        '</body></html>'
+    )
+    # what Tika's html parser returned for that div
+    tika_page_xhtml = (
+        '<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n'
+        '<meta name="X-TIKA:Parsed-By" content="org.apache.tika.parser.DefaultParser"/>\n'
+        '<title></title>\n</head>\n'
+        '<body><p>Some  text\xa0 here \nmore</p>\n'
+        '<a href="http://example.com">link</a>\n'
+        '<p>Last line </p>\n</body></html>'
+    )
+
+    def page_div(self):
+        soup = BeautifulSoup(self.document_xhtml, features='lxml')
+        return soup.find('div', attrs={'class': 'page'})
+
+    def test_same_as_tika_round_trip(self):
+        text = re.sub(r' +\n', '\n', self.tika_page_xhtml.strip().replace('\xa0', ' '))
+        page_soup = BeautifulSoup(text, features='lxml')
+        page_soup.head.extract()
+        self.assertEqual(page_to_html(self.page_div()), page_soup.prettify())
+
+    def test_no_clean(self):
+        self.assertIn('text\xa0 here', page_to_html(self.page_div(), clean=False))
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+class TestBulkSaveChildPages(TestCase):
+
+    @override_settings(INGEST_BULK_BATCH_SIZE=2)
+    def test_bulk_save_child_pages(self):
+        parent = ParentDocument.objects.create(filepath='/books/book.pdf')
+        children = [ChildPage(parent=parent, page_number=i, html_content=f'<p>{i}</p>',
+                              parent_doc_id=parent.id, parent_filename='book.pdf')
+                    for i in range(1, 6)]
+        with mock.patch('book_search.indexing.index_child_pages') as index_child_pages:
+            parent.bulk_save_child_pages(children)
+        index_child_pages.assert_called_once_with(children)
+        self.assertEqual(ChildPage.objects.filter(parent=parent).count(), 5)
+
+    def test_bulk_save_rolled_back_when_indexing_fails(self):
+        parent = ParentDocument.objects.create(filepath='/books/book.pdf')
+        children = [ChildPage(parent=parent, page_number=1, html_content='<p>1</p>',
+                              parent_doc_id=parent.id, parent_filename='book.pdf')]
+        with mock.patch('book_search.indexing.index_child_pages', side_effect=RuntimeError), \
+                mock.patch('book_search.indexing.delete_child_pages_from_index') as delete_from_index:
+            with self.assertRaises(RuntimeError):
+                parent.bulk_save_child_pages(children)
+        self.assertFalse(ChildPage.objects.filter(parent=parent).exists())
+        delete_from_index.assert_called_once_with([children[0].id])
+
+
+# don't index pages created in tests through the django-elasticsearch-dsl signals
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+class TestIncrementalIngest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.doc_file = Path(self.tmpdir.name) / 'book.pdf'
+        self.doc_file.write_bytes(b'version 1')
+        self.parent = ParentDocument.objects.create(filepath=self.doc_file.resolve())
+        self.parent.set_file_stats()
+        self.parent.save()
+        ChildPage.objects.create(parent=self.parent, page_number=1, html_content='<p>1</p>',
+                                 parent_doc_id=self.parent.id, parent_filename='book.pdf')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_unchanged_file_skipped_without_hashing(self):
+        with mock.patch.object(ingest, 'hash_file') as hash_file_mock:
+            changed, unchanged = find_changed_documents([self.doc_file])
+        self.assertEqual((changed, unchanged), ([], 1))
+        hash_file_mock.assert_not_called()
+
+    def test_touched_file_with_same_content_not_converted(self):
+        os.utime(self.doc_file, (0, 0))
+        changed, unchanged = find_changed_documents([self.doc_file])
+        self.assertEqual(changed, [self.doc_file])
+        with mock.patch.object(ParentDocument, 'convert_to_html_child_pages') as convert:
+            status, num_pages, error = ingest.convert_to_child_pages(self.doc_file)
+        self.assertEqual(status, ingest.UNCHANGED)
+        convert.assert_not_called()
+        self.parent.refresh_from_db()
+        self.assertEqual(self.parent.file_mtime, 0)
+
+    def test_missing_file_reported(self):
+        missing = Path(self.tmpdir.name) / 'missing.pdf'
+        changed, unchanged = find_changed_documents([missing])
+        self.assertEqual((changed, unchanged), ([missing], 0))
+        with self.assertLogs('book_search'):
+            status, num_pages, error = ingest.convert_to_child_pages(missing)
+        self.assertEqual((status, error), (ingest.FAILED, 'file does not exist'))
+
+    def test_changed_file_converted(self):
+        self.doc_file.write_bytes(b'version 2')
+        with mock.patch.object(ParentDocument, 'convert_to_html_child_pages', return_value=3) as convert:
+            status, num_pages, error = ingest.convert_to_child_pages(self.doc_file)
+        self.assertEqual((status, num_pages), (ingest.CONVERTED, 3))
+        convert.assert_called_once()
+        self.parent.refresh_from_db()
+        self.assertEqual(self.parent.content_hash, hash_file(self.doc_file))
+
+    def test_delete_child_pages(self):
+        page_ids = list(ChildPage.objects.filter(parent=self.parent).values_list('id', flat=True))
+        with mock.patch('book_search.indexing.delete_child_pages_from_index') as delete_from_index:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.parent.delete_child_pages()
+        self.assertFalse(ChildPage.objects.filter(parent=self.parent).exists())
+        delete_from_index.assert_called_once_with(page_ids)
+
+
+class TestSearchCache(TestCase):
+
+    def setUp(self):
+        caches[settings.SEARCH_CACHE_ALIAS].clear()
+        self.results = (1, [{'parent_doc_id': 1}], {}, False)
+        patcher = mock.patch.object(es, 'collapsed_search', return_value=self.results)
+        self.collapsed_search = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_normalize_query(self):
+        self.assertEqual(es.normalize_query('  Three\tWISDOMS  '), 'three wisdoms')
+
+    def test_cache_hit(self):
+        stats = es.search_cache_stats()
+        self.assertEqual(es.handle_query('three wisdoms'), self.results)
+        self.assertEqual(es.handle_query('Three  Wisdoms'), self.results)
+        self.collapsed_search.assert_called_once_with('match', 'three wisdoms', None)
+        self.assertEqual(es.search_cache_stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(es.search_cache_stats()['misses'], stats['misses'] + 1)
+
+    def test_generation_bump_invalidates(self):
+        es.handle_query('three wisdoms')
+        IndexGeneration.bump()
+        es.handle_query('three wisdoms')
+        self.assertEqual(self.collapsed_search.call_count, 2)
+
+    def test_filters_in_key(self):
+        es.handle_query('three wisdoms')
+        es.handle_query('three wisdoms', {'author': 'Tolkien'})
+        es.handle_query('three wisdoms', {'author': 'Tolkien'})
+        self.assertEqual(self.collapsed_search.call_count, 2)
+        self.collapsed_search.assert_called_with('match', 'three wisdoms', {'author': 'Tolkien'})
+
+
+class TestFacets(SimpleTestCase):
+
+    def test_filters_in_filter_context(self):
+        body = es.collapsed_search_body('match', 'wisdom', {'title': 'The Book', 'author': 'Tolkien'}, facets=True)
+        self.assertEqual(body['query'], {'bool': {
+            'must': [{'match': {'content': {'query': 'wisdom'}}}],
+            'filter': [{'term': {'author': 'Tolkien'}}, {'term': {'title.keyword': 'The Book'}}],
+        }})
+        self.assertEqual(body['aggs']['title']['terms']['field'], 'title.keyword')
+        self.assertEqual(es.collapsed_search_body('match', 'wisdom')['query'],
+                         {'match': {'content': {'query': 'wisdom'}}})
+
+    def test_search_view_facets(self):
+        results = es.shape_collapsed_hits(collapsed_response([3]))
+        facets = {'author': [('Tolkien', 3), ('Lewis', 1)], 'title': [('Title', 4)]}
+        with mock.patch('book_search.views.handle_query', return_value=(1, results, facets, False)) as search:
+            response = self.client.post('/search/', {'query': 'wisdom', 'author': 'Tolkien'})
+        search.assert_called_once_with('wisdom', {'author': 'Tolkien'})
+        self.assertContains(response, '<button type="submit" name="author" value="Lewis">Lewis (1)</button>',
+                            html=True)
+        self.assertContains(response, 'Any author')
+        self.assertContains(response, '<input type="hidden" name="author" value="Tolkien">', html=True)
+
+
+def page_hit(parent_doc_id, page_number, highlights=('a <em>match</em>',)):
+    return {
+        '_source': {'parent_doc_id': parent_doc_id, 'title': 'Title', 'author': 'Author',
+                    'page_number': page_number, 'parent_filename': 'book.pdf'},
+        'highlight': {'content': list(highlights)},
+        'sort': [parent_doc_id],
+    }
+
+
+def collapsed_response(parent_doc_ids, pages_per_book=1, pit_id='pit'):
+    hits = []
+    for parent_doc_id in parent_doc_ids:
+        hit = page_hit(parent_doc_id, 1)
+        hit['inner_hits'] = {'matched_pages': {'hits': {'hits': [
+            page_hit(parent_doc_id, page_number) for page_number in range(1, pages_per_book + 1)]}}}
+        hits.append(hit)
+    total = len(hits) * pages_per_book
+    return {'took': 12, 'timed_out': False, '_shards': {'total': 1, 'failed': 0}, 'pit_id': pit_id,
+            'hits': {'total': {'value': total}, 'hits': hits},
+            'aggregations': {'author': {'buckets': [{'key': 'Author', 'doc_count': total}]},
+                             'title': {'buckets': [{'key': 'Title', 'doc_count': total}]}}}
+
+
+class TestResultShaping(SimpleTestCase):
+
+    def test_same_as_legacy_shaping(self):
+        def as_dict(hit):
+            return {name: as_dict(value) if isinstance(value, es.Hit)
+                    else [as_dict(item) for item in value] if name == 'inner_hits'
+                    else value
+                    for name in hit.__slots__ if (value := getattr(hit, name)) is not None}
+
+        response = canned_response(books=20, pages=3, highlights=4)
+        response['hits']['hits'][0]['inner_hits']['matched_pages']['hits']['hits'][1:] = []
+        expected = legacy_shape_collapsed_hits(response)
+        self.assertEqual([as_dict(hit) for hit in es.shape_collapsed_hits(response)], expected)
+
+    def test_clean_highlight(self):
+        for highlight in ('>a <em>b</em>', ', a b<', 'a b<\n', '”a', 'a b', ''):
+            self.assertEqual(es.clean_highlight(highlight), re.sub(es.EDGE_STRIP_REGEX, '', highlight))
+
+    def test_pickle(self):
+        results = es.shape_collapsed_hits(collapsed_response([3]))
+        results = pickle.loads(pickle.dumps(results))
+        self.assertEqual(results[0].single_inner_hit['highlights'], ['a <em>match</em>'])
+        self.assertIs(results[0].single_inner_hit, results[0].inner_hits[0])
+
+
+class TestSearchPage(SimpleTestCase):
+
+    def setUp(self):
+        self.client_mock = mock.Mock()
+        self.client_mock.options.return_value = self.client_mock
+        self.client_mock.open_point_in_time.return_value = {'id': 'pit'}
+        patcher = mock.patch.object(es, 'get_client', return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_and_last_page(self):
+        self.client_mock.search.return_value = collapsed_response([3, 7], pages_per_book=2)
+        total_hits, results, cursor, partial = es.search_page('match', 'wisdom', size=2)
+        body = self.client_mock.search.call_args.kwargs['body']
+        self.assertEqual(body['pit']['id'], 'pit')
+        self.assertEqual(body['sort'], [{'parent_doc_id': 'asc'}])
+        self.assertNotIn('search_after', body)
+        self.assertEqual([result['parent_doc_id'] for result in results], [3, 7])
+        self.assertEqual(results[0]['inner_hits'][0]['highlight_count'], 1)
+        self.assertEqual(es.decode_cursor(cursor), {'pit': 'pit', 'after': [7]})
+
+        self.client_mock.search.return_value = collapsed_response([9], pit_id='pit2')
+        total_hits, results, cursor, partial = es.search_page('match', 'wisdom', cursor, size=2)
+        self.assertEqual(self.client_mock.search.call_args.kwargs['body']['search_after'], [7])
+        self.assertEqual(cursor, '')
+        self.assertEqual(results[0]['single_inner_hit']['page_number'], 1)
+        self.client_mock.close_point_in_time.assert_called_once_with(id='pit2')
+
+    def test_invalid_cursor(self):
+        for cursor in ('not a cursor', es.encode_cursor({'offset': 5}), es.encode_cursor([1, 2])):
+            with self.assertRaises(ValueError):
+                es.search_page('match', 'wisdom', cursor)
+            with self.assertRaises(ValueError):
+                es.more_book_pages('match', 'wisdom', 3, cursor)
+
+    def test_expired_cursor(self):
+        cursor = es.encode_cursor({'pit': 'pit', 'after': [7]})
+        self.client_mock.search.side_effect = api_error(NotFoundError, 404)
+        with self.assertRaises(es.CursorExpired):
+            es.search_page('match', 'wisdom', cursor)
+        self.client_mock.search.side_effect = api_error(BadRequestError, 400)
+        with self.assertRaises(ValueError):
+            es.more_book_pages('match', 'wisdom', 3, es.encode_cursor({'after': ['made up']}))
+        # not the cursor's fault
+        with self.assertRaises(BadRequestError):
+            es.search_page('match', 'wisdom')
+
+    @override_settings(SEARCH_HIGHLIGHTER='unified')
+    def test_highlighter_setting(self):
+        self.client_mock.search.return_value = collapsed_response([3])
+        es.search_page('match', 'wisdom')
+        body = self.client_mock.search.call_args.kwargs['body']
+        self.assertEqual(body['collapse']['inner_hits']['highlight']['fields']['content'], {'type': 'unified'})
+        self.assertEqual(body['collapse']['inner_hits']['sort'], [{'_score': 'desc'}, {'page_number': 'asc'}])
+        with self.assertRaises(ImproperlyConfigured):
+            content_highlight_options('fast')
+
+
+def api_error(error_class, status: int):
+    return error_class(f'{status} error', ApiResponseMeta(status, '1.1', {}, 0.0, None), {})
+
+
+class TestSearchView(SimpleTestCase):
+
+    def test_paged_search(self):
+        results = es.shape_collapsed_hits(collapsed_response([3], pages_per_book=es.INNER_HITS_SIZE))
+        with mock.patch('book_search.views.handle_query_page', return_value=(5, results, 'next', False)) as search:
+            response = self.client.get('/search/', {'query': 'wisdom', 'cursor': 'abc'})
+        search.assert_called_once_with('wisdom', 'abc', {})
+        self.assertContains(response, '?query=wisdom&cursor=next')
+        self.assertContains(response, '/search/3/?query=wisdom')
+
+    def test_expired_cursor(self):
+        client_mock = mock.Mock()
+        client_mock.options.return_value = client_mock
+        client_mock.search.side_effect = api_error(NotFoundError, 404)
+        with mock.patch.object(es, 'get_client', return_value=client_mock):
+            response = self.client.get('/search/', {'query': 'wisdom',
+                                                    'cursor': es.encode_cursor({'pit': 'gone', 'after': [7]})})
+            self.assertEqual(response.status_code, 410)
+            client_mock.search.side_effect = api_error(BadRequestError, 400)
+            response = self.client.get('/search/3/', {'query': 'wisdom',
+                                                      'cursor': es.encode_cursor({'after': ['made up']})})
+            self.assertEqual(response.status_code, 400)
+
+
+class TestAsyncSearch(SimpleTestCase):
+
+    async def test_async_collapsed_search(self):
+        client_mock = mock.AsyncMock()
+        client_mock.options = mock.Mock(return_value=client_mock)
+        client_mock.search.return_value = collapsed_response([3, 7])
+        with mock.patch.object(es, 'get_async_client', return_value=client_mock):
+            total_hits, results, facets, partial = await es.async_collapsed_search('match_phrase', 'three wisdoms')
+        body = client_mock.search.call_args.kwargs['body']
+        self.assertEqual(body['query'], {'match_phrase': {'content': {'query': 'three wisdoms'}}})
+        self.assertEqual(total_hits, 2)
+        self.assertEqual(facets['author'], [('Author', 2)])
+        self.assertEqual([result['parent_doc_id'] for result in results], [3, 7])
+
+    async def test_search_async_view(self):
+        results = es.shape_collapsed_hits(collapsed_response([3]))
+        with mock.patch('book_search.views.async_handle_query', return_value=(1, results, {}, False)) as search:
+            response = await self.async_client.get('/search/async/', {'query': 'wisdom'})
+        search.assert_awaited_once_with('wisdom', {})
+        self.assertContains(response, '1 hit')
+
+
+class TestSearchApi(SimpleTestCase):
+
+    def setUp(self):
+        self.results = es.shape_collapsed_hits(collapsed_response([3, 7], pages_per_book=2))
+        patcher = mock.patch('book_search.views.handle_query_iter',
+                             return_value=(4, iter(self.results), {'author': [('Author', 4)]}, False))
+        self.handle_query_iter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_search_api(self):
+        response = self.client.get('/api/search/', {'query': 'wisdom'})
+        self.assertTrue(response.streaming)
+        data = json.loads(b''.join(response.streaming_content))
+        self.handle_query_iter.assert_called_once_with('wisdom', {})
+        self.assertEqual(data['total_hits'], 4)
+        self.assertIs(data['partial'], False)
+        self.assertEqual(data['facets'], {'author': [['Author', 4]]})
+        self.assertEqual([result['parent_doc_id'] for result in data['results']], [3, 7])
+        self.assertEqual(data['results'][0]['inner_hits'][1]['highlights'], ['a <em>match</em>'])
+        self.assertNotIn('single_inner_hit', data['results'][0])
+
+    def test_field_selection(self):
+        response = self.client.get('/api/search/', {'query': 'wisdom', 'fields': 'title,inner_hits',
+                                                     'page_fields': 'page_number'})
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data['results'][0], {'title': 'Title',
+                                              'inner_hits': [{'page_number': 1}, {'page_number': 2}]})
+
+    def test_bad_request(self):
+        self.assertEqual(self.client.get('/api/search/').status_code, 400)
+        response = self.client.get('/api/search/', {'query': 'wisdom', 'fields': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestSuggest(TestCase):
+
+    def setUp(self):
+        caches[settings.SEARCH_CACHE_ALIAS].clear()
+        self.client_mock = mock.Mock()
+        self.client_mock.search.return_value = {'took': 1, 'hits': {'hits': [
+            {'_id': '4', '_source': {'title': 'The Three Wisdoms', 'author': 'Tolkien',
+                                     'parent_filename': 'wisdoms.pdf'}}]}}
+        patcher = mock.patch.object(es, 'get_client', return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_suggest_api(self):
+        for _ in range(2):
+            response = self.client.get('/api/suggest/', {'query': 'three wis'})
+            self.assertEqual(response.json()['suggestions'], [
+                {'parent_doc_id': 4, 'title': 'The Three Wisdoms', 'author': 'Tolkien',
+                 'parent_filename': 'wisdoms.pdf'}])
+        self.client_mock.search.assert_called_once()
+        kwargs = self.client_mock.search.call_args.kwargs
+        self.assertEqual(kwargs['index'], 'booksearch_suggest')
+        self.assertEqual(kwargs['body']['query']['multi_match']['type'], 'bool_prefix')
+
+    def test_suggest_doc_indexed_once_per_conversion(self):
+        xhtml = BytesIO(TIKA_DOCUMENT_XHTML.encode('utf-8'))
+        with mock.patch.object(BookSuggestDocument, 'update') as update, \
+                mock.patch('book_search.indexing.index_child_pages'), \
+                mock.patch('book_search.models.tika_xhtml_stream', return_value=nullcontext(xhtml)), \
+                mock.patch('book_search.indexing.get_client') as get_client:
+            with self.captureOnCommitCallbacks(execute=True):
+                parent = ParentDocument.objects.create(filepath='/books/book.pdf')
+                parent.save()
+            update.assert_not_called()
+            with self.captureOnCommitCallbacks(execute=True):
+                parent.convert_to_html_child_pages_streaming()
+            update.assert_called_once_with(parent, refresh=False)
+            # no pages, their ChildPageDocument signals aren't mocked
+            other = ParentDocument.objects.create(filepath='/books/other.pdf')
+            other_id = other.pk
+            with self.captureOnCommitCallbacks(execute=True):
+                other.delete()
+        get_client().options().delete.assert_called_once_with(index='booksearch_suggest', id=other_id)
+
+    def test_short_query(self):
+        response = self.client.get('/api/suggest/', {'query': 't'})
+        self.assertEqual(response.json()['suggestions'], [])
+        self.client_mock.search.assert_not_called()
+
+
+class TestSearchBackends(TestCase):
+
+    def setUp(self):
+        caches[settings.SEARCH_CACHE_ALIAS].clear()
+
+    @override_settings(SEARCH_BACKEND='solr')
+    def test_unknown_backend(self):
+        with self.assertRaises(ImproperlyConfigured):
+            search_backends.get_backend()
+
+    @skipIf(connection.vendor == 'postgresql', 'the backend is available on PostgreSQL')
+    @override_settings(SEARCH_BACKEND='postgres')
+    def test_postgres_needs_postgresql(self):
+        with self.assertRaises(ImproperlyConfigured):
+            search_backends.get_backend()
+
+    @override_settings(SEARCH_BACKEND='postgres')
+    def test_handle_query_uses_backend(self):
+        backend = mock.Mock(search_backends.SearchBackend)
+        backend.name = 'postgres'
+        backend.search.return_value = (1, [], {}, False)
+        with mock.patch.object(search_backends, '_backend', backend):
+            self.assertEqual(es.handle_query('"three wisdoms"', {'author': 'Tolkien'}), (1, [], {}, False))
+        backend.search.assert_called_once_with('match_phrase', 'three wisdoms', {'author': 'Tolkien'})
+
+    def test_postgres_text_query(self):
+        query = search_backends.PostgresBackend.text_query('match', 'three wisdoms')
+        self.assertEqual(query.connector, '||')
+        phrase = search_backends.PostgresBackend.text_query('match_phrase', 'three wisdoms')
+        self.assertEqual(phrase.function, 'phraseto_tsquery')
+
+    def test_postgres_cursor(self):
+        self.assertEqual(search_backends.cursor_position('', 'offset', 5), 5)
+        self.assertEqual(search_backends.cursor_position(es.encode_cursor({'offset': 15}), 'offset', 5), 15)
+        with self.assertRaises(ValueError):
+            search_backends.cursor_position(es.encode_cursor({'pit': 'pit', 'after': [7]}), 'offset', 5)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'full text search needs PostgreSQL')
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False, PAGE_STORAGE='db')
+class TestPostgresBackend(TestCase):
+
+    def setUp(self):
+        search_backends.install_search_vector()
+        self.backend = search_backends.PostgresBackend()
+        self.book = self.create_book('/books/wisdom.pdf', 'Author A', ['wisdom of the ages'] * 7)
+        # the best page, so the book ranks first
+        ChildPage.objects.filter(parent=self.book, page_number=2).update(html_content='<p>wisdom wisdom wisdom</p>')
+        self.other = self.create_book('/books/other.pdf', 'Author B', ['three wisdoms of the sages', 'nothing'])
+
+    @staticmethod
+    def create_book(filepath: str, author: str, texts: [str]) -> ParentDocument:
+        parent = ParentDocument.objects.create(filepath=filepath, author=author, title=Path(filepath).stem)
+        for page_number, text in enumerate(texts, 1):
+            ChildPage.objects.create(parent=parent, page_number=page_number, html_content=f'<p>{text}</p>',
+                                     parent_doc_id=parent.id, parent_filename=Path(filepath).name,
+                                     author=author, title=parent.title)
+        return parent
+
+    def test_setup_needed(self):
+        search_backends.remove_search_vector()
+        self.assertFalse(ChildPage.objects.filter(search_vector__isnull=False).exists())
+        with self.assertRaises(ImproperlyConfigured):
+            search_backends.PostgresBackend()
+        call_command('setup_postgres_search', batch_size=2, stdout=StringIO())
+        self.assertFalse(ChildPage.objects.filter(search_vector__isnull=True).exists())
+
+    def test_search_ranked_by_best_page(self):
+        total_hits, results, facets, partial = self.backend.search('match', 'wisdom')
+        self.assertEqual((total_hits, partial), (8, False))
+        self.assertEqual([result.parent_doc_id for result in results], [self.book.id, self.other.id])
+        self.assertEqual([hit.page_number for hit in results[0].inner_hits], [2, 1, 3, 4, 5])
+        self.assertIn('<em>wisdom</em>', results[0].inner_hits[0].highlights[0])
+        self.assertEqual(results[1].single_inner_hit.page_number, 1)
+        self.assertEqual(facets['author'], [('Author A', 7), ('Author B', 1)])
+
+    def test_phrase_and_filters(self):
+        total_hits, results, facets, partial = self.backend.search('match_phrase', 'three wisdoms')
+        self.assertEqual([result.parent_doc_id for result in results], [self.other.id])
+        total_hits, results, facets, partial = self.backend.search('match', 'wisdom', {'author': 'Author B'})
+        self.assertEqual((total_hits, [result.parent_doc_id for result in results]), (1, [self.other.id]))
+
+    def test_search_page(self):
+        total_hits, results, cursor, partial = self.backend.search_page('match', 'wisdom', size=1)
+        self.assertEqual([result.parent_doc_id for result in results], [self.book.id])
+        total_hits, results, cursor, partial = self.backend.search_page('match', 'wisdom', cursor, size=1)
+        self.assertEqual([result.parent_doc_id for result in results], [self.other.id])
+        total_hits, results, cursor, partial = self.backend.search_page('match', 'wisdom', cursor, size=1)
+        self.assertEqual((results, cursor), ([], ''))
+
+    def test_more_book_pages(self):
+        hits, cursor = self.backend.more_book_pages('match', 'wisdom', self.book.id, size=1)
+        self.assertEqual([hit.page_number for hit in hits], [6])
+        hits, cursor = self.backend.more_book_pages('match', 'wisdom', self.book.id, cursor)
+        self.assertEqual(([hit.page_number for hit in hits], cursor), ([7], ''))
+
+    def test_statement_timeout(self):
+        def slow_facets(pages):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_sleep(1)')
+
+        with mock.patch.object(es, 'search_budget', return_value=0.05), \
+                mock.patch.object(self.backend, 'facets', side_effect=slow_facets), \
+                self.assertLogs('book_search.search_backends'):
+            self.assertEqual(self.backend.search('match', 'wisdom'), (0, [], {}, True))
+
+
+class TestCachedSearchIter(TestCase):
+
+    def test_results_cached_after_streaming(self):
+        caches[settings.SEARCH_CACHE_ALIAS].clear()
+        client_mock = mock.Mock()
+        client_mock.options.return_value = client_mock
+        client_mock.search.return_value = collapsed_response([3, 7])
+        with mock.patch.object(es, 'get_client', return_value=client_mock):
+            total_hits, results, facets, partial = es.cached_search_iter('match', 'wisdom')
+            self.assertEqual(next(results)['parent_doc_id'], 3)
+            self.assertEqual(len(list(results)), 1)
+            total_hits, results, facets, partial = es.cached_search_iter('match', 'wisdom')
+        self.assertEqual(facets['title'], [('Title', 2)])
+        self.assertEqual([result['parent_doc_id'] for result in results], [3, 7])
+        client_mock.search.assert_called_once()
+
+
+class TestBatchSearch(TestCase):
+
+    def setUp(self):
+        caches[settings.SEARCH_CACHE_ALIAS].clear()
+        self.client_mock = mock.Mock()
+        self.client_mock.options.return_value = self.client_mock
+        patcher = mock.patch.object(es, 'get_client', return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_multi_search(self):
+        self.client_mock.msearch.return_value = {'took': 5, 'responses': [
+            collapsed_response([3, 7]),
+            {'error': {'type': 'search_phase_execution_exception', 'reason': 'too many clauses'}, 'status': 400}]}
+        results = es.multi_search([('match', 'wisdom', None), ('match_phrase', 'three wisdoms', {'author': 'A'})])
+        lines = self.client_mock.msearch.call_args.kwargs['body']
+        self.assertEqual(lines[0], {})
+        self.assertEqual(lines[1]['query'], {'match': {'content': {'query': 'wisdom'}}})
+        self.assertEqual(lines[3]['query']['bool']['filter'], [{'term': {'author': 'A'}}])
+        total_hits, books, facets, partial = results[0]
+        self.assertEqual([book['parent_doc_id'] for book in books], [3, 7])
+        self.assertIsInstance(results[1], es.SearchError)
+        self.assertEqual(results[1].status, 400)
+
+    def test_batch_api(self):
+        self.client_mock.msearch.return_value = {'took': 5, 'responses': [
+            collapsed_response([3]), collapsed_response([7], pages_per_book=2)]}
+        searches = ['wisdom', {'query': "'three wisdoms'", 'author': 'Tolkien'}, {'query': ''}, {'query': 'a', 'x': 1}]
+        for _ in range(2):
+            response = self.client.post('/api/search/batch/?fields=parent_doc_id', {'searches': searches},
+                                        content_type='application/json')
+            data = response.json()['searches']
+            self.assertEqual(data[0], {'query': 'wisdom', 'total_hits': 1, 'partial': False,
+                                       'facets': {'author': [['Author', 1]], 'title': [['Title', 1]]},
+                                       'results': [{'parent_doc_id': 3}]})
+            self.assertEqual(data[1]['results'], [{'parent_doc_id': 7}])
+            self.assertEqual(data[2], {'query': '', 'error': 'query is required', 'status': 400})
+            self.assertEqual(data[3]['error'], 'unknown keys: x')
+        self.client_mock.msearch.assert_called_once()
+        self.assertEqual(self.client_mock.msearch.call_args.kwargs['body'][3]['query']['bool']['must'],
+                         [{'match_phrase': {'content': {'query': 'three wisdoms'}}}])
+        self.assertEqual(self.client.get('/api/search/batch/').status_code, 405)
+        self.assertEqual(self.client.post('/api/search/batch/', 'nope', content_type='application/json').status_code,
+                         400)
+
+
+@override_settings(SEARCH_LATENCY_BUDGET={'match': 2.0}, SEARCH_DEADLINE_GRACE=1.0)
+class TestLatencyBudget(TestCase):
+
+    def setUp(self):
+        caches[settings.SEARCH_CACHE_ALIAS].clear()
+        self.client_mock = mock.Mock()
+        self.client_mock.options.return_value = self.client_mock
+        patcher = mock.patch.object(es, 'get_client', return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_budget_applied(self):
+        self.client_mock.search.return_value = collapsed_response([3])
+        self.assertFalse(es.collapsed_search('match', 'wisdom')[3])
+        self.assertEqual(self.client_mock.search.call_args.kwargs['body']['timeout'], '2000ms')
+        self.client_mock.options.assert_called_once_with(request_timeout=3.0, retry_on_timeout=False)
+        es.collapsed_search('match_phrase', 'three wisdoms')
+        self.assertNotIn('timeout', self.client_mock.search.call_args.kwargs['body'])
+
+    def test_timed_out_partial_not_cached(self):
+        response = collapsed_response([3, 7])
+        response['timed_out'] = True
+        self.client_mock.search.return_value = response
+        for _ in range(2):
+            response = self.client.post('/search/', {'query': 'wisdom'})
+            self.assertContains(response, 'these results are incomplete')
+            self.assertEqual(len(response.context['results']), 2)
+        self.assertEqual(self.client_mock.search.call_count, 2)
+
+    def test_deadline(self):
+        self.client_mock.search.side_effect = ConnectionTimeout('timed out')
+        with self.assertLogs('book_search.elasticsearch', 'WARNING'):
+            self.assertEqual(es.collapsed_search('match', 'wisdom'), (0, [], {}, True))
+        self.assertIn('booksearch_search_partial_total{reason="deadline"}', metrics.REGISTRY.render())
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+class TestPageStorage(TestCase):
+
+    def setUp(self):
+        self.parent = ParentDocument.objects.create(filepath='/books/book.pdf')
+        self.html = '<html><body><p>page text</p></body></html>'
+
+    def create_page(self, storage):
+        page = ChildPage(parent=self.parent, page_number=1, parent_doc_id=self.parent.id,
+                         parent_filename='book.pdf')
+        page.set_html(self.html, storage)
+        page.save()
+        return ChildPage.objects.get(pk=page.pk)
+
+    def test_compressed(self):
+        page = self.create_page('compressed')
+        self.assertEqual(page.html_content, '')
+        self.assertEqual(page.html, self.html)
+
+    def test_elasticsearch(self):
+        page = self.create_page('elasticsearch')
+        with mock.patch('book_search.indexing.fetch_html_from_index',
+                        return_value={page.pk: self.html}) as fetch:
+            self.assertEqual(page.html, self.html)
+        fetch.assert_called_once_with([page.pk])
+
+    def test_render_pages_fetched_together(self):
+        pages = [self.create_page('elasticsearch')]
+        pages.append(ChildPage.objects.create(parent=self.parent, page_number=2, parent_doc_id=self.parent.id,
+                                              parent_filename='book.pdf'))
+        with mock.patch('book_search.views.fetch_html_from_index',
+                        return_value={page.pk: self.html for page in pages}) as fetch:
+            rendered = views.render_pages(self.parent.id, [1, 2])
+        fetch.assert_called_once()
+        self.assertCountEqual(fetch.call_args.args[0], [page.pk for page in pages])
+        self.assertEqual(sorted(rendered), [1, 2])
+        self.assertIn('page text', rendered[2][2])
+
+    def test_convert_page_storage(self):
+        page = self.create_page('db')
+        call_command('convert_page_storage', 'compressed', stdout=StringIO())
+        page = ChildPage.objects.get(pk=page.pk)
+        self.assertEqual((page.html_content, page.html), ('', self.html))
+        with mock.patch('book_search.management.commands.convert_page_storage.fetch_html_from_index',
+                        return_value={}):
+            call_command('convert_page_storage', 'elasticsearch', stdout=StringIO())
+        # not dropped from the db when it can't be read back from the index
+        self.assertEqual(ChildPage.objects.get(pk=page.pk).html, self.html)
+        call_command('convert_page_storage', 'db', stdout=StringIO())
+        self.assertEqual(ChildPage.objects.get(pk=page.pk).html_content, self.html)
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+class TestViewPage(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.parent = ParentDocument.objects.create(filepath='/books/book.pdf', converted_at=timezone.now())
+        for page_number in (1, 2, 3):
+            ChildPage.objects.create(parent=cls.parent, page_number=page_number,
+                                     html_content=f'<p>page {page_number} text</p>',
+                                     parent_doc_id=cls.parent.id, parent_filename='book.pdf')
+
+    def setUp(self):
+        caches[settings.PAGE_CACHE_ALIAS].clear()
+
+    def test_view_page(self):
+        response = self.client.get(f'/view/{self.parent.id}/2/')
+        self.assertContains(response, 'page 2 text')
+        self.assertTrue(response.has_header('Last-Modified'))
+        response = self.client.get(f'/view/{self.parent.id}/2/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_adjacent_pages_cached(self):
+        self.client.get(f'/view/{self.parent.id}/2/')
+        # only the index generation is read for each
+        with self.assertNumQueries(2):
+            self.assertContains(self.client.get(f'/view/{self.parent.id}/3/'), 'page 3 text')
+            self.assertContains(self.client.get(f'/view/{self.parent.id}/1/'), 'page 1 text')
+
+    def test_missing_page(self):
+        self.assertEqual(self.client.get(f'/view/{self.parent.id}/9/').status_code, 404)
+
+
+TIKA_DOCUMENT_XHTML = """<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<meta name="dc:creator" content="Cortland Dahl"/>
+<meta name="dc:title" content="The Three Wisdoms"/>
+<title>The Three Wisdoms</title>
+</head>
+<body><div class="page"><p>First  page\xa0 text 
+more</p>
+<p/>
+</div>
+<div class="page"><p>Second page</p>
+<div class="annotation"><a href="http://example.com">link</a></div>
+</div>
+<div class="page"><p>Third &amp; last page</p>
+</div>
+</body></html>"""
+
+
+class TestStreamingPages(SimpleTestCase):
+
+    def test_same_pages_as_whole_document(self):
+        soup = BeautifulSoup(TIKA_DOCUMENT_XHTML, features='lxml')
+        expected = [page_to_html(div) for div in soup.find_all('div', attrs={'class': 'page'})]
+        metadata = {}
+        pages = list(iter_xhtml_pages(BytesIO(TIKA_DOCUMENT_XHTML.encode('utf-8')), metadata))
+        self.assertEqual(pages, expected)
+        self.assertEqual(metadata, {'dc:creator': 'Cortland Dahl', 'dc:title': 'The Three Wisdoms'})
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False, INGEST_BULK_BATCH_SIZE=2)
+class TestStreamingConversion(TestCase):
+
+    @contextmanager
+    def tika_stream(self, filepath, endpoint=''):
+        yield BytesIO(TIKA_DOCUMENT_XHTML.encode('utf-8'))
+
+    def test_convert_streaming(self):
+        parent = ParentDocument.objects.create(filepath='/books/book.pdf')
+        with mock.patch('book_search.models.tika_xhtml_stream', self.tika_stream), \
+                mock.patch('book_search.indexing.index_child_pages') as index_child_pages:
+            num_pages = parent.convert_to_html_child_pages_streaming()
+        self.assertEqual(num_pages, 3)
+        self.assertEqual(index_child_pages.call_count, 2)
+        pages = ChildPage.objects.filter(parent=parent).order_by('page_number')
+        self.assertEqual([page.is_last_page for page in pages], [False, False, True])
+        self.assertEqual({(page.author, page.title) for page in pages}, {('Cortland Dahl', 'The Three Wisdoms')})
+        self.assertIn('Third &amp; last page', pages[2].html)
+        self.assertEqual({page.ocr_status for page in pages}, {''})
+
+
+def ocr_xhtml(*pages) -> str:
+    return ('<html xmlns="http://www.w3.org/1999/xhtml"><head></head><body>'
+            + ''.join(f'<div class="page"><p>{page}</p></div>' for page in pages) + '</body></html>')
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+class TestOcr(TestCase):
+
+    def setUp(self):
+        self.parent = ParentDocument.objects.create(filepath='/books/scanned.pdf')
+        for page_number, text in enumerate(['First page text', ' ', 'Third page text'], 1):
+            page = ChildPage(parent=self.parent, page_number=page_number, parent_doc_id=self.parent.id,
+                             parent_filename='scanned.pdf')
+            page.set_html(f'<html><body><p>{text}</p></body></html>')
+            page.queue_ocr_if_textless()
+            page.save()
+        self.xhtml = ocr_xhtml('First page text', 'Scanned page text', 'Third page text')
+        self.requests = []
+
+    @contextmanager
+    def ocr_stream(self, filepath, endpoint='', headers=None, timeout=None):
+        self.requests.append((endpoint, headers))
+        yield BytesIO(self.xhtml.encode('utf-8'))
+
+    def pages(self) -> dict:
+        return {page.page_number: page for page in ChildPage.objects.filter(parent=self.parent)}
+
+    def test_textless_pages_queued(self):
+        self.assertEqual({number: page.ocr_status for number, page in self.pages().items()},
+                         {1: '', 2: OCR_PENDING, 3: ''})
+        ChildPage.objects.update(ocr_status='')
+        self.assertEqual(ocr.queue_textless_pages(batch_size=2), 1)
+        self.assertEqual(ocr.pending_documents(), [self.parent.id])
+
+    def test_only_queued_pages_updated(self):
+        with mock.patch('book_search.ocr.tika_xhtml_stream', self.ocr_stream), \
+                mock.patch('book_search.ocr.index_child_pages') as index_child_pages:
+            results = list(ocr.ocr_pending_pages(workers=1))
+        self.assertEqual(results, [(self.parent, 1, 1, '')])
+        self.assertEqual(self.requests, [(settings.OCR_TIKA_ENDPOINTS[0], settings.OCR_TIKA_HEADERS)])
+        pages = self.pages()
+        self.assertEqual(pages[2].ocr_status, OCR_DONE)
+        self.assertIn('Scanned page text', pages[2].html)
+        self.assertEqual(pages[1].ocr_status, '')
+        index_child_pages.assert_called_once_with([pages[2]])
+        self.assertEqual(ocr.pending_documents(), [])
+
+    def test_page_count_mismatch_fails(self):
+        self.xhtml = ocr_xhtml('First page text', 'Scanned page text')
+        with mock.patch('book_search.ocr.tika_xhtml_stream', self.ocr_stream), self.assertLogs('book_search.ocr'):
+            [(parent, queued, with_text, error)] = ocr.ocr_pending_pages(workers=1)
+        self.assertIn('found 2 pages, expected 3', error)
+        self.assertEqual(self.pages()[2].ocr_status, OCR_FAILED)
+        self.assertEqual(ocr.requeue_failed(), 1)
+
+    def test_indexing_error_fails_document(self):
+        with mock.patch('book_search.ocr.tika_xhtml_stream', self.ocr_stream), \
+                mock.patch('book_search.ocr.index_child_pages', side_effect=RuntimeError('bulk failed')), \
+                self.assertLogs('book_search.ocr'):
+            [(parent, queued, with_text, error)] = ocr.ocr_pending_pages(workers=1)
+        self.assertEqual((queued, with_text), (1, 0))
+        self.assertIn('bulk failed', error)
+        page = self.pages()[2]
+        self.assertEqual(page.ocr_status, OCR_FAILED)
+        self.assertNotIn('Scanned page text', page.html)
+
+
+class TestStubTika(SimpleTestCase):
+
+    def test_document_xhtml(self):
+        metadata = {}
+        xhtml = document_xhtml({'seed': 1, 'pages': 3, 'words': 50})
+        pages = list(iter_xhtml_pages(BytesIO(xhtml.encode('utf-8')), metadata))
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(metadata['dc:title'], 'Document 1')
+
+    def test_stub_server(self):
+        with StubTikaServer() as stub:
+            response = requests.put(f'{stub.endpoint}/tika', data=b'{"seed": 1, "pages": 2, "words": 10}')
+        self.assertEqual(response.text.count('<div class="page">'), 2)
+
+
+class TestMetrics(SimpleTestCase):
+
+    def test_histogram(self):
+        registry = metrics.MetricsRegistry()
+        histogram = registry.histogram('test_seconds', 'Test.', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+        ])
+
+    def test_merge_snapshot(self):
+        registry, worker = metrics.MetricsRegistry(), metrics.MetricsRegistry()
+        for each in (registry, worker):
+            each.counter('test_total', 'Test.').inc(status='ok')
+            each.histogram('test_seconds', 'Test.').observe(1)
+        registry.merge(json.loads(json.dumps(worker.snapshot())))
+        self.assertEqual(registry.summary(), [('test_total{status="ok"}', 2, None, None),
+                                              ('test_seconds', 2, 2.0, 1.0)])
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False, TIKA_CONFIG_FILE=None)
+class TestIngestMetrics(TestCase):
+
+    def test_ingest_metrics(self):
+        with TemporaryDirectory() as tmp_dir, StubTikaServer() as stub, \
+                mock.patch('tika.tika.TikaClientOnly', True):
+            generate_corpus(tmp_dir, documents=2, pages=3, words=20)
+            metrics_file = Path(tmp_dir) / 'ingest.prom'
+            stdout = StringIO()
+            with override_settings(TIKA_SERVER_ENDPOINT=stub.endpoint, INGEST_METRICS_FILE=str(metrics_file)):
+                call_command('convert_to_html_and_index', input_dir=tmp_dir, stdout=stdout)
+                response = self.client.get('/metrics/')
+            exported = metrics_file.read_text()
+        self.assertIn('tika_parse_seconds', stdout.getvalue())
+        self.assertIn('booksearch_ingest_pages_total 6', exported)
+        self.assertIn('booksearch_ingest_documents_total{status="converted"} 2', exported)
+        self.assertIn('booksearch_ingest_page_clean_seconds_count 6', exported)
+        self.assertIn('booksearch_ingest_pages_per_document_sum 6', response.content.decode())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+                           'search': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class TestSearchTiming(TestCase):
+
+    def setUp(self):
+        self.client_mock = mock.Mock()
+        self.client_mock.options.return_value = self.client_mock
+        self.client_mock.search.return_value = collapsed_response([3, 7])
+        patcher = mock.patch.object(es, 'get_client', return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_server_timing(self):
+        response = self.client.post('/search/', {'query': 'three wisdoms'})
+        phases = dict(re.findall(r'(\w+);dur=([\d.]+)', response['Server-Timing']))
+        self.assertEqual(set(phases), {'cache', 'es', 'network', 'shape', 'render', 'total'})
+        self.assertEqual(phases['es'], '12.0')
+
+    def test_slow_query_logged(self):
+        with override_settings(SEARCH_SLOW_QUERY_MS=0), self.assertLogs('book_search.views', 'WARNING') as logs:
+            self.client.get('/api/search/', {'query': 'three wisdoms'})
+        self.assertIn("query: 'three wisdoms'", logs.output[0])
+        self.assertIn('es=12ms', logs.output[0])
+
+    def test_phase_histograms(self):
+        self.client.post('/search/', {'query': 'three wisdoms'})
+        self.assertIn('booksearch_search_phase_seconds_count{phase="es"}', metrics.REGISTRY.render())
+
+
+@override_settings(TIKA_RETRY_BACKOFF=0, TIKA_PARSE_MAX_RETRY=3, TIKA_SERVER_ENDPOINTS=['http://a', 'http://b'],
+                   TIKA_DISPATCH='round_robin')
+class TestTikaServers(SimpleTestCase):
+
+    def test_round_robin(self):
+        pool = tika_servers.TikaServerPool(['http://a', 'http://b'])
+        self.assertEqual([pool.choose() for _ in range(3)], [0, 1, 0])
+
+    def test_least_busy(self):
+        pool = tika_servers.TikaServerPool(['http://a', 'http://b', 'http://c'], tika_servers.LEAST_BUSY)
+        first, second = pool.choose(), pool.choose()
+        pool.release(first)
+        self.assertEqual(sorted([first, second, pool.choose()]), [0, 1, 2])
+        self.assertEqual(pool.choose(), first)
+
+    def test_failover(self):
+        def parse(endpoint):
+            if endpoint == 'http://a':
+                raise requests.ConnectionError('refused')
+            return endpoint
+
+        pool = tika_servers.get_pool()
+        pool.state['next'].value = 0
+        with mock.patch.object(pool, 'probe', return_value=False) as probe:
+            self.assertEqual(tika_servers.call_with_retries(parse), 'http://b')
+            # a is skipped until it is due for a health check
+            self.assertEqual(tika_servers.call_with_retries(parse), 'http://b')
+        probe.assert_not_called()
+        self.assertGreater(pool.state['unhealthy_until'][0], 0)
+
+    def test_bounded_retries(self):
+        parse = mock.Mock(side_effect=tika_servers.TikaParseError('Tika returned status 503', 503))
+        with self.assertRaises(tika_servers.TikaParseError):
+            tika_servers.call_with_retries(parse)
+        self.assertEqual(parse.call_count, 3)
+
+    def test_file_errors_not_retried(self):
+        parse = mock.Mock(side_effect=tika_servers.TikaParseError('Tika returned status 422', 422))
+        with self.assertRaises(tika_servers.TikaParseError):
+            tika_servers.call_with_retries(parse)
+        self.assertEqual(parse.call_count, 1)
+
+
+@override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False, TIKA_CONFIG_FILE=None, TIKA_RETRY_BACKOFF=0)
+class TestTikaFailover(TestCase):
+
+    def test_convert_fails_over(self):
+        with TemporaryDirectory() as tmp_dir, StubTikaServer() as stub, \
+                mock.patch('tika.tika.TikaClientOnly', True):
+            doc_files = generate_corpus(tmp_dir, documents=2, pages=3, words=20)
+            for doc_file, stream in zip(doc_files, (False, True)):
+                # nothing listens on port 9
+                with override_settings(TIKA_SERVER_ENDPOINTS=['http://127.0.0.1:9', stub.endpoint]):
+                    tika_servers.get_pool().state['next'].value = 0
+                    parent = ParentDocument.objects.create(filepath=str(doc_file))
+                    if stream:
+                        num_pages = parent.convert_to_html_child_pages_streaming()
+                    else:
+                        num_pages = parent.convert_to_html_child_pages()
+                self.assertEqual(num_pages, 3)
+
+
+class TestVersionedIndex(SimpleTestCase):
+
+    def setUp(self):
+        self.client_mock = mock.MagicMock()
+        patcher = mock.patch.object(indexing, 'get_client', return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_create_next_version(self):
+        self.client_mock.indices.get.return_value = {'booksearch_v2': {}, 'booksearch_v10': {},
+                                                     'booksearch_v3_old': {}}
+        self.assertEqual(indexing.versioned_indices('booksearch'), ['booksearch_v2', 'booksearch_v10'])
+        connection = mock.MagicMock()
+        with mock.patch.object(type(indexing.ChildPageDocument._index), '_get_connection', return_value=connection):
+            self.assertEqual(indexing.create_versioned_index('booksearch'), 'booksearch_v11')
+        create = connection.indices.create.call_args.kwargs
+        self.assertEqual(create['index'], 'booksearch_v11')
+        self.assertEqual(create['body']['settings']['number_of_replicas'], 0)
+        self.assertEqual(create['body']['settings']['refresh_interval'], '-1')
+        self.assertIn('content', create['body']['mappings']['properties'])
+
+    def test_create_index_for_highlighter(self):
+        connection = mock.MagicMock()
+        with mock.patch.object(type(indexing.ChildPageDocument._index), '_get_connection', return_value=connection):
+            indexing.create_index('booksearch_highlight_fvh', 'fvh')
+            content = connection.indices.create.call_args.kwargs['body']['mappings']['properties']['content']
+            self.assertEqual(content['term_vector'], 'with_positions_offsets')
+            self.assertNotIn('index_options', content)
+
+            indexing.create_index('booksearch_highlight_unified', 'unified')
+            content = connection.indices.create.call_args.kwargs['body']['mappings']['properties']['content']
+            self.assertEqual(content['index_options'], 'offsets')
+            self.assertNotIn('term_vector', content)
+
+    def test_swap_alias(self):
+        self.client_mock.indices.exists_alias.return_value = True
+        self.client_mock.indices.get_alias.return_value = {'booksearch_v1': {}}
+        self.assertEqual(indexing.swap_alias('booksearch_v2', 'booksearch'), ['booksearch_v1'])
+        self.client_mock.indices.update_aliases.assert_called_once_with(actions=[
+            {'remove': {'index': 'booksearch_v1', 'alias': 'booksearch'}},
+            {'add': {'index': 'booksearch_v2', 'alias': 'booksearch'}},
+        ])
+
+    def test_swap_replaces_plain_index(self):
+        self.client_mock.indices.exists_alias.return_value = False
+        self.client_mock.indices.exists.return_value = True
+        indexing.swap_alias('booksearch_v1', 'booksearch')
+        self.client_mock.indices.update_aliases.assert_called_once_with(actions=[
+            {'remove_index': {'index': 'booksearch'}},
+            {'add': {'index': 'booksearch_v1', 'alias': 'booksearch'}},
+        ])
+
+
+class TestFillIndex(TestCase):
+
+    @override_settings(ELASTICSEARCH_DSL_AUTOSYNC=False)
+    def setUp(self):
+        parent = ParentDocument.objects.create(filepath='/books/book.pdf')
+        for page_number, storage in enumerate(('db', 'elasticsearch'), 1):
+            page = ChildPage(parent=parent, page_number=page_number, parent_doc_id=parent.id,
+                             parent_filename='book.pdf')
+            page.set_html(f'<p>page {page_number}</p>', storage)
+            page.save()
+
+    @override_settings(INGEST_BULK_IN_FLIGHT=1)
+    def test_fill_index(self):
+        def streaming_bulk(client, actions, **kwargs):
+            self.actions = list(actions)
+            return [(True, action) for action in self.actions]
+
+        with mock.patch.object(indexing, 'streaming_bulk', streaming_bulk), \
+                mock.patch.object(indexing, 'fetch_html_from_index',
+                                  side_effect=lambda ids: {page_id: '<p>from es</p>' for page_id in ids}) as fetch:
+            self.assertEqual(indexing.fill_index('booksearch_v2'), 2)
+        fetch.assert_called_once()
+        self.assertEqual({action['_index'] for action in self.actions}, {'booksearch_v2'})
+        self.assertEqual([action['_source']['content'] for action in self.actions],
+                         ['<p>page 1</p>', '<p>from es</p>'])
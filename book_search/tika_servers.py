@@ -0,0 +1,199 @@
+"""Dispatch of parse requests over a pool of Tika servers.
+
+Requests go to one of settings.TIKA_SERVER_ENDPOINTS, chosen round robin or
+least busy (settings.TIKA_DISPATCH).  A server that refuses connections or
+times out is skipped for settings.TIKA_HEALTH_CHECK_INTERVAL seconds, then
+probed before it is used again.  The pool's state is in shared memory, so
+worker processes forked by a parallel ingest dispatch over the same counts.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+
+import requests
+import urllib3
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+ROUND_ROBIN, LEAST_BUSY = 'round_robin', 'least_busy'
+# seconds to wait for a health probe
+HEALTH_CHECK_TIMEOUT = 5
+# errors reaching a server or reading its response, as opposed to the server failing to parse the file
+SERVER_ERRORS = (requests.ConnectionError, requests.Timeout, urllib3.exceptions.HTTPError)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class TikaParseError(RuntimeError):
+    """Raised when the conversion of a document into html by Tika fails.
+
+    :param status - the http status Tika returned, if it returned one
+    """
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retryable(self) -> bool:
+        # 4xx means Tika can't parse this file (eg 422 for encrypted or corrupt documents),
+        # another server won't do better
+        return self.status is None or not 400 <= self.status < 500
+
+
+class TikaServerPool:
+    """A set of Tika endpoints, with per-endpoint in flight request counts and health.
+
+    :param endpoints - Tika server urls
+    :param dispatch - ROUND_ROBIN or LEAST_BUSY
+    :param shared_state - from create_shared_state, to share dispatch state
+        with forked processes.  Created here if not given.
+    """
+
+    def __init__(self, endpoints: [str], dispatch: str = ROUND_ROBIN, shared_state=None):
+        if not endpoints:
+            raise ValueError('No Tika server endpoints')
+        if dispatch not in (ROUND_ROBIN, LEAST_BUSY):
+            raise ValueError(f'Unknown Tika dispatch: {dispatch}')
+        self.endpoints = list(endpoints)
+        self.dispatch = dispatch
+        self.state = shared_state or self.create_shared_state(len(self.endpoints))
+
+    @staticmethod
+    def create_shared_state(num_endpoints: int, context=multiprocessing):
+        """Shared memory for dispatch: the next round robin index, in flight counts and unhealthy until times.
+
+        Create it before forking worker processes and pass it to their pools.
+        """
+        return {
+            'lock': context.Lock(),
+            'next': context.Value('i', 0, lock=False),
+            'in_flight': context.Array('i', num_endpoints, lock=False),
+            # time.time() until which the endpoint is skipped, 0 if healthy
+            'unhealthy_until': context.Array('d', num_endpoints, lock=False),
+        }
+
+    def choose(self) -> int:
+        """Choose a server for a request and count it as in flight.
+
+        Servers marked unhealthy are skipped until their retry time, then
+        probed.  If none is available the one due to be retried first is used
+        anyway, so a request never waits on the pool.
+        """
+        while True:
+            with self.state['lock']:
+                start = self.state['next'].value
+                self.state['next'].value = (start + 1) % len(self.endpoints)
+                order = [(start + offset) % len(self.endpoints) for offset in range(len(self.endpoints))]
+                unhealthy_until = self.state['unhealthy_until']
+                now = time.time()
+                available = [index for index in order if unhealthy_until[index] <= now]
+                if self.dispatch == LEAST_BUSY:
+                    available.sort(key=lambda index: self.state['in_flight'][index])
+                if not available:
+                    index = min(order, key=lambda index: unhealthy_until[index])
+                elif not unhealthy_until[available[0]]:
+                    index = available[0]
+                else:
+                    index = None
+                if index is not None:
+                    self.state['in_flight'][index] += 1
+                    return index
+            # due to be retried, probed without holding the lock
+            self.probe(available[0])
+
+    def release(self, index: int):
+        with self.state['lock']:
+            self.state['in_flight'][index] -= 1
+
+    def mark_unhealthy(self, index: int):
+        logger.warning('Tika server unavailable, skipping it for %ss: %s',
+                       settings.TIKA_HEALTH_CHECK_INTERVAL, self.endpoints[index])
+        with self.state['lock']:
+            self.state['unhealthy_until'][index] = time.time() + settings.TIKA_HEALTH_CHECK_INTERVAL
+
+    def probe(self, index: int) -> bool:
+        """Check the server answers, and record whether it is healthy."""
+        try:
+            healthy = requests.get(f'{self.endpoints[index]}/tika', timeout=HEALTH_CHECK_TIMEOUT).ok
+        except requests.RequestException:
+            healthy = False
+        with self.state['lock']:
+            self.state['unhealthy_until'][index] = (
+                0 if healthy else time.time() + settings.TIKA_HEALTH_CHECK_INTERVAL)
+        return healthy
+
+    def check_health(self) -> [str]:
+        """Probe every server, returning the endpoints of those that are down."""
+        return [self.endpoints[index] for index in range(len(self.endpoints)) if not self.probe(index)]
+
+
+def configured_endpoints() -> [str]:
+    return list(settings.TIKA_SERVER_ENDPOINTS) or [settings.TIKA_SERVER_ENDPOINT]
+
+
+def get_pool() -> TikaServerPool:
+    """Return this process's pool of the configured Tika servers."""
+    global _pool
+    endpoints = configured_endpoints()
+    if _pool is None or _pool.endpoints != endpoints or _pool.dispatch != settings.TIKA_DISPATCH:
+        with _pool_lock:
+            _pool = TikaServerPool(endpoints, settings.TIKA_DISPATCH)
+    return _pool
+
+
+def use_shared_state(shared_state):
+    """Make this process's pool use dispatch state created by TikaServerPool.create_shared_state."""
+    global _pool
+    _pool = TikaServerPool(configured_endpoints(), settings.TIKA_DISPATCH, shared_state)
+
+
+def call_with_retries(parse, lock=None, description: str = '', pool: TikaServerPool = None):
+    """Call parse(endpoint) with a server from the pool, retrying on another server if it fails.
+
+    Tries up to settings.TIKA_PARSE_MAX_RETRY times, waiting
+    settings.TIKA_RETRY_BACKOFF seconds before the first retry and doubling
+    the wait each time.  Servers that can't be reached or time out are marked
+    unhealthy.  A TikaParseError for a 4xx status is not retried.
+
+    :param parse - called with the endpoint url, raises TikaParseError or one
+        of SERVER_ERRORS on failure
+    :param lock - optional lock or semaphore held during each attempt, not while waiting to retry
+    :param description - what is being parsed, for logging
+    :param pool - servers to use, default get_pool()
+    :return parse's return value
+    """
+    pool = pool or get_pool()
+    attempts = max(1, settings.TIKA_PARSE_MAX_RETRY)
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(settings.TIKA_RETRY_BACKOFF * 2 ** (attempt - 1))
+        if lock is not None:
+            lock.acquire()
+        index = pool.choose()
+        endpoint = pool.endpoints[index]
+        try:
+            result = parse(endpoint)
+        except SERVER_ERRORS as error:
+            metrics.TIKA_REQUESTS.inc(endpoint=endpoint, outcome='unavailable')
+            pool.mark_unhealthy(index)
+            last_error = TikaParseError(f'{endpoint}: {error!r}')
+        except TikaParseError as error:
+            metrics.TIKA_REQUESTS.inc(endpoint=endpoint, outcome='error')
+            if not error.retryable:
+                raise
+            last_error = error
+        else:
+            metrics.TIKA_REQUESTS.inc(endpoint=endpoint, outcome='ok')
+            return result
+        finally:
+            pool.release(index)
+            if lock is not None:
+                lock.release()
+        logger.warning('Tika attempt %s of %s failed: %s %s', attempt + 1, attempts, last_error, description)
+    raise TikaParseError(f'failed after {attempts} attempts, last error: {last_error}', last_error.status)
@@ -6,6 +6,18 @@ urlpatterns = [
 
     path('', views.home, name='home'),
     path('search/', views.search, name='search'),
+    # async search for ASGI deployments, GET ?query=
+    path('search/async/', views.search_async, name='search-async'),
+    # json search results, GET ?query=
+    path('api/search/', views.search_api, name='search-api'),
+    # json results of many searches in one request, POST {"searches": [...]}
+    path('api/search/batch/', views.search_batch_api, name='search-batch-api'),
+    # title and author suggestions as the query is typed, GET ?query=
+    path('api/suggest/', views.suggest_api, name='suggest-api'),
+    # further matching pages in one book
+    path('search/<int:document>/', views.book_matches, name='book-matches'),
     # enables viewing the content of a book
     path('view/<int:document>/<int:page>/', views.view_page, name='view-page'),
+    # Prometheus metrics
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
@@ -1,8 +1,77 @@
+from functools import wraps
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag, urlencode
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
+from . import metrics
 from .forms import SearchForm
-from .elasticsearch import handle_query
-from .models import ChildPage
+from .elasticsearch import (FACET_FIELDS, INNER_HITS_SIZE, CursorExpired, SearchError, async_handle_query,
+                            cached_suggest, handle_queries, handle_query, handle_query_iter, handle_query_page,
+                            parse_query)
+from .indexing import fetch_html_from_index
+from .models import ChildPage, IndexGeneration
+from .search_backends import get_backend
+
+logger = logging.getLogger(__name__)
+
+
+def timed_search_view(view):
+    """Time a search view's phases, see metrics.record_phase.
+
+    The phases are returned in a Server-Timing header and recorded in the
+    search metrics, and searches slower than settings.SEARCH_SLOW_QUERY_MS are
+    logged.  Streamed responses are timed until their headers are sent.
+    """
+    def finish(request, response, phases, start):
+        total = time.perf_counter() - start
+        metrics.SEARCH_REQUEST_SECONDS.observe(total, view=view.__name__)
+        response['Server-Timing'] = metrics.server_timing(phases, total)
+        if total * 1000 >= settings.SEARCH_SLOW_QUERY_MS:
+            query = request.GET.get('query') or request.POST.get('query', '')
+            logger.warning('slow search: %s %.0fms query: %r %s', view.__name__, total * 1000, query,
+                           ' '.join(f'{phase}={seconds * 1000:.0f}ms' for phase, seconds in phases.items()))
+        return response
+
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            start = time.perf_counter()
+            with metrics.collect_phases() as phases:
+                response = await view(request, *args, **kwargs)
+            return finish(request, response, phases, start)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        start = time.perf_counter()
+        with metrics.collect_phases() as phases:
+            response = view(request, *args, **kwargs)
+        return finish(request, response, phases, start)
+    return wrapper
+
+
+def timed_render(*args, **kwargs):
+    """render, recording the time as the render phase of a search."""
+    with metrics.timed_phase('render'):
+        return render(*args, **kwargs)
+
+
+def selected_facets(data) -> dict:
+    """Facet name to the selected value, from form data or GET parameters."""
+    return {name: data[name] for name in FACET_FIELDS if data.get(name)}
 
 
 def home(request):
@@ -11,33 +80,321 @@ def home(request):
 
 
 # todo should be GET
+@timed_search_view
 def search(request):
     if request.method == 'POST':
         form = SearchForm(request.POST)
         if form.is_valid():
             query = form.cleaned_data
-            total_hits, results = handle_query(query['query'])
+            filters = selected_facets(query)
+            total_hits, results, facets, partial = handle_query(query['query'], filters)
+
+            return timed_render(request, "book_search/search.html",
+                                {'form': form,
+                                 'query': query['query'],
+                                 'filters': filters,
+                                 'filter_params': urlencode(filters),
+                                 'facets': facets,
+                                 'total_hits': total_hits,
+                                 'partial': partial,
+                                 'results': results,
+                                 'inner_hits_size': INNER_HITS_SIZE})
+
+    elif 'query' in request.GET:
+        # paging through all results with the cursor from the previous page
+        form = SearchForm(request.GET)
+        if form.is_valid():
+            query = form.cleaned_data
+            filters = selected_facets(query)
+            try:
+                total_hits, results, next_cursor, partial = handle_query_page(
+                    query['query'], request.GET.get('cursor', ''), filters)
+            except CursorExpired:
+                return HttpResponse('Cursor expired, search again', status=410)
+            except ValueError:
+                return HttpResponseBadRequest('Invalid cursor')
 
-            return render(request, "book_search/search.html",
-                          {'form': form,
-                           'total_hits': total_hits,
-                           'results': results})
+            return timed_render(request, "book_search/search.html",
+                                {'form': form,
+                                 'query': query['query'],
+                                 'filters': filters,
+                                 'filter_params': urlencode(filters),
+                                 'total_hits': total_hits,
+                                 'partial': partial,
+                                 'results': results,
+                                 'inner_hits_size': INNER_HITS_SIZE,
+                                 'paged': True,
+                                 'next_cursor': next_cursor})
 
     else:
         form = SearchForm()
 
-    return render(request, "book_search/search.html",
-                  {'form': form,
-                   'results': ''})
+    return timed_render(request, "book_search/search.html",
+                        {'form': form,
+                         'results': ''})
+
+
+@timed_search_view
+async def search_async(request):
+    """Same results as the search form, served without blocking a worker on ES.
+
+    Run under ASGI (config.asgi) so many searches can be in flight per worker.
+    Takes the query as a GET parameter.
+    """
+    form = SearchForm(request.GET or None)
+    if form.is_valid():
+        query = form.cleaned_data
+        filters = selected_facets(query)
+        total_hits, results, facets, partial = await async_handle_query(query['query'], filters)
+        return timed_render(request, "book_search/search.html",
+                            {'form': form,
+                             'query': query['query'],
+                             'filters': filters,
+                             'filter_params': urlencode(filters),
+                             'facets': facets,
+                             'total_hits': total_hits,
+                             'partial': partial,
+                             'results': results,
+                             'inner_hits_size': INNER_HITS_SIZE})
+
+    return timed_render(request, "book_search/search.html",
+                        {'form': SearchForm(),
+                         'results': ''})
+
+
+# fields of each result and of each of its inner hits returned by search_api
+API_FIELDS = ('parent_doc_id', 'parent_filename', 'title', 'author', 'num_inner_hits', 'inner_hits')
+API_PAGE_FIELDS = ('parent_doc_id', 'title', 'author', 'page_number', 'highlights', 'highlight_count')
+
+
+def select_fields(result: dict, fields, page_fields) -> dict:
+    selected = {field: result[field] for field in fields if field != 'inner_hits'}
+    if 'inner_hits' in fields:
+        selected['inner_hits'] = [{field: inner_hit[field] for field in page_fields}
+                                  for inner_hit in result['inner_hits']]
+    return selected
+
+
+def requested_fields(request):
+    """The result and inner hit fields selected by the fields and page_fields GET parameters.
+
+    :return (fields, page_fields, unknown fields)
+    """
+    fields = request.GET.get('fields', '')
+    fields = [field for field in fields.split(',') if field] or API_FIELDS
+    page_fields = request.GET.get('page_fields', '')
+    page_fields = [field for field in page_fields.split(',') if field] or API_PAGE_FIELDS
+    return fields, page_fields, set(fields) - set(API_FIELDS) | set(page_fields) - set(API_PAGE_FIELDS)
+
+
+@timed_search_view
+def search_api(request):
+    """JSON search results, streamed one book at a time.
+
+    GET parameters:
+        query - as in the search form
+        fields - optional comma separated result fields, default API_FIELDS
+        page_fields - optional comma separated inner hit fields, default API_PAGE_FIELDS,
+            eg leave out highlights to cut the payload size
+        author, title - optional facet values to narrow the results to
+
+    partial is true if the search ran out of its latency budget and the
+    results are incomplete, see settings.SEARCH_LATENCY_BUDGET.
+    """
+    query = request.GET.get('query', '').strip()
+    if not query:
+        return JsonResponse({'error': 'query is required'}, status=400)
+    fields, page_fields, unknown = requested_fields(request)
+    if unknown:
+        return JsonResponse({'error': f'unknown fields: {", ".join(sorted(unknown))}'}, status=400)
+
+    total_hits, results, facets, partial = handle_query_iter(query, selected_facets(request.GET))
+
+    def stream():
+        yield (f'{{"query": {json.dumps(query)}, "total_hits": {total_hits}, "partial": {json.dumps(partial)}, '
+               f'"facets": {json.dumps(facets)}, "results": [')
+        for i, result in enumerate(results):
+            yield (',' if i else '') + json.dumps(select_fields(result, fields, page_fields))
+        yield ']}'
+
+    return StreamingHttpResponse(stream(), content_type='application/json')
+
+
+def batch_search(search) -> (str, dict):
+    """The query and filters of a search in a batch, a query string or an object with query, author and title.
+
+    Raises ValueError if it isn't valid.
+    """
+    if isinstance(search, str):
+        search = {'query': search}
+    if not isinstance(search, dict):
+        raise ValueError('search must be a query or an object')
+    query = search.get('query')
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError('query is required')
+    unknown = set(search) - {'query', *FACET_FIELDS}
+    if unknown:
+        raise ValueError(f'unknown keys: {", ".join(sorted(unknown))}')
+    filters = selected_facets(search)
+    if not all(isinstance(value, str) for value in filters.values()):
+        raise ValueError('facet values must be strings')
+    return query.strip(), filters
+
+
+# it only reads, and is for tools rather than browsers
+@csrf_exempt
+@require_POST
+@timed_search_view
+def search_batch_api(request):
+    """JSON results of a batch of searches, run in one ES request.
+
+    POST a json object {"searches": [...]}, each search a query as in the
+    search form, or an object with query and optionally author and title
+    facet values.  At most settings.SEARCH_BATCH_MAX_SIZE searches.  The
+    fields and page_fields GET parameters select the result fields as for
+    search_api.
+
+    The response has an entry for each search, in order: query, total_hits,
+    partial, facets and results, or query, error and status if it failed.
+    The searches fail independently.
+    """
+    fields, page_fields, unknown = requested_fields(request)
+    if unknown:
+        return JsonResponse({'error': f'unknown fields: {", ".join(sorted(unknown))}'}, status=400)
+    try:
+        searches = json.loads(request.body)['searches']
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse({'error': 'expected a json object with a searches list'}, status=400)
+    if not isinstance(searches, list):
+        return JsonResponse({'error': 'expected a json object with a searches list'}, status=400)
+    if len(searches) > settings.SEARCH_BATCH_MAX_SIZE:
+        return JsonResponse({'error': f'at most {settings.SEARCH_BATCH_MAX_SIZE} searches'}, status=400)
+
+    entries, valid = [], []
+    for search in searches:
+        try:
+            query, filters = batch_search(search)
+        except ValueError as error:
+            entries.append({'query': search.get('query') if isinstance(search, dict) else search,
+                            'error': str(error), 'status': 400})
+            continue
+        entries.append({'query': query})
+        valid.append((entries[-1], query, filters))
+
+    results = handle_queries([(query, filters) for _, query, filters in valid]) if valid else []
+    for (entry, _, _), result in zip(valid, results):
+        if isinstance(result, SearchError):
+            entry.update({'error': str(result), 'status': result.status})
+            continue
+        total_hits, books, facets, partial = result
+        entry.update({'total_hits': total_hits, 'partial': partial, 'facets': facets,
+                      'results': [select_fields(book, fields, page_fields) for book in books]})
+    return JsonResponse({'searches': entries})
+
+
+@timed_search_view
+def suggest_api(request):
+    """JSON title and author suggestions for a partially typed query, GET ?query=
+
+    Queries shorter than settings.SUGGEST_MIN_CHARS get no suggestions.
+    """
+    query = request.GET.get('query', '').strip()
+    suggestions = cached_suggest(query) if len(query) >= settings.SUGGEST_MIN_CHARS else []
+    return JsonResponse({'query': query, 'suggestions': suggestions})
+
+
+@timed_search_view
+def book_matches(request, document: int):
+    """Further pages matching the query in one book, beyond those in the search results."""
+    form = SearchForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest('Missing query')
+    query = form.cleaned_data['query']
+    query_type, search_query = parse_query(query)
+    try:
+        pages, next_cursor = get_backend().more_book_pages(query_type, search_query, document,
+                                                           request.GET.get('cursor', ''))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid cursor')
+    return timed_render(request, "book_search/book_matches.html",
+                        {'query': query,
+                         'document': document,
+                         'pages': pages,
+                         'next_cursor': next_cursor})
+
+
+def page_cache_key(document: int, page: int, generation: int) -> str:
+    return f'page:{generation}:{document}:{page}'
+
+
+def render_pages(document: int, pages: [int]) -> dict:
+    """Render the pages of a document that exist, in one query.
+
+    :return {page_number: (etag, last modified timestamp or None, html)}
+    """
+    child_pages = list(ChildPage.objects.filter(parent_id=document, page_number__in=pages).select_related('parent'))
+    # read pages stored only in ES in one request
+    in_index = fetch_html_from_index([child_page.id for child_page in child_pages
+                                      if not child_page.html_content and child_page.compressed_content is None])
+    rendered = {}
+    for child_page in child_pages:
+        if child_page.id in in_index:
+            child_page._html = in_index[child_page.id]
+        html = render_to_string("book_search/document_page.html",
+                                {'html': child_page.html,
+                                 'page_number': child_page.page_number,
+                                 'title': child_page.title,
+                                 'author': child_page.author})
+        etag = quote_etag(hashlib.md5(html.encode('utf-8')).hexdigest())
+        converted_at = child_page.parent.converted_at
+        last_modified = int(converted_at.timestamp()) if converted_at else None
+        rendered[child_page.page_number] = (etag, last_modified, html)
+    return rendered
+
 
 def view_page(request, document: int, page: int):
-    child_page = ChildPage.objects.filter(parent_id=document).filter(page_number=page)[0]
-    return render(request, "book_search/document_page.html",
-                  {'html': child_page.html_content,
-                   'page_number': child_page.page_number,
-                   'title': child_page.title,
-                   'author': child_page.author})
+    """Render a page of a document.
+
+    Rendered pages are cached, along with the previous and next pages so
+    paging through a book is served from the cache.  Responses have ETag and
+    Last-Modified headers, so a repeat view returns 304 Not Modified.
+    """
+    cache = caches[settings.PAGE_CACHE_ALIAS]
+    generation = IndexGeneration.current()
+    cached = cache.get(page_cache_key(document, page, generation))
+    if cached is None:
+        rendered = render_pages(document, [page - 1, page, page + 1])
+        if page not in rendered:
+            raise Http404('Page not found')
+        cache.set_many({page_cache_key(document, page_number, generation): value
+                        for page_number, value in rendered.items()})
+        cached = rendered[page]
+
+    etag, last_modified, html = cached
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(html)
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
 
 ## query for parent_doc_id == 6 and page_number == 1
 # In [5]: ChildPage.objects.filter(parent__id=6).filter(page_number=1)
 # Out[5]: <QuerySet [<ChildPage: Cortland Dahl - The Three Wisdoms Exploring Reality M1 S1 - page 1>]>
+
+
+def metrics_view(request):
+    """Metrics in the Prometheus text format.
+
+    This process's metrics, followed by those written by the last ingest run
+    to settings.INGEST_METRICS_FILE.
+    """
+    content = metrics.REGISTRY.render([name for name in metrics.REGISTRY.metrics
+                                       if name not in metrics.INGEST_METRICS])
+    if settings.INGEST_METRICS_FILE:
+        try:
+            content += Path(settings.INGEST_METRICS_FILE).read_text()
+        except FileNotFoundError:
+            pass
+    return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -106,6 +106,34 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # search results, see book_search.elasticsearch.cached_search
+    # LocMemCache is per process and evicts the least recently used entries past
+    # MAX_ENTRIES; use a shared backend (eg redis) to share results between workers
+    'search': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'book-search-results',
+        'TIMEOUT': 600,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+    # rendered pages, see book_search.views.view_page
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'book-search-pages',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+}
+SEARCH_CACHE_ALIAS = 'search'
+PAGE_CACHE_ALIAS = 'pages'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -208,6 +236,68 @@ ELASTIC_URL = 'https://localhost:9200'
 ELASTIC_USER = 'elastic'
 ELASTIC_PASSWORD = env('ELASTIC_PASSWORD')
 ELASTIC_CA_CERT = '/Users/drogers/software/search/elasticsearch-8.13.0/config/certs/http_ca.crt'
+# shared search client (book_search.elasticsearch.get_client)
+# max keep-alive connections kept open to each node
+ELASTIC_CONNECTIONS_PER_NODE = 10
+# request timeout in seconds
+ELASTIC_TIMEOUT = 1000
+ELASTIC_MAX_RETRIES = 3
+ELASTIC_RETRY_ON_TIMEOUT = True
+
+# where ChildPage html is stored: 'db', 'compressed' or 'elasticsearch', see ChildPage
+# change with the convert_page_storage command so existing pages are moved too
+PAGE_STORAGE = 'db'
+# zlib level for 'compressed' page storage
+PAGE_COMPRESSION_LEVEL = 6
+
+# paged search (book_search.elasticsearch.search_page)
+# books per page, and pages per "more pages from this book" request
+SEARCH_PAGE_SIZE = 10
+# how long ES keeps the point in time open between page requests
+SEARCH_PIT_KEEP_ALIVE = '5m'
+# searches taking longer than this are logged with a breakdown of where the time went
+SEARCH_SLOW_QUERY_MS = 1000
+# highlighter for the matched page fragments: 'plain', 'unified' or 'fvh'.  The
+# content field is indexed with offsets for unified and term vectors for fvh, so
+# rebuild the index (rebuild_index command) after changing it.  Compare them on
+# the corpus with the benchmark_highlighting command
+SEARCH_HIGHLIGHTER = os.getenv('SEARCH_HIGHLIGHTER', 'plain')
+# what runs the searches: 'elasticsearch', or 'postgres' for PostgreSQL full text
+# search of the pages in the db, without an ES node (book_search.search_backends).
+# postgres needs PAGE_STORAGE = 'db' and the setup_postgres_search command run
+# first, and ES indexing can then be turned off with ELASTICSEARCH_DSL_AUTOSYNC =
+# False.  Compare them with benchmark_backends
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'elasticsearch')
+# latency budget in seconds of each search mode (query type), so a query matching
+# much of the corpus can't tie up a worker.  ES returns the hits it has collected
+# when the budget is spent, and the client gives up SEARCH_DEADLINE_GRACE seconds
+# later (fetching and highlighting the hits isn't in the budget).  The postgres
+# backend uses it as a statement_timeout.  Results are then flagged partial and
+# not cached.  Leave a mode out for no budget
+SEARCH_LATENCY_BUDGET = {'match': 2.0, 'match_phrase': 5.0}
+SEARCH_DEADLINE_GRACE = 1.0
+# pages each shard collects before returning early, 0 for no limit.  Bounds the
+# cost of very common words, but the best matches may be among those not
+# collected, so it is off by default
+SEARCH_TERMINATE_AFTER = 0
+# most searches in a batch (search_batch_api), all sent in one _msearch request
+SEARCH_BATCH_MAX_SIZE = 50
+# values of each facet (author, title) counted with the search results
+SEARCH_FACET_SIZE = 10
+# title and author suggestions (book_search.elasticsearch.suggest), from the
+# booksearch_suggest index.  Max suggestions returned, and the shortest query
+# that gets any
+SUGGEST_SIZE = 10
+SUGGEST_MIN_CHARS = 2
+
+# bulk ingest (convert_to_html_and_index --bulk)
+# pages per bulk_create batch and per ES bulk request
+INGEST_BULK_BATCH_SIZE = 500
+# max concurrent ES bulk requests per ingest process
+INGEST_BULK_IN_FLIGHT = 2
+# each ingest run writes its metrics here in Prometheus text format, served by the
+# metrics view along with the web process's own metrics.  None to not write them
+INGEST_METRICS_FILE = os.getenv('INGEST_METRICS_FILE', str(BASE_DIR / 'ingest_metrics.prom'))
 
 # django-elasticsearch-dsl
 ELASTICSEARCH_DSL = {
@@ -224,5 +314,36 @@ ELASTICSEARCH_DSL = {
 # for instance, 90 seconds without -> 3 seconds with
 # this assumes you don't want to OCR the pdf
 TIKA_CONFIG_FILE = '/Users/drogers/my-git/book-search/disable-tesseract-parser.xml'
-# how many times to retry call to Tika server if parsing fails
+# how many times to try parsing a document, on different servers if there are several
 TIKA_PARSE_MAX_RETRY = 3
+# seconds to wait before the first retry, doubled for each further retry
+TIKA_RETRY_BACKOFF = 1.0
+# seconds to wait for Tika to respond before failing over to another server
+TIKA_REQUEST_TIMEOUT = 300
+# Tika server endpoint (same environment variable as the tika package)
+TIKA_SERVER_ENDPOINT = os.getenv('TIKA_SERVER_ENDPOINT', 'http://localhost:9998')
+# pool of Tika servers to spread parsing over, comma separated in the environment.
+# If empty only TIKA_SERVER_ENDPOINT is used
+TIKA_SERVER_ENDPOINTS = [endpoint for endpoint in os.getenv('TIKA_SERVER_ENDPOINTS', '').split(',') if endpoint]
+# how requests are spread over the pool: 'round_robin' or 'least_busy'
+TIKA_DISPATCH = os.getenv('TIKA_DISPATCH', 'round_robin')
+# seconds a server that couldn't be reached is skipped before it is probed again
+TIKA_HEALTH_CHECK_INTERVAL = 30
+# max concurrent requests to the Tika server when ingesting with --workers
+TIKA_MAX_CONCURRENCY = 4
+
+# background OCR of pages that had no text when converted, eg of scanned books, as
+# ingest parses with OCR turned off (TIKA_CONFIG_FILE).  See the ocr_pages command.
+# Pages with fewer characters of text than this are queued for it
+OCR_MIN_PAGE_CHARS = 10
+# Tika servers with OCR (Tesseract) enabled, ie started without TIKA_CONFIG_FILE,
+# comma separated in the environment
+OCR_TIKA_ENDPOINTS = [endpoint for endpoint in os.getenv('OCR_TIKA_ENDPOINTS', 'http://localhost:9999').split(',')
+                      if endpoint]
+# headers of the OCR requests: with the auto strategy Tika only OCRs the pages of a
+# pdf without text, rather than every page
+OCR_TIKA_HEADERS = {'X-Tika-PDFOcrStrategy': 'auto'}
+# documents OCR'd at once, each a request to one of OCR_TIKA_ENDPOINTS
+OCR_WORKERS = 2
+# seconds to wait for an OCR parse, which takes far longer than one without
+OCR_REQUEST_TIMEOUT = 3600